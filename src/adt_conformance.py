@@ -0,0 +1,172 @@
+import argparse
+import re
+from src.coding_task_5 import pid_values, extract_pid_fields, build_adt_message
+from src.er7_serializer import render_adt_a01
+
+TIMESTAMP = "20240101120000"
+
+
+def patient(family="Russel", given=("James",), line="555 Hahn Village Unit 34", city="Westford",
+            state="Massachusetts", postal="00000", birth_date="2000-06-18", gender="male", id_="p1"):
+    name = {"family": family}
+    if given is not None:
+        name["given"] = list(given)
+    return {"resourceType": "Patient", "id": id_, "name": [name], "gender": gender, "birthDate": birth_date,
+            "address": [{"line": [line], "city": city, "state": state, "postalCode": postal}]}
+
+
+def condition(display="Allergic rhinitis"):
+    return {"resourceType": "Condition", "code": {"coding": [{"code": "61582004", "display": display}]}}
+
+
+# (case name, Patient, Condition, ICD-10 code, ICD-10 term)
+CASES = [
+    ("baseline", patient(), condition(), "J30.4", "Allergic rhinitis"),
+    ("component separator in family", patient(family="Smith^Jones"), condition(), "J30.4", "Allergic rhinitis"),
+    ("field separator in given", patient(given=("Ann|Marie",)), condition(), "J30.4", "Allergic rhinitis"),
+    ("subcomponent and repetition", patient(line="12 A&B St ~ Rear"), condition(), "J30.4", "Allergic rhinitis"),
+    ("escape character", patient(city="C:\\Temp\\Town"), condition(), "J30.4", "Allergic rhinitis"),
+    ("escape sequence lookalike", patient(family="\\F\\"), condition(), "J30.4", "Allergic rhinitis"),
+    ("line breaks", patient(line="Flat 2\nMain St\r"), condition("Rhinitis\r\nallergic"), "J30.4",
+     "Allergic rhinitis"),
+    ("subcomponent separator in given and city", patient(given=("A&B",), city="Town & Country"), condition(),
+     "J30.4", "Allergic rhinitis"),
+    ("hex escape lookalike", patient(family="\\X0D\\"), condition(), "J30.4", "Allergic rhinitis"),
+    ("no given name", patient(given=None), condition(), "J30.4", "Allergic rhinitis"),
+    ("empty given name", patient(given=()), condition(), "J30.4", "Allergic rhinitis"),
+    ("empty family and given", patient(family="", given=("",)), condition(), "J30.4", "Allergic rhinitis"),
+    ("empty address components", patient(line="", city="", state="", postal=""), condition(), "J30.4",
+     "Allergic rhinitis"),
+    ("unicode", patient(family="Müller-Łukasiewicz", given=("Zoë",), city="São Paulo"),
+     condition("Rhinite allergique – saisonnière"), "J30.4", "Rhinite allergique"),
+    ("delimiters in diagnosis", patient(), condition("Asthma ^ allergic | mixed & other ~"), "J45.909",
+     "Asthma^unspecified"),
+    ("empty diagnosis term", patient(), condition(""), "J30.4", ""),
+    ("female", patient(gender="female"), condition(), "J30.4", "Allergic rhinitis"),
+    ("unknown gender", patient(gender="unknown"), condition(), "J30.4", "Allergic rhinitis"),
+    ("no name, gender, birthDate or address", {"resourceType": "Patient", "id": "p2"}, condition(), "J30.4",
+     "Allergic rhinitis"),
+]
+
+
+# HL7 escape sequences hl7apy copies through instead of escaping their backslashes
+HL7APY_PASSTHROUGH = re.compile(r"\\[HNFSTRE]\\")
+
+UNESCAPES = {"F": "|", "S": "^", "T": "&", "R": "~", "E": "\\"}
+ESCAPE_SEQUENCE = re.compile(r"\\(X[0-9A-Fa-f]+|[FSTRE])\\")
+
+
+def unescape(value):
+    """
+        Decode the HL7 escape sequences of one data value (delimiters and hex data), independently
+        of er7_serializer.escape().
+    """
+    def replace(match):
+        code = match.group(1)
+        return bytes.fromhex(code[1:]).decode("latin-1") if code[0] == "X" else UNESCAPES[code]
+    return ESCAPE_SEQUENCE.sub(replace, value)
+
+
+def decoded(message, segment_id, field, component=1, subcomponent=1):
+    """
+        Value at SEG-field.component.subcomponent (1-based, as HL7 numbers them) of an ER7 message,
+        unescaped. Missing positions are "".
+    """
+    for segment in message.split("\r"):
+        fields = segment.split("|")
+        if fields[0] != segment_id:
+            continue
+        # MSH-1 is the field separator itself, so MSH fields are shifted by one
+        index = field - 1 if segment_id == "MSH" else field
+        value = fields[index] if index < len(fields) else ""
+        components = value.split("^")
+        value = components[component - 1] if component <= len(components) else ""
+        subcomponents = value.split("&")
+        return unescape(subcomponents[subcomponent - 1] if subcomponent <= len(subcomponents) else "")
+    return None
+
+
+def expected_values(values, condition_data, icd10_code, icd10_term, control_id):
+    """
+        ((segment, field, component, subcomponent), raw value) every message of a case must decode to.
+    """
+    return [
+        (("MSH", 10, 1, 1), control_id),
+        (("PID", 3, 1, 1), values["patient_id"]),
+        (("PID", 5, 1, 1), values["family"]),
+        (("PID", 5, 2, 1), values["given"]),
+        (("PID", 7, 1, 1), values["birthdate"]),
+        (("PID", 8, 1, 1), values["gender"]),
+        (("PID", 11, 1, 1), values["line"]),
+        (("PID", 11, 3, 1), values["city"]),
+        (("PID", 11, 4, 1), values["state"]),
+        (("PID", 11, 5, 1), values["postal"]),
+        (("DG1", 3, 1, 1), icd10_code),
+        (("DG1", 3, 2, 1), icd10_term),
+        (("DG1", 4, 1, 1), condition_data["code"]["coding"][0]["display"]),
+    ]
+
+
+def hl7apy_gap(values, condition_data, icd10_code, icd10_term):
+    """
+        Why hl7apy's ER7 for these raw values is not valid, or None. hl7apy writes CR/LF raw,
+        copies escape sequence lookalikes (\\F\\) through, and leaves a delimiter unescaped when
+        it could be structure below the level a value is assigned at: "&" in a component
+        (given name, city, ...), "^" and "&" in a whole field (DG1-4).
+    """
+    snomed_term = condition_data["code"]["coding"][0]["display"]
+    components = (values["given"], values["city"], values["state"], values["postal"], icd10_code, icd10_term)
+    every = (values["family"], values["line"], snomed_term) + components
+    if any("\r" in value or "\n" in value for value in every):
+        return "line break"
+    if any(HL7APY_PASSTHROUGH.search(value) for value in every):
+        return "escape sequence lookalike"
+    if any("&" in value for value in components) or "^" in snomed_term or "&" in snomed_term:
+        return "delimiter hl7apy does not escape at this level"
+    return None
+
+
+def run_cases(cases=CASES, verbose=False):
+    """
+        Render every case with the template serializer and check it two ways, both from the raw
+        input values: it must decode (unescape() above, not er7_serializer) back to every input
+        value, and it must match hl7apy's to_er7() for the same raw values byte for byte, except
+        where hl7apy's output is not valid ER7 (hl7apy_gap()).
+        Returns the failures as (case name, check, expected, actual).
+    """
+    failures = []
+    for number, (name, patient_data, condition_data, icd10_code, icd10_term) in enumerate(cases):
+        control_id = f"CONF{number:06d}"
+        values = pid_values(patient_data)
+        actual = render_adt_a01(extract_pid_fields(patient_data), condition_data, icd10_code, icd10_term,
+                                TIMESTAMP, control_id)
+        for position, value in expected_values(values, condition_data, icd10_code, icd10_term, control_id):
+            if decoded(actual, *position) != value:
+                failures.append((name, f"decode {position[0]}-{'.'.join(map(str, position[1:]))}", value,
+                                 decoded(actual, *position)))
+        gap = hl7apy_gap(values, condition_data, icd10_code, icd10_term)
+        expected = build_adt_message(values, condition_data, icd10_code, icd10_term, TIMESTAMP, control_id).to_er7()
+        if gap is None and actual != expected:
+            failures.append((name, "hl7apy", expected, actual))
+        if verbose:
+            print(f"{name}:" + (f" (decoded only: {gap})" if gap else ""))
+            print("  " + actual.replace("\r", "\n  "))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Check the ADT^A01 template serializer against hl7apy and an independent decoder")
+    parser.add_argument("--verbose", action="store_true", help="Print the expected message of every case")
+    args = parser.parse_args()
+
+    print()
+    failures = run_cases(verbose=args.verbose)
+    for name, check, expected, actual in failures:
+        print(f"MISMATCH {name} ({check}):")
+        print(f"  expected: {expected!r}")
+        print(f"  template: {actual!r}")
+    print(f"{len(CASES) - len({failure[0] for failure in failures})}/{len(CASES)} cases decode to their input "
+          f"values and match hl7apy where its output is valid ER7")
+    if failures:
+        raise SystemExit(1)
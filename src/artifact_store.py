@@ -0,0 +1,274 @@
+import argparse
+import gzip
+import itertools
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from src.registration import data_dir
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARTIFACT_DIR = data_dir / "artifacts"
+
+# File suffix of each compression; None writes plain NDJSON
+COMPRESSION_SUFFIXES = {None: ".ndjson", "gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}
+DEFAULT_COMPRESSION = "gzip"
+
+# Start a new part once a file reaches this many bytes on disk
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+_run_counter = itertools.count(1)
+
+
+def new_run_id():
+    """
+        Sortable, unique id of one writer run, so every run appends new files instead of
+        overwriting: microsecond time, then process id and a per-process counter, so two
+        runs in the same second (or microsecond) never publish to the same path.
+    """
+    return f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}-{next(_run_counter):06d}"
+
+
+def open_compressed(raw, compression, mode):
+    """
+        Wrap a binary file object for reading ("rb") or writing ("wb") with the given compression.
+    """
+    if compression is None:
+        return raw
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode=mode)
+    if zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+    if mode == "wb":
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    return zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+
+
+def compression_of(path):
+    name = Path(path).name
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if compression is not None and name.endswith(suffix):
+            return compression
+    return None
+
+
+class ArtifactWriter:
+    """
+        Appends compact NDJSON lines for one stream (by default a resource type) to
+        {stream}.{run id}.{part}.ndjson[.gz|.zst] files. Each part is written to a hidden temp
+        file and renamed into place when it is full or the writer closes, so readers only ever
+        see complete files.
+    """
+
+    def __init__(self, stream, directory=ARTIFACT_DIR, compression=DEFAULT_COMPRESSION,
+                 max_bytes=DEFAULT_MAX_BYTES, run_id=None):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.stream = stream
+        self.directory = Path(directory)
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.run_id = run_id or new_run_id()
+        self.part = 0
+        self.count = 0
+        self.paths = []
+        self._raw = None
+        self._file = None
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _final_path(self):
+        return self.directory / f"{self.stream}.{self.run_id}.{self.part:04d}{COMPRESSION_SUFFIXES[self.compression]}"
+
+    def _open(self):
+        self.part += 1
+        self._tmp_path = self.directory / f".{self._final_path().name}.tmp"
+        self._raw = open(self._tmp_path, "wb")
+        self._file = open_compressed(self._raw, self.compression, "wb")
+
+    def _finish(self):
+        if self._file is None:
+            return
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        path = self._final_path()
+        os.replace(self._tmp_path, path)
+        self.paths.append(path)
+        self._file = self._raw = None
+
+    def write(self, resource):
+        if self._file is None:
+            self._open()
+        self._file.write(json.dumps(resource, separators=(",", ":")).encode() + b"\n")
+        self.count += 1
+        # The raw position counts compressed bytes flushed so far, close enough for rotation
+        if self._raw.tell() >= self.max_bytes:
+            self._finish()
+
+    def close(self):
+        """
+            Publish the current part. Returns the paths of every part this writer produced.
+        """
+        self._finish()
+        return self.paths
+
+    def abort(self):
+        """
+            Drop the unfinished part without publishing it.
+        """
+        if self._file is not None:
+            if self._file is not self._raw:
+                self._file.close()
+            self._raw.close()
+            os.remove(self._tmp_path)
+            self._file = self._raw = None
+
+
+class ArtifactStore:
+    """
+        One ArtifactWriter per stream, sharing a run id. Use as a context manager: on success
+        every open part is published (`paths` then maps each stream to its files), on an
+        exception the unfinished parts are discarded.
+    """
+
+    def __init__(self, directory=ARTIFACT_DIR, compression=DEFAULT_COMPRESSION, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.run_id = new_run_id()
+        self.writers = {}
+        self.paths = {}
+
+    def write(self, resource, stream=None):
+        """
+            Append a resource to `stream`, by default its resourceType.
+        """
+        stream = stream or resource["resourceType"]
+        writer = self.writers.get(stream)
+        if writer is None:
+            writer = self.writers[stream] = ArtifactWriter(stream, self.directory, self.compression,
+                                                           self.max_bytes, self.run_id)
+        writer.write(resource)
+
+    def close(self):
+        self.paths = {stream: writer.close() for stream, writer in self.writers.items()}
+        return self.paths
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save_artifact(resource, stream=None, directory=ARTIFACT_DIR, compression=DEFAULT_COMPRESSION):
+    """
+        Write a single resource as its own artifact file. Returns the file path.
+    """
+    with ArtifactStore(directory, compression) as store:
+        store.write(resource, stream)
+    return store.writers[stream or resource["resourceType"]].paths[0]
+
+
+def artifact_paths(stream, directory=ARTIFACT_DIR, run="all"):
+    """
+        Published files of a stream, oldest first. run="latest" keeps only the newest run's
+        parts, any other value except "all" selects that run id.
+    """
+    paths = sorted(path for path in Path(directory).glob(f"{stream}.*.ndjson*")
+                   if path.name.split(".")[0] == stream)
+    if run == "all" or not paths:
+        return paths
+    if run == "latest":
+        run = paths[-1].name.split(".")[1]
+    return [path for path in paths if path.name.split(".")[1] == run]
+
+
+def iter_file(path):
+    """
+        Yield the resources of one artifact file, one line at a time.
+    """
+    compression = compression_of(path)
+    with open(path, "rb") as raw, open_compressed(raw, compression, "rb") as f:
+        # zstandard readers have no line iteration
+        for line in _iter_lines(f) if compression == "zstd" else f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _iter_lines(reader, chunk_size=1 << 16):
+    pending = b""
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def iter_artifacts(stream, directory=ARTIFACT_DIR, run="all"):
+    """
+        Stream every resource of a stream across its files, oldest first (see artifact_paths()).
+    """
+    for path in artifact_paths(stream, directory, run):
+        yield from iter_file(path)
+
+
+def iter_source(source, directory=ARTIFACT_DIR):
+    """
+        Stream the lines of an NDJSON source: an artifact or plain NDJSON file, a directory of
+        them, or the name of an artifact stream (its latest run).
+    """
+    path = Path(source)
+    if path.is_dir():
+        for child in sorted(path.iterdir()):
+            if ".ndjson" in child.name and not child.name.startswith("."):
+                yield from iter_file(child)
+    elif path.is_file():
+        yield from iter_file(path)
+    else:
+        yield from iter_artifacts(str(source), directory, run="latest")
+
+
+def load_latest(stream, directory=ARTIFACT_DIR):
+    """
+        The most recently written resource of a stream, or None if it has none.
+    """
+    resource = None
+    for resource in iter_artifacts(stream, directory, run="latest"):
+        pass
+    return resource
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List or dump NDJSON artifact streams")
+    parser.add_argument("stream", nargs="?", help="Stream to dump, e.g. Patient or parent_condition")
+    parser.add_argument("--run", default="all", help='"all", "latest" or a run id')
+    args = parser.parse_args()
+
+    if args.stream:
+        for resource in iter_artifacts(args.stream, run=args.run):
+            print(json.dumps(resource))
+    else:
+        streams = {}
+        for path in sorted(ARTIFACT_DIR.glob("*.ndjson*")):
+            streams.setdefault(path.name.split(".")[0], []).append(path)
+        for stream, paths in streams.items():
+            print(f"{stream}: {len(paths)} files, {sum(path.stat().st_size for path in paths)} bytes")
@@ -0,0 +1,261 @@
+import argparse
+import csv
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import requests
+from src import http_client, profile_validator
+from src.stub_server import start_stub_server
+from src.patient_transform import deidentify_patient, transform_patients
+from src.patient_columns import DEMOGRAPHIC_FIELDS, iter_demographic_rows, iter_patient_columns, patient_from_row
+from src.resource_templates import CONDITION_SKELETON, CONDITION_TEMPLATE, VITAL_SIGNS_PROFILE_URL, ResourceTemplate
+from src.er7_serializer import render_adt_a01
+from src.profile_validator import CompiledProfile, validate
+from src.batch_validation import PROCESS_CHUNK_SIZE, validate_concurrently
+
+
+def summarize_latencies(name, latencies):
+    """
+        Print mean / p50 / p95 for a list of latencies in seconds.
+    """
+    ordered = sorted(latencies)
+    p50 = ordered[len(ordered) // 2]
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{name:<10} mean {statistics.mean(ordered) * 1000:.3f} ms | "
+          f"p50 {p50 * 1000:.3f} ms | p95 {p95 * 1000:.3f} ms")
+
+
+def benchmark_http_pooling(requests_count=500):
+    """
+        Compare per-request latency of module-level requests.get (new connection
+        every call) with the pooled keep-alive Session from http_client,
+        against a local stub FHIR server.
+    """
+    patient = {"resourceType": "Patient", "id": "1", "name": [{"family": "Russel", "given": ["James"]}]}
+    server, base_url = start_stub_server({("GET", "/Patient/1"): (200, {}, patient)})
+    url = f"{base_url}/Patient/1"
+    try:
+        unpooled = []
+        for _ in range(requests_count):
+            start = time.perf_counter()
+            requests.get(url=url, timeout=http_client.DEFAULT_TIMEOUT).json()
+            unpooled.append(time.perf_counter() - start)
+
+        pooled = []
+        for _ in range(requests_count):
+            start = time.perf_counter()
+            http_client.get(url=url).json()
+            pooled.append(time.perf_counter() - start)
+    finally:
+        server.shutdown()
+
+    print(f"HTTP pooling benchmark ({requests_count} GETs against {base_url})")
+    summarize_latencies("unpooled", unpooled)
+    summarize_latencies("pooled", pooled)
+    print(f"speed-up (mean): {statistics.mean(unpooled) / statistics.mean(pooled):.2f}x")
+
+
+def synthetic_patient(number):
+    """
+        An OpenEMR-shaped Patient with an SSN and a second identifier, an extension and two addresses.
+    """
+    return {
+        "resourceType": "Patient",
+        "id": f"patient-{number}",
+        "meta": {"versionId": "1", "lastUpdated": "2025-01-01T00:00:00+00:00"},
+        "extension": [{"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race"}],
+        "identifier": [
+            {"system": "http://hl7.org/fhir/sid/us-ssn", "value": f"{number:09d}"},
+            {"system": "http://terminology.hl7.org/CodeSystem/v2-0203", "value": str(number)},
+        ],
+        "name": [{"family": "Russel", "given": ["James"]}],
+        "gender": "male" if number % 2 else "female",
+        "birthDate": "1990-05-17",
+        "address": [
+            {"line": [f"{number} Main St"], "city": "Indianapolis", "state": "IN", "postalCode": "46202"},
+            {"line": ["1 Oak Ave"], "city": "Carmel", "district": "", "state": "IN", "postalCode": "46032"},
+        ],
+    }
+
+
+def benchmark_patient_transform(patient_count=1_000_000, chunk_size=10_000):
+    """
+        Throughput of the compiled de-identification transform over a stream of synthetic
+        Patients. Patients are generated in chunks outside the timed section, so only
+        the transform itself is measured.
+    """
+    elapsed = 0.0
+    for chunk_start in range(0, patient_count, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, patient_count)
+        chunk = [synthetic_patient(number) for number in range(chunk_start, chunk_end)]
+        start = time.perf_counter()
+        for _ in transform_patients(chunk, deidentify_patient):
+            pass
+        elapsed += time.perf_counter() - start
+    print(f"Patient transform benchmark ({patient_count} synthetic patients)")
+    print(f"{elapsed:.2f}s total | {patient_count / elapsed:,.0f} patients/s | {elapsed / patient_count * 1e6:.2f} µs/patient")
+
+
+def retained_bytes_per_resource(build, count):
+    """
+        Build and keep `count` resources; returns the bytes they still hold, per resource.
+    """
+    tracemalloc.start()
+    resources = [build(number) for number in range(count)]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del resources
+    return allocated / count
+
+
+def benchmark_resource_templates(resource_count=200_000):
+    """
+        Memory retained and build time per Condition with every container rebuilt on each
+        call (what the old dict literal did) versus a template that shares its constant parts.
+    """
+    templates = (("literal", ResourceTemplate(CONDITION_SKELETON, share_constants=False)),
+                 ("template", CONDITION_TEMPLATE))
+    print(f"Resource template benchmark ({resource_count} Conditions)")
+    for name, template in templates:
+        def build(number):
+            return template.build(patient_id=number, code=str(number), display="Allergic rhinitis",
+                                  onset="2012-05-24")
+        start = time.perf_counter()
+        for number in range(resource_count):
+            build(number)
+        elapsed = time.perf_counter() - start
+        per_resource = retained_bytes_per_resource(build, resource_count)
+        print(f"{name:<10} {per_resource:,.0f} bytes/resource | {elapsed / resource_count * 1e6:.2f} µs/resource")
+
+
+def benchmark_adt_serializer(message_count=500):
+    """
+        ADT^A01 messages/s built with hl7apy (Message + to_er7) versus the precompiled
+        ER7 template of er7_serializer.py, for the same Patients and Condition (PID extraction included).
+    """
+    from src.coding_task_5 import extract_pid_fields, pid_values, build_adt_message
+
+    patients = [synthetic_patient(number) for number in range(message_count)]
+    condition = {"code": {"coding": [{"code": "61582004", "display": "Allergic rhinitis"}]}}
+    timestamp = "20240101120000"
+    paths = (
+        ("hl7apy", lambda patient, control_id: build_adt_message(
+            pid_values(patient), condition, "J30.4", "Allergic rhinitis", timestamp, control_id).to_er7()),
+        ("template", lambda patient, control_id: render_adt_a01(
+            extract_pid_fields(patient), condition, "J30.4", "Allergic rhinitis", timestamp, control_id)),
+    )
+    print(f"ADT serializer benchmark ({message_count} ADT^A01 messages)")
+    for name, render in paths:
+        start = time.perf_counter()
+        for number, patient in enumerate(patients):
+            render(patient, f"MSG{number:08d}")
+        elapsed = time.perf_counter() - start
+        print(f"{name:<10} {elapsed:.2f}s | {message_count / elapsed:,.0f} messages/s | "
+              f"{elapsed / message_count * 1e6:.2f} µs/message")
+
+
+def benchmark_patient_columns(patient_count=200_000, chunk_size=50_000):
+    """
+        Demographics file to de-identified Patients and PID fields: one Patient dict per row through
+        deidentify_patient and extract_pid_fields, versus PatientColumns built straight from the rows.
+        Both read the same CSV file, so reading it is part of both timings.
+    """
+    from src.coding_task_5 import extract_pid_fields
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "demographics.csv"
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(DEMOGRAPHIC_FIELDS)
+            for number in range(patient_count):
+                writer.writerow([number, "Russel", "James", "male" if number % 2 else "female", "1990-05-17",
+                                 f"{number} Main St", "Indianapolis", "" if number % 3 else "Marion", "IN", "46202"])
+        paths = (
+            ("per-dict", lambda: [(deidentify_patient(patient), extract_pid_fields(patient)) for patient in
+                                  (patient_from_row(row) for row in iter_demographic_rows(path))]),
+            ("columnar", lambda: [(list(columns.iter_patients()), list(columns.iter_pid_fields()))
+                                  for columns in iter_patient_columns(path, chunk_size)]),
+        )
+        print(f"Patient columns benchmark ({patient_count} demographics rows, chunks of {chunk_size})")
+        for name, run in paths:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print(f"{name:<10} {elapsed:.2f}s | {patient_count / elapsed:,.0f} patients/s")
+
+
+# Enough of the R4 vitalsigns profile for the validator to do per-resource work
+VITAL_SIGNS_DEFINITION = {
+    "resourceType": "StructureDefinition", "url": VITAL_SIGNS_PROFILE_URL, "type": "Observation",
+    "differential": {"element": [
+        {"id": "Observation.status", "path": "Observation.status", "min": 1, "max": "1"},
+        {"id": "Observation.category", "path": "Observation.category", "min": 1},
+        {"id": "Observation.category:VSCat", "path": "Observation.category", "sliceName": "VSCat",
+         "min": 1, "max": "1"},
+        {"id": "Observation.category:VSCat.coding.system", "path": "Observation.category.coding.system",
+         "min": 1, "max": "1", "fixedUri": "http://terminology.hl7.org/CodeSystem/observation-category"},
+        {"id": "Observation.category:VSCat.coding.code", "path": "Observation.category.coding.code",
+         "min": 1, "max": "1", "fixedCode": "vital-signs"},
+        {"id": "Observation.subject", "path": "Observation.subject", "min": 1,
+         "type": [{"code": "Reference", "targetProfile": ["http://hl7.org/fhir/StructureDefinition/Patient"]}]},
+        {"id": "Observation.effective[x]", "path": "Observation.effective[x]", "min": 1},
+    ]},
+}
+
+
+def synthetic_observation(number):
+    return {"resourceType": "Observation", "id": f"obs-{number}", "meta": {"profile": [VITAL_SIGNS_PROFILE_URL]},
+            "status": "final",
+            "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                                      "code": "vital-signs"}]}],
+            "code": {"coding": [{"system": "http://loinc.org", "code": "85354-9"}]},
+            "subject": {"reference": f"Patient/patient-{number % 100}"}, "effectiveDateTime": "2025-11-27",
+            "component": [{"code": {"coding": [{"system": "http://loinc.org", "code": code}]},
+                           "valueQuantity": {"value": value, "unit": "mmHg", "system": "http://unitsofmeasure.org"}}
+                          for code, value in (("8480-6", 120 + number % 40), ("8462-4", 80 + number % 20))]}
+
+
+def benchmark_batch_validation(resource_count=5_000, workers=8):
+    """
+        Local (compiled profile) validation of synthetic vital-signs Observations: serially in this
+        process, on `workers` threads, and on `workers` processes with one resource per task and
+        with batch_validation.PROCESS_CHUNK_SIZE resources per task.
+    """
+    # Set before the pools start, so forked worker processes inherit the compiled profile
+    profile_validator._profiles = {VITAL_SIGNS_PROFILE_URL: CompiledProfile(VITAL_SIGNS_DEFINITION)}
+    resources = [synthetic_observation(number) for number in range(resource_count)]
+    runs = (
+        ("serial", dict(workers=1)),
+        ("threads", dict(workers=workers)),
+        ("processes", dict(workers=workers, processes=True)),
+        (f"chunks of {PROCESS_CHUNK_SIZE}", dict(workers=workers, processes=True, chunk_size=PROCESS_CHUNK_SIZE)),
+    )
+    print(f"Batch validation benchmark ({resource_count} Observations, {workers} workers, "
+          f"{os.cpu_count()} CPUs)")
+    for name, options in runs:
+        start = time.perf_counter()
+        validated = sum(1 for _ in validate_concurrently(resources, validate, **options))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<15} {elapsed:.2f}s | {validated / elapsed:,.0f} resources/s")
+
+
+BENCHMARKS = {
+    "http": benchmark_http_pooling,
+    "patient-transform": benchmark_patient_transform,
+    "templates": benchmark_resource_templates,
+    "patient-columns": benchmark_patient_columns,
+    "adt": benchmark_adt_serializer,
+    "validation": benchmark_batch_validation,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pipeline micro-benchmarks")
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS), help=f"Benchmarks to run: {', '.join(BENCHMARKS)}")
+    args = parser.parse_args()
+    for name in args.names:
+        print()
+        BENCHMARKS[name]()
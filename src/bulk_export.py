@@ -0,0 +1,149 @@
+import argparse
+import json
+import time
+from src import http_client
+from src.artifact_store import ArtifactStore, ARTIFACT_DIR
+from src.http_client import BASE_URL
+from src.coding_task_1 import get_headers, clean_patient_resource
+
+EXPORT_TYPES = ("Patient", "Condition", "Observation", "Procedure")
+
+# Transform applied to every exported resource of a given type before it is handed on
+EXPORT_TRANSFORMS = {
+    "Patient": clean_patient_resource,
+}
+
+
+def build_export_url(level="system", group_id=None, base_url=BASE_URL):
+    """
+        Kick-off url for a FHIR Bulk Data export:
+        system -> /$export, patient -> /Patient/$export, group -> /Group/{id}/$export.
+    """
+    if level == "group":
+        return f'{base_url}/Group/{group_id}/$export'
+    if level == "patient":
+        return f'{base_url}/Patient/$export'
+    return f'{base_url}/$export'
+
+
+def kickoff_export(level="system", group_id=None, resource_types=EXPORT_TYPES, since=None,
+                   headers=None, base_url=BASE_URL):
+    """
+        Start an asynchronous $export on the server.
+        Returns the status (polling) url from the Content-Location header, or None on error.
+    """
+    url = build_export_url(level, group_id, base_url)
+    params = {"_type": ",".join(resource_types)}
+    if since:
+        params["_since"] = since
+    request_headers = {**(http_client.resolve_headers(headers) or {}),
+                       "Accept": "application/fhir+json", "Prefer": "respond-async"}
+    response = http_client.get(url=url, headers=request_headers, params=params)
+    print(response.url)
+    if response.status_code != 202:
+        print(f"Error when starting bulk export: {response.status_code}")
+        print(response.text)
+        return None
+    return response.headers.get("Content-Location")
+
+
+def poll_export_status(status_url, headers=None, poll_interval=5, max_wait=3600):
+    """
+        Poll the export status url until the export completes.
+        Honors Retry-After while the server answers 202 and prints X-Progress.
+        Returns the completion manifest (dict), or None on error/timeout.
+    """
+    deadline = time.monotonic() + max_wait
+    while time.monotonic() < deadline:
+        response = http_client.get(url=status_url, headers=headers)
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code != 202:
+            print(f"Error when polling bulk export status: {response.status_code}")
+            print(response.text)
+            return None
+        progress = response.headers.get("X-Progress")
+        if progress:
+            print(f"Export in progress: {progress}")
+        retry_after = response.headers.get("Retry-After", "")
+        time.sleep(float(retry_after) if retry_after.isdigit() else poll_interval)
+    print("Timed out waiting for bulk export")
+    return None
+
+
+def iter_ndjson_resources(file_url, headers=None):
+    """
+        Stream one NDJSON output file and yield its resources one line at a time,
+        without holding the whole file in memory.
+    """
+    with http_client.get(url=file_url, headers={**(http_client.resolve_headers(headers) or {}),
+                                                   "Accept": "application/fhir+ndjson"},
+                         stream=True) as response:
+        if response.status_code != 200:
+            print(f"Error when downloading {file_url}: {response.status_code}")
+            return
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def iter_export_resources(manifest, headers=None, resource_types=None, transforms=EXPORT_TRANSFORMS):
+    """
+        Yield every resource listed in an export manifest, passing each one through
+        the transform registered for its type (e.g. Patient de-identification).
+    """
+    file_headers = headers if manifest.get("requiresAccessToken") else None
+    for output in manifest.get("output", []):
+        resource_type = output.get("type")
+        if resource_types and resource_type not in resource_types:
+            continue
+        transform = transforms.get(resource_type)
+        for resource in iter_ndjson_resources(output["url"], file_headers):
+            yield transform(resource) if transform else resource
+
+
+def run_bulk_export(level="system", group_id=None, resource_types=EXPORT_TYPES, since=None,
+                    directory=ARTIFACT_DIR, headers=None, base_url=BASE_URL, poll_interval=5):
+    """
+        Kick off an export, wait for it, and stream the transformed resources into the
+        "bulk_export" artifact stream (artifact_store.py: compressed, rotated parts).
+        `headers` defaults to coding_task_1.get_headers, called for every request, so polling
+        and downloads keep working after the access token is renewed.
+        Returns a dict with the number of resources written per type.
+    """
+    headers = headers if headers is not None else get_headers
+    status_url = kickoff_export(level, group_id, resource_types, since, headers, base_url)
+    if status_url is None:
+        return {}
+    manifest = poll_export_status(status_url, headers, poll_interval=poll_interval)
+    if manifest is None:
+        return {}
+
+    counts = {}
+    with ArtifactStore(directory) as store:
+        for resource in iter_export_resources(manifest, headers, resource_types):
+            store.write(resource, stream="bulk_export")
+            resource_type = resource.get("resourceType")
+            counts[resource_type] = counts.get(resource_type, 0) + 1
+    for path in store.paths.get("bulk_export", []):
+        print(f"Bulk export resources saved to: {path}")
+    for resource_type, count in counts.items():
+        print(f"{resource_type}: {count}")
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="FHIR Bulk Data $export ingestion from OpenEMR")
+    parser.add_argument("--level", choices=["system", "patient", "group"], default="system")
+    parser.add_argument("--group", help="Group id for a group-level export")
+    parser.add_argument("--types", default=",".join(EXPORT_TYPES), help="Comma-separated resource types")
+    parser.add_argument("--since", help="Only export resources updated after this instant (_since)")
+    parser.add_argument("--dir", default=ARTIFACT_DIR, help="Artifact directory (default: data/artifacts)")
+    parser.add_argument("--base-url", default=BASE_URL, help="FHIR server base url (e.g. a local stub)")
+    args = parser.parse_args()
+    if args.level == "group" and not args.group:
+        parser.error("--level group needs --group")
+
+    print()
+    run_bulk_export(level=args.level, group_id=args.group, resource_types=tuple(args.types.split(",")),
+                    since=args.since, directory=args.dir, base_url=args.base_url)
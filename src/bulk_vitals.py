@@ -0,0 +1,156 @@
+import argparse
+import csv
+import json
+import math
+import time
+import uuid
+from itertools import islice
+from pathlib import Path
+import numpy as np
+from src.artifact_store import ArtifactStore, ARTIFACT_DIR
+from src.resource_templates import build_blood_pressure
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# Artifact stream the bulk Observations are written to
+OBSERVATION_STREAM = "bp_observations"
+
+# Input columns (CSV header names / NDJSON keys)
+READING_FIELDS = ("patient", "timestamp", "systolic", "diastolic")
+
+# Interpretation thresholds in mmHg: below low -> L, at or above high -> H, otherwise N
+SYSTOLIC_RANGE = (90, 140)
+DIASTOLIC_RANGE = (60, 90)
+
+# Namespace of the deterministic (uuid5) Observation identifiers: the same reading always gets the same id
+VITALS_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "http://example.org/fhir/vitals/blood-pressure")
+
+
+def iter_reading_rows(path):
+    """
+        Yield (patient, timestamp, systolic, diastolic) tuples of strings from a CSV file
+        with a header row, or from an NDJSON file with one reading object per line.
+    """
+    path = Path(path)
+    with open(path, "r", newline="") as f:
+        if path.suffix.lower() == ".csv":
+            for row in csv.DictReader(f):
+                yield tuple(row.get(field) for field in READING_FIELDS)
+        else:
+            for line in f:
+                if line.strip():
+                    reading = json.loads(line)
+                    yield tuple(reading.get(field) for field in READING_FIELDS)
+
+
+def iter_reading_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Read a readings file in chunks of at most chunk_size rows.
+        Yields (patients, timestamps, systolic, diastolic, skipped): the first two are lists,
+        the values are float arrays, and skipped counts rows with a missing or non-numeric value.
+    """
+    rows = iter_reading_rows(path)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        patients, timestamps, systolic, diastolic = [], [], [], []
+        for patient, timestamp, systolic_value, diastolic_value in chunk:
+            try:
+                values = float(systolic_value), float(diastolic_value)
+            except (TypeError, ValueError):
+                continue
+            if not patient or not timestamp or not all(map(math.isfinite, values)):
+                continue
+            patients.append(str(patient))
+            timestamps.append(str(timestamp))
+            systolic.append(values[0])
+            diastolic.append(values[1])
+        yield (patients, timestamps, np.array(systolic, dtype=np.float64), np.array(diastolic, dtype=np.float64),
+               len(chunk) - len(patients))
+
+
+def interpret(values, value_range):
+    """
+        Vectorized N/H/L interpretation codes for an array of values.
+    """
+    low, high = value_range
+    return np.where(values >= high, "H", np.where(values < low, "L", "N"))
+
+
+def interpret_panel(systolic_codes, diastolic_codes):
+    """
+        Panel interpretation: H if any component is high, else L if any is low, else N.
+    """
+    high = (systolic_codes == "H") | (diastolic_codes == "H")
+    low = (systolic_codes == "L") | (diastolic_codes == "L")
+    return np.where(high, "H", np.where(low, "L", "N"))
+
+
+def observation_identifier(patient, timestamp):
+    return f"urn:uuid:{uuid.uuid5(VITALS_NAMESPACE, f'{patient}|{timestamp}')}"
+
+
+def quantity(value):
+    """
+        JSON value of a reading: 120.0 -> 120, 120.5 stays 120.5.
+    """
+    return int(value) if value.is_integer() else value
+
+
+def iter_blood_pressure_observations(path, chunk_size=DEFAULT_CHUNK_SIZE, stats=None):
+    """
+        Stream blood pressure panel Observations built from a readings file, one chunk in
+        memory at a time. Interpretations are computed per chunk with vectorized thresholds.
+        `stats` (a dict), if given, receives the number of readings and skipped rows.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("readings", 0)
+    stats.setdefault("skipped", 0)
+    for patients, timestamps, systolic, diastolic, skipped in iter_reading_chunks(path, chunk_size):
+        stats["skipped"] += skipped
+        systolic_codes = interpret(systolic, SYSTOLIC_RANGE)
+        diastolic_codes = interpret(diastolic, DIASTOLIC_RANGE)
+        panel_codes = interpret_panel(systolic_codes, diastolic_codes)
+        for row in zip(patients, timestamps, systolic.tolist(), diastolic.tolist(), systolic_codes.tolist(),
+                       diastolic_codes.tolist(), panel_codes.tolist()):
+            patient, timestamp, systolic_value, diastolic_value, systolic_code, diastolic_code, panel_code = row
+            stats["readings"] += 1
+            yield build_blood_pressure(
+                patient_id=patient, identifier=observation_identifier(patient, timestamp), effective=timestamp,
+                systolic=quantity(systolic_value), diastolic=quantity(diastolic_value),
+                systolic_code=systolic_code, diastolic_code=diastolic_code, panel_code=panel_code,
+            )
+
+
+def write_observations(observations, directory=ARTIFACT_DIR, stream=OBSERVATION_STREAM):
+    """
+        Write the Observations to the `stream` artifact stream (artifact_store.py: compressed,
+        rotated parts, a new run each time, published only once every Observation is written).
+        Returns (number written, paths of the published parts).
+    """
+    count = 0
+    with ArtifactStore(directory) as store:
+        for observation in observations:
+            store.write(observation, stream=stream)
+            count += 1
+    return count, store.paths.get(stream, [])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk blood pressure readings to FHIR Observations")
+    parser.add_argument("readings", help="CSV (with header) or NDJSON file of patient, timestamp, systolic, diastolic")
+    parser.add_argument("--dir", default=ARTIFACT_DIR, help="Artifact directory (default: data/artifacts)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    print()
+    stats = {}
+    start = time.perf_counter()
+    count, paths = write_observations(iter_blood_pressure_observations(args.readings, args.chunk_size, stats),
+                                      args.dir)
+    elapsed = time.perf_counter() - start
+    print(f"Created {count} Observations in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f}/s), "
+          f"skipped {stats['skipped']} invalid rows")
+    for path in paths:
+        print(f"Observations saved to: {path}")
@@ -0,0 +1,314 @@
+import argparse
+import json
+import time
+import uuid
+from pathlib import Path
+from src import write_scheduler
+from src.registration import data_dir
+from src.http_client import PRIMARY_FHIR_URL
+from src.coding_task_1 import clean_patient_resource
+from src.identity_map import (get_identity_map, add_source_identifier, if_none_exist, id_from_location,
+                              remap_references)
+from src.artifact_store import iter_source
+from src.bulk_vitals import OBSERVATION_STREAM
+
+# Resource types loaded with each Patient; each one points at the Patient through `subject`
+DEPENDENT_TYPES = ("Condition", "Observation", "Procedure")
+
+DEFAULT_BATCH_SIZE = 50
+
+
+def new_full_url():
+    return f"urn:uuid:{uuid.uuid4()}"
+
+
+def prepare_dependent(resource, patient_reference, source_patient_id=None):
+    """
+        Strip the server-assigned id/meta of a source resource and point its subject at
+        `patient_reference` (a urn:uuid fullUrl or a Patient/{id} reference). Its other references
+        to the source patient get the same target; references to other source resources are
+        remapped through the identity map or dropped (identity_map.remap_references()).
+        Modifies it in place.
+    """
+    resource.pop("id", None)
+    resource.pop("meta", None)
+    resource["subject"] = {"reference": patient_reference}
+    aliases = {f"Patient/{source_patient_id}": patient_reference} if source_patient_id is not None else None
+    return remap_references(resource, get_identity_map(), aliases=aliases)
+
+
+def source_patient_id(record):
+    return record.get("patient_id") or (record.get("Patient") or {}).get("id")
+
+
+def skipped_patient(record):
+    """
+        Result of a record without a Patient (e.g. the Patient fetch failed during extraction):
+        nothing of it is loaded.
+    """
+    print(f"Skipping record {source_patient_id(record)}: it has no Patient")
+    return {"resourceType": "Patient", "source_id": source_patient_id(record), "status": "skipped",
+            "target_id": None, "outcome": "record has no Patient"}
+
+
+def create_entry(resource, full_url=None, source_id=None):
+    """
+        POST entry for a resource. With a source_id the resource gets its stable source identifier
+        and the request an ifNoneExist on it, so reloading a record does not duplicate it.
+    """
+    entry = {"resource": resource, "request": {"method": "POST", "url": resource["resourceType"]}}
+    if source_id is not None:
+        entry["request"]["ifNoneExist"] = if_none_exist(add_source_identifier(resource, source_id))
+    if full_url:
+        entry = {"fullUrl": full_url, **entry}
+    return entry
+
+
+def build_transaction_bundle(record):
+    """
+        One transaction Bundle for a cohort record (see cohort.py): the Patient gets a urn:uuid
+        fullUrl and every Condition/Observation/Procedure references it, so the server creates
+        them all atomically without a round trip for the Patient id first.
+        Returns (bundle, sources): sources[i] is the (resourceType, source id) of entry i.
+    """
+    patient = record["Patient"]
+    patient_url = new_full_url()
+    patient_id = source_patient_id(record)
+    sources = [("Patient", patient_id)]
+    entries = [create_entry(clean_patient_resource(patient), patient_url, patient_id)]
+    for resource_type in DEPENDENT_TYPES:
+        for resource in record.get(resource_type) or []:
+            source_id = resource.get("id")
+            sources.append((resource_type, source_id))
+            entries.append(create_entry(prepare_dependent(resource, patient_url, patient_id), new_full_url(),
+                                        source_id))
+    return {"resourceType": "Bundle", "type": "transaction", "entry": entries}, sources
+
+
+def build_batch_bundle(items):
+    """
+        One batch Bundle from (resource, source) pairs. Batch entries are processed
+        independently, so they must not reference each other.
+        Returns (bundle, sources) like build_transaction_bundle().
+    """
+    sources = [source for _, source in items]
+    entries = [create_entry(resource, source_id=source_id) for resource, (_, source_id) in items]
+    return {"resourceType": "Bundle", "type": "batch", "entry": entries}, sources
+
+
+def target_id(response_entry):
+    """
+        Id of the created resource, from the entry's resource or its Location (Type/id/_history/n).
+    """
+    resource = response_entry.get("resource") or {}
+    if resource.get("id"):
+        return resource["id"]
+    return id_from_location((response_entry.get("response") or {}).get("location"))
+
+
+def map_responses(sources, response_bundle):
+    """
+        Pair every response entry with the source resource of the request entry at the same
+        position (FHIR keeps the order). Returns one result dict per entry:
+        resourceType, source_id, status, target_id and, for failures, outcome.
+    """
+    results = []
+    response_entries = (response_bundle or {}).get("entry", [])
+    for position, (resource_type, source_id) in enumerate(sources):
+        entry = response_entries[position] if position < len(response_entries) else {}
+        response = entry.get("response") or {}
+        status = response.get("status", "")
+        result = {"resourceType": resource_type, "source_id": source_id, "status": status,
+                  "target_id": target_id(entry) if status.startswith("2") else None}
+        if not status.startswith("2"):
+            result["outcome"] = response.get("outcome") or entry.get("resource")
+        results.append(result)
+    return results
+
+
+def record_identities(results):
+    """
+        Save the source -> target id of every created (or matched) resource in the identity map.
+    """
+    get_identity_map().put_many([(result["resourceType"], result["source_id"], result["target_id"])
+                                 for result in results if result["target_id"] and result["source_id"] is not None])
+    return results
+
+
+def post_bundle(bundle, sources, base_url=PRIMARY_FHIR_URL):
+    """
+        POST a transaction/batch Bundle to the server base and map the response back to sources.
+        Returns the list of per-entry results; on an HTTP error every entry is reported as failed.
+    """
+    headers = {'Content-Type': 'application/fhir+json'}
+    # Safe to resend after a timeout only when every entry is a conditional create
+    idempotent = all("ifNoneExist" in entry["request"] for entry in bundle["entry"])
+    response = write_scheduler.post(url=base_url, headers=headers, json=bundle, idempotent=idempotent)
+    if response.status_code != 200:
+        print(f"Error posting {bundle['type']} Bundle with {len(sources)} entries: {response.status_code}")
+        try:
+            outcome = response.json()
+        except ValueError:
+            outcome = response.text or None
+        return [{"resourceType": resource_type, "source_id": source_id, "status": str(response.status_code),
+                 "target_id": None, "outcome": outcome} for resource_type, source_id in sources]
+    return record_identities(map_responses(sources, response.json()))
+
+
+def load_transactions(records, base_url=PRIMARY_FHIR_URL):
+    """
+        Load every cohort record as its own transaction Bundle (one request per patient).
+        Records without a Patient are skipped. Yields the per-entry results.
+    """
+    for record in records:
+        if not record.get("Patient"):
+            yield skipped_patient(record)
+            continue
+        bundle, sources = build_transaction_bundle(record)
+        yield from post_bundle(bundle, sources, base_url)
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_batches(records, batch_size=DEFAULT_BATCH_SIZE, base_url=PRIMARY_FHIR_URL):
+    """
+        Load cohort records with batch Bundles of up to batch_size entries, many patients per request.
+        Because batch entries cannot reference each other, each chunk of records is loaded in two
+        passes: first the Patients, then their Conditions/Observations/Procedures with the subject
+        set to the new Patient ids. Patients already in the identity map are not sent again
+        (status "mapped"), and resources of a Patient that failed or is missing ("skipped") are not sent.
+        Yields the per-entry results.
+    """
+    identity_map = get_identity_map()
+    for chunk in iter_chunks(records, batch_size):
+        patient_results = [None] * len(chunk)
+        patients, positions = [], []
+        for position, record in enumerate(chunk):
+            if not record.get("Patient"):
+                patient_results[position] = skipped_patient(record)
+                continue
+            patient_id = source_patient_id(record)
+            mapped = identity_map.get("Patient", patient_id)
+            if mapped is not None:
+                patient_results[position] = {"resourceType": "Patient", "source_id": patient_id, "status": "mapped",
+                                             "target_id": mapped}
+                continue
+            patients.append((clean_patient_resource(record["Patient"]), ("Patient", patient_id)))
+            positions.append(position)
+        if patients:
+            for position, result in zip(positions, post_bundle(*build_batch_bundle(patients), base_url)):
+                patient_results[position] = result
+        yield from patient_results
+
+        dependents = []
+        for record, result in zip(chunk, patient_results):
+            if result["target_id"] is None:
+                continue
+            for resource_type in DEPENDENT_TYPES:
+                for resource in record.get(resource_type) or []:
+                    source = (resource_type, resource.get("id"))
+                    if source[1] is not None and identity_map.get(*source) is not None:
+                        continue
+                    dependents.append((prepare_dependent(resource, f"Patient/{result['target_id']}",
+                                                         result["source_id"]), source))
+        for items in iter_chunks(dependents, batch_size):
+            yield from post_bundle(*build_batch_bundle(items), base_url)
+
+
+def observation_source_id(observation):
+    """
+        Source id of a standalone Observation: the value of its first identifier (bulk_vitals.py
+        gives every reading a deterministic urn:uuid), else its id.
+    """
+    identifiers = observation.get("identifier") or []
+    return identifiers[0].get("value") if identifiers else observation.get("id")
+
+
+def load_observations(observations, batch_size=DEFAULT_BATCH_SIZE, base_url=PRIMARY_FHIR_URL):
+    """
+        Load standalone Observations, e.g. the bulk_vitals.py `bp_observations` stream, with batch
+        Bundles of up to batch_size entries. Their subject is the source patient (Patient/{source id}),
+        resolved through the identity map to the Patient loaded before; Observations of a patient
+        that is not loaded are skipped ("skipped"), and Observations already in the identity map are
+        not sent again ("mapped"). Other references are kept: the readings are built for the primary
+        server. Yields the per-entry results in input order.
+    """
+    identity_map = get_identity_map()
+    for chunk in iter_chunks(observations, batch_size):
+        results = [None] * len(chunk)
+        items, positions = [], []
+        for position, observation in enumerate(chunk):
+            source_id = observation_source_id(observation)
+            reference = (observation.get("subject") or {}).get("reference", "")
+            patient_id = identity_map.get("Patient", reference.split("/")[-1])
+            if patient_id is None:
+                print(f"Skipping Observation {source_id}: patient {reference} is not loaded")
+                results[position] = {"resourceType": "Observation", "source_id": source_id, "status": "skipped",
+                                     "target_id": None, "outcome": f"patient {reference} is not loaded"}
+                continue
+            mapped = identity_map.get("Observation", source_id)
+            if mapped is not None:
+                results[position] = {"resourceType": "Observation", "source_id": source_id, "status": "mapped",
+                                     "target_id": mapped}
+                continue
+            items.append(({**observation, "subject": {"reference": f"Patient/{patient_id}"}},
+                          ("Observation", source_id)))
+            positions.append(position)
+        if items:
+            for position, result in zip(positions, post_bundle(*build_batch_bundle(items), base_url)):
+                results[position] = result
+        yield from results
+
+
+def iter_records(source):
+    """
+        Cohort records (or Observations) from an NDJSON file, an artifact directory or stream
+        (see artifact_store.iter_source()).
+    """
+    return iter_source(source)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load cohort records into the Primary Care EHR with Bundles")
+    parser.add_argument("records", nargs="?",
+                        help="Cohort records (cohort.py), or Observations in observations mode: NDJSON file or "
+                             f"artifact stream (default: latest cohort or {OBSERVATION_STREAM} run)")
+    parser.add_argument("--mode", choices=["transaction", "batch", "observations"], default="transaction",
+                        help="transaction: one atomic Bundle per patient; batch: many patients per Bundle; "
+                             "observations: bulk_vitals.py Observations of loaded patients in batch Bundles")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Entries per batch Bundle")
+    parser.add_argument("--out", help="NDJSON file of per-entry results (default: data/bundle_load_results.ndjson)")
+    args = parser.parse_args()
+
+    print()
+    out_path = Path(args.out or data_dir / "bundle_load_results.ndjson")
+    records = iter_records(args.records or (OBSERVATION_STREAM if args.mode == "observations" else "cohort"))
+    if args.mode == "observations":
+        results = load_observations(records, batch_size=args.batch_size)
+    elif args.mode == "batch":
+        results = load_batches(records, batch_size=args.batch_size)
+    else:
+        results = load_transactions(records)
+    counts = {}
+    start = time.perf_counter()
+    with open(out_path, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+            if result["target_id"]:
+                key = (result["resourceType"], "ok")
+            else:
+                key = (result["resourceType"], "skipped" if result["status"] == "skipped" else "failed")
+            counts[key] = counts.get(key, 0) + 1
+    print(f"Loaded in {time.perf_counter() - start:.1f}s")
+    for (resource_type, outcome), count in sorted(counts.items()):
+        print(f"{resource_type} {outcome}: {count}")
+    print(f"Per-entry results saved to: {out_path}")
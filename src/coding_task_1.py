@@ -1,42 +1,24 @@
-import json
-import requests
+from src import http_client
 from pprint import pprint
-from pathlib import Path
-from src.registration import data_dir
-
-BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir" # OpenEMR FHIR server
-BASE_HERMES_URL = 'http://159.203.121.13:8080/v1/snomed' # Hermes terminology server
-PRIMARY_FHIR_URL = 'http://159.203.105.138:8080/fhir' # Primary care EHR FHIR server
-
-def get_access_token_from_file():
-    """
-        Read the OAuth access token from data/access_token.json.
-        Returns the access_token string, or None if the file is missing/invalid.
-    """
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
+from src.http_client import BASE_URL, PRIMARY_FHIR_URL
+from src.token_provider import get_token_provider
+from src.terminology_cache import search_constraint, first_concept
+from src.terminology_batch import load_lookup_table
+from src.paging import iter_search_resources, get_first_resource
+from src.compartment import fetch_patient_compartment
+from src.resource_templates import CONDITION_TEMPLATE, CONDITION_PROFILE_URL, PATIENT_PROFILE_URL
+from src.identity_map import conditional_create
+from src.artifact_store import save_artifact
+from src.patient_transform import (compile_patient_transform, deidentify_patient, SSN_SYSTEM_MARKER,
+                                   DEFAULT_DISTRICT)
 
 
 def get_headers():
     """
         Helper to build the Authorization headers for FHIR requests
-        using the access token read from file.
+        using the in-memory access token, which is refreshed before it expires.
     """
-    access_token = get_access_token_from_file()
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
+    return get_token_provider().get_headers()
 
 
 def get_fhir_resource(resource_name):
@@ -45,7 +27,7 @@ def get_fhir_resource(resource_name):
         from the OpenEMR FHIR server.
     """
     url = f'{BASE_URL}/{resource_name}'
-    response = requests.get(url=url, headers=get_headers())
+    response = http_client.get(url=url, headers=get_headers())
     print(response.url)
     pprint(response.json())
 
@@ -56,7 +38,7 @@ def get_fhir_patient(resource_id):
         from the OpenEMR FHIR server by its id.
     """
     url = f'{BASE_URL}/Patient/{resource_id}'
-    response = requests.get(url=url, headers=get_headers())
+    response = http_client.cached_get(url=url, headers=get_headers())
     print(response.url)
     pprint(response.json())
 
@@ -65,46 +47,40 @@ def get_patient_gender_where_dob_greater_than(name, gender, birth_date):
     """
         Demonstrates a filtered FHIR search:
         GET /Patient?name={name}&gender={gender}&birthdate=gt{birth_date}
-        Prints each matching patient's id, gender, birthDate and full name.
+        Prints each matching patient's id, gender, birthDate and full name, across all result pages.
     """
     url = f'{BASE_URL}/Patient?name={name}&gender={gender}&birthdate=gt{birth_date}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
-    if 'entry' in data:
-        print(f"Number of entries: {len(data['entry'])}")
-        entry = data['entry']
-        for item in entry:
-            resource_id = item['resource']['id']
-            given_name = f"{item['resource']['name'][0]['given'][0]}"
-            family_name = f"{item['resource']['name'][0]['family']}"
-            print(f"{resource_id} - {item['resource']['gender']} - {item['resource']['birthDate']} - {given_name} {family_name}")
+    count = 0
+    for resource in iter_search_resources(url, headers=get_headers()):
+        count += 1
+        resource_id = resource['id']
+        given_name = f"{resource['name'][0]['given'][0]}"
+        family_name = f"{resource['name'][0]['family']}"
+        print(f"{resource_id} - {resource['gender']} - {resource['birthDate']} - {given_name} {family_name}")
+    if count:
+        print(f"Number of entries: {count}")
     else:
         print('No results found')
 
 def search_condition(patient_resource_id):
     """
-        List all Condition resources in OpenEMR for a given patient.
+        List all Condition resources in OpenEMR for a given patient, across all result pages.
         Prints resourceType, id, and SNOMED code for each Condition.
     """
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
-    if 'entry' in data:
-        print(f"Number of entries: {len(data['entry'])}")
+    count = 0
+    for resource in iter_search_resources(url, headers=get_headers()):
+        count += 1
+        resource_type = resource['resourceType']
+        resource_id = resource['id']
+        code = resource['code']['coding'][0]['code']
+        print(f'Resource type: {resource_type}')
+        print(f'Resource ID: {resource_id}')
+        print(f'Code: {code}')
+        print()
+    if count:
+        print(f"Number of entries: {count}")
         print()
-        entry = data.get('entry')
-        for item in entry:
-            resource_type = item['resource']['resourceType']
-            resource_id = item['resource']['id']
-            code = item['resource']['code']['coding'][0]['code']
-            display = item['resource']['code']['coding'][0]['display']
-            print(f'Resource type: {resource_type}')
-            print(f'Resource ID: {resource_id}')
-            print(f'Code: {code}')
-            print()
-
     else:
         print('No results found')
 
@@ -115,16 +91,12 @@ def get_one_condition(patient_resource_id):
        and print its type, id, SNOMED code.
    """
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
+    resource = get_first_resource(url, headers=get_headers())
 
-    if 'entry' in data:
-        entry = data['entry'][0]
-        resource_type = entry['resource']['resourceType']
-        resource_id = entry['resource']['id']
-        code = entry['resource']['code']['coding'][0]['code']
-        display = entry['resource']['code']['coding'][0]['display']
+    if resource is not None:
+        resource_type = resource['resourceType']
+        resource_id = resource['id']
+        code = resource['code']['coding'][0]['code']
         print()
         print("Selected condition for patient resource:")
         print(f'Resource type: {resource_type}')
@@ -141,30 +113,33 @@ def get_parent_for_code(patient_resource_id):
         Returns (parent_id, parent_term) if found, or None if no parent could be found.
     """
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
-    if 'entry' not in data or not data['entry']:
+    resource = get_first_resource(url, headers=get_headers())
+    if resource is None:
         print('No Condition resources found for this patient')
         return None, None
-    if 'entry' in data:
-        entry = data['entry'][0]
-        resource_type = entry['resource']['resourceType']
-        resource_id = entry['resource']['id']
-        code = entry['resource']['code']['coding'][0]['code']
-        display = entry['resource']['code']['coding'][0]['display']
-
-    # Use Hermes terminology server to get the parent SNOMED concept
-    snomed_url = f'{BASE_HERMES_URL}/search?constraint=>!{code}'
-    response = requests.get(url=snomed_url)
-    print(response.url)
-    if response.status_code != 200:
-        print(f"Hermes error: {response.status_code}")
+    return get_parent_for_condition(resource)
+
+def get_parent_for_condition(condition, lookup=None):
+    """
+        Query Hermes for the parent concept of an already fetched Condition's SNOMED code
+        (the one with the lowest id when the concept has several, see first_concept()).
+        `lookup` is an optional table from terminology_batch.resolve_codes(); codes it
+        has an answer for are answered without any I/O, the others go to search_constraint().
+        Returns (parent_id, parent_term) if found, or None if no parent could be found.
+    """
+    code = condition['code']['coding'][0]['code']
+
+    # Use Hermes terminology server (through the SNOMED hierarchy cache) to get the parent concept
+    # A table built without this operation, or where it failed for the code, has no answer
+    data = (lookup or {}).get(code, {}).get('parents')
+    if data is None:
+        data = search_constraint('>!', code)
+    if data is None:
         return None, None
-    data = response.json()
     if data:
-        parent_id = data[0].get('conceptId')
-        parent_term = data[0].get('preferredTerm')
+        parent = first_concept(data)
+        parent_id = parent.get('conceptId')
+        parent_term = parent.get('preferredTerm')
         print(f"Parent concept for selected condition: {code}")
         print(f'Parent concept ID: {parent_id}')
         print(f'Parent preferred term: {parent_term}')
@@ -174,59 +149,52 @@ def get_parent_for_code(patient_resource_id):
         print('No results found')
         return None
 
-PATIENT_PROFILE_URL = "http://example.org/StructureDefinition/my-patient-profile"
-def create_patient_resource(patient_resource_id):
+
+# Transform of create_patient_json_for_validation(), compiled once at import
+prepare_patient_for_validation = compile_patient_transform(
+    drop_fields=("extension",),
+    drop_identifier_systems=(SSN_SYSTEM_MARKER,),
+    default_district=DEFAULT_DISTRICT,
+    rebuild_address_text=True,
+    profile=PATIENT_PROFILE_URL,
+)
+
+
+def clean_patient_resource(data):
+    """
+    Prepare a source Patient for loading: remove ids/SSN/extension and fix address text/district
+    on every address (see patient_transform.DEIDENTIFY_RULES).
+    Modifies the Patient dict in place and returns it.
+    """
+    return deidentify_patient(data)
+
+def create_patient_resource(patient_resource_id, source_patient=None):
     """
     Fetch Patient from OpenEMR, remove ids/SSN/extension, fix address text/district,
     and POST a new Patient to the Primary Care EHR.
+    Pass source_patient (e.g. from the patient compartment) to skip the OpenEMR GET.
+    The Patient is created at most once per OpenEMR id: a patient already in the identity map
+    is not sent again, and the POST is conditional (If-None-Exist) on its OpenEMR identifier.
     Returns created_patient(): The Patient resource as created on PRIMARY_FHIR_URL.
     """
-    url = f'{BASE_URL}/Patient/{patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
+    if source_patient is None:
+        url = f'{BASE_URL}/Patient/{patient_resource_id}'
+        response = http_client.cached_get(url=url, headers=get_headers())
+        print(response.url)
+        data = response.json()
+    else:
+        data = source_patient
     print()
     print("Source Patient from OpenEMR:")
     # pprint(data)
     print()
-
-    # Removing id and meta for the server to add one
-    data.pop('id', None)
-    data.pop('meta', None)
-    data.pop("extension", None)
-
-    # remove SSN identifier if present
-    identifiers = data.get("identifier", [])
-    for i, ident in enumerate(list(identifiers)):
-        if "us-ssn" in ident.get("system", ""):
-            identifiers.pop(i)
-            break
-    data["identifier"] = identifiers
-
-    # fix address - district
-    if "address" in data and data["address"]:
-        address = data["address"][0]
-
-        # set district to "Not found" if missing/blank
-        if "district" not in address or not address["district"]:
-            address["district"] = "Not found"
-
-        line = (address.get("line") or [""])[0]
-        city = address.get("city", "")
-        district = address.get("district", "")
-        state = address.get("state", "")
-        postal = address.get("postalCode", "")
-
-        address["text"] = f"{line} {city}, {district}, {state} {postal}".strip()
+    source_id = patient_resource_id or data.get('id')
+    data = clean_patient_resource(data)
 
     #POST
-    fhir_url = f'{PRIMARY_FHIR_URL}/Patient'
-    headers = {'Content-Type': 'application/fhir+json'}
-    print(f'POST {fhir_url}')
-    create_response = requests.post(url=fhir_url, headers=headers, json=data)
-    print(create_response.url)
-
-    created_patient = create_response.json()
+    created_patient = conditional_create(data, source_id=source_id)
+    if created_patient is None:
+        raise RuntimeError(f"Could not create the Patient of {source_id}")
     print()
     print("Created Patient resource on primary care EHR:")
     print(created_patient)
@@ -234,103 +202,26 @@ def create_patient_resource(patient_resource_id):
 
     return created_patient
 
-CONDITION_PROFILE_URL = "http://example.org/StructureDefinition/my-condition-profile"
-def create_condition_resource(primary_patient_id, parent_id, parent_term):
+def create_condition_resource(primary_patient_id, parent_id, parent_term, source_condition_id):
     """
     Build a Condition resource using the SNOMED parent concept and
     create it on the Primary Care EHR linked to the primary_patient_id.
     Adds clinicalStatus, verificationStatus, category, severity, bodySite, and onsetDateTime.
+    The write is keyed on the source OpenEMR Condition, so running the task again updates
+    the same parent Condition instead of adding another one.
     """
-    condition_resource = {
-        "resourceType": "Condition",
-        "text": {
-            "status": "generated",
-            "div": (
-                '<div xmlns="http://www.w3.org/1999/xhtml">'
-                f"<p>{parent_term}</p>"
-                "</div>"
-            )
-        },
-        "clinicalStatus": {
-            "coding": [
-                {
-                    "system": "http://terminology.hl7.org/CodeSystem/condition-clinical",
-                    "code": "active",
-                    'display': 'Active'
-                }
-            ]
-        },
-        "verificationStatus": {
-            "coding": [
-                {
-                    "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status",
-                    "code": "confirmed",
-                    "display": "Confirmed"
-                }
-            ]
-        },
-        "category": [
-            {
-                "coding": [
-                    {
-                        "system": "http://terminology.hl7.org/CodeSystem/condition-category",
-                        "code": "encounter-diagnosis",
-                        "display": "Encounter Diagnosis"
-                    }
-                ]
-            }
-        ],
-        "code": {
-            "coding": [
-                {
-                    "system": "http://snomed.info/sct",
-                    "code": parent_id,
-                    "display": parent_term
-                }
-            ],
-            "text": parent_term
-        },
-        "severity": {
-            "coding": [
-                {
-                    "system": "http://snomed.info/sct",
-                    "code": "24484000",
-                    "display": "Severe"
-                }
-            ],
-            "text": "Severe"
-        },
-        "bodySite": [
-            {
-                "coding": [
-                    {
-                        "system": "http://snomed.info/sct",
-                        "code": "34508005",
-                        "display": "Structure of mucous membrane of nose"
-                    }
-                ],
-                "text": "Mucous membrane of nose"
-            }
-        ],
-        "onsetDateTime": "2012-05-24",
-        "subject": {
-            "reference": f"Patient/{primary_patient_id}"
-        }
-    }
-    # POST
-    fhir_url = f'{PRIMARY_FHIR_URL}/Condition'
-    headers = {'Content-Type': 'application/fhir+json'}
-    print(f'POST {fhir_url}')
-    response = requests.post(url=fhir_url, headers=headers, json=condition_resource)
-    print(response.url)
-
-    created_condition = response.json()
+    condition_resource = CONDITION_TEMPLATE.build(patient_id=primary_patient_id, code=parent_id,
+                                                  display=parent_term, onset="2012-05-24")
+    # POST (or PUT when the source Condition was loaded before)
+    created_condition = conditional_create(condition_resource, source_id=f"{source_condition_id}:parent")
+    if created_condition is None:
+        raise RuntimeError(f"Could not create the parent Condition of {source_condition_id}")
     print()
     print("Created Condition resource on primary care EHR:")
     resource_type = created_condition.get('resourceType')
     resource_id = created_condition.get('id')
-    code = created_condition['code']['coding'][0]['code']
-    display = created_condition['code']['coding'][0]['display']
+    code = condition_resource['code']['coding'][0]['code']
+    display = condition_resource['code']['coding'][0]['display']
     print(f'Resource type: {resource_type}')
     print(f'Resource ID: {resource_id}')
     print(f'Code: {code}')
@@ -341,58 +232,29 @@ def create_condition_resource(primary_patient_id, parent_id, parent_term):
 def create_patient_json_for_validation(primary_patient_id):
     """
         Reads the Patient from the Primary Care EHR, attaches the profile URL, removes SSN identifier,
-        fixes address.text/district, and saves it to patient.json for validation.
+        fixes address.text/district, and appends it to the Patient artifact stream for validation.
     """
     url = f'{PRIMARY_FHIR_URL}/Patient/{primary_patient_id}'
-    response = requests.get(url=url)
+    response = http_client.get(url=url)
     print(url)
     data = response.json()
 
-    # Add profile URL into meta.profile
-    meta = data.get("meta", {})
-    meta["profile"] = [PATIENT_PROFILE_URL]
-    data["meta"] = meta
+    # Attach the profile, remove extension and SSN identifiers, fix address text/district
+    data = prepare_patient_for_validation(data)
 
-    # Remove extension
-    data.pop("extension", None)
-
-    # Remove SSN identifier if present
-    identifiers = data.get("identifier", [])
-    for i, ident in enumerate(list(identifiers)):
-        if "us-ssn" in ident.get("system", ""):
-            identifiers.pop(i)
-            break
-    data["identifier"] = identifiers
-
-    # Ensure address text and district are set correctly
-    if "address" in data and data["address"]:
-        address = data["address"][0]
-        # district, if missing
-        if "district" not in address:
-            address["district"] = "Not found"
-
-        line = (address.get("line") or [""])[0]
-        city = address.get("city", "")
-        district = address.get("district", "")
-        state = address.get("state", "")
-        postal = address.get("postalCode", "")
-
-        address["text"] = f"{line} {city}, {district}, {state} {postal}".strip()
-
-        # Save final JSON for validation
-        with open(data_dir / "patient.json", "w") as f:
-            json.dump(data, f, indent=2)
-
-        print("Created patient.json for validation")
-        print()
+    # Save final JSON for validation
+    path = save_artifact(data)
+
+    print(f"Saved Patient for validation to {path}")
+    print()
 
 def create_condition_json_for_validation(primary_condition_id):
     """
         Reads the Condition from the Primary Care EHR, attaches the profile URL,
-        normalizes category, and saves it to parent_condition.json for validation.
+        normalizes category, and appends it to the parent_condition artifact stream for validation.
     """
     url = f'{PRIMARY_FHIR_URL}/Condition/{primary_condition_id}'
-    response = requests.get(url=url)
+    response = http_client.get(url=url)
     print(url)
     data = response.json()
 
@@ -428,32 +290,43 @@ def create_condition_json_for_validation(primary_condition_id):
                 "coding": [category_coding]
             }
         ]
-    with open(data_dir / "parent_condition.json", "w") as f:
-        json.dump(data, f, indent=2)
+    path = save_artifact(data, stream="parent_condition")
 
-    print("Created parent_condition.json for validation")
+    print(f"Saved parent Condition for validation to {path}")
     print()
 
 
 if __name__ == '__main__':
     print()
+    # Repeated GETs within this run are answered from memory
+    http_client.start_run()
     # 1. Demonstrate filtered patient search on OpenEMR
     get_patient_gender_where_dob_greater_than(name = 'James', gender = 'male', birth_date='2000-01-01')
-    # 2. Inspect patient and condition from OpenEMR
-    get_fhir_patient(resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    search_condition(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    get_one_condition(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    # 3. Get parent SNOMED concept from Hermes
-    get_parent_for_code(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
+    # 2. Pull the patient and its Conditions from OpenEMR in a single search
+    compartment = fetch_patient_compartment(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914',
+                                            headers=get_headers())
+    pprint(compartment['Patient'])
+    print(f"Number of Conditions: {len(compartment['Condition'])}")
+    # 3. Pick the parent SNOMED concept of the first Condition; a cohort-wide lookup table
+    # (python -m src.terminology_batch) avoids the Hermes round trip
+    if compartment['Condition']:
+        first_condition = compartment['Condition'][0]
+        source_condition_id = first_condition['id']
+        parent_id, parent_term = get_parent_for_condition(first_condition, lookup=load_lookup_table())
+    else:
+        print('No Condition resources found for this patient')
+        source_condition_id, parent_id, parent_term = None, None, None
     # 4. Create Patient resource on Primary Care EHR
-    patient_resource = create_patient_resource(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
+    patient_resource = create_patient_resource(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914',
+                                               source_patient=compartment['Patient'])
+    # The OpenEMR -> Primary Care EHR id is kept in the identity map for Tasks 2-4
     primary_patient_id = patient_resource.get('id')
-    with open(data_dir / "primary_patient_id.txt", "w") as f:
-        f.write(str(primary_patient_id))
-    parent_id, parent_term = get_parent_for_code(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
     # 5. Create Condition resource on Primary Care EHR
-    condition_resource = create_condition_resource(primary_patient_id=primary_patient_id, parent_id=parent_id, parent_term=parent_term)
+    condition_resource = create_condition_resource(primary_patient_id=primary_patient_id, parent_id=parent_id,
+                                                   parent_term=parent_term,
+                                                   source_condition_id=source_condition_id)
     primary_condition_id = condition_resource.get('id')
     # 6. Create JSON files for validation
     create_patient_json_for_validation(primary_patient_id)
-    create_condition_json_for_validation(primary_condition_id)
\ No newline at end of file
+    create_condition_json_for_validation(primary_condition_id)
+    http_client.end_run()
@@ -1,42 +1,22 @@
-import json
-import requests
+from src import http_client
 from pprint import pprint
-from pathlib import Path
-from src.registration import data_dir
-
-BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir" # OpenEMR FHIR server
-BASE_HERMES_URL = 'http://159.203.121.13:8080/v1/snomed' # Hermes terminology server
-PRIMARY_FHIR_URL = 'http://159.203.105.138:8080/fhir' # Primary care EHR FHIR server
-
-def get_access_token_from_file():
-    """
-    Read the OAuth access token from data/access_token.json.
-    Returns the access_token string, or None if the file is missing/invalid.
-    """
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
+from src.http_client import BASE_URL, PRIMARY_FHIR_URL
+from src.token_provider import get_token_provider
+from src.terminology_cache import search_constraint, first_concept
+from src.terminology_batch import load_lookup_table
+from src.paging import iter_search_resources, get_first_resource
+from src.compartment import fetch_patient_compartment
+from src.identity_map import load_primary_patient_id, conditional_create
+from src.artifact_store import save_artifact
+from src.resource_templates import CONDITION_TEMPLATE, CONDITION_PROFILE_URL
 
 
 def get_headers():
     """
     Helper to build the Authorization headers for FHIR requests
-    using the access token read from file.
+    using the in-memory access token, which is refreshed before it expires.
     """
-    access_token = get_access_token_from_file()
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
+    return get_token_provider().get_headers()
 
 
 def get_fhir_resource(resource_name):
@@ -45,7 +25,7 @@ def get_fhir_resource(resource_name):
     from the OpenEMR FHIR server.
     """
     url = f'{BASE_URL}/{resource_name}'
-    response = requests.get(url=url, headers=get_headers())
+    response = http_client.get(url=url, headers=get_headers())
     print(response.url)
     pprint(response.json())
 
@@ -56,33 +36,29 @@ def get_fhir_patient(resource_id):
         from the OpenEMR FHIR server by its id.
     """
     url = f'{BASE_URL}/Patient/{resource_id}'
-    response = requests.get(url=url, headers=get_headers())
+    response = http_client.cached_get(url=url, headers=get_headers())
     print(response.url)
     pprint(response.json())
 
 def search_condition(patient_resource_id):
     """
-        List all Condition resources in OpenEMR for a given patient.
+        List all Condition resources in OpenEMR for a given patient, across all result pages.
         Prints resourceType, Condition id, and SNOMED code for each entry.
     """
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
-    if 'entry' in data:
-        print(f"Number of entries: {len(data['entry'])}")
+    count = 0
+    for resource in iter_search_resources(url, headers=get_headers()):
+        count += 1
+        resource_type = resource['resourceType']
+        resource_id = resource['id']
+        code = resource['code']['coding'][0]['code']
+        print(f'Resource type: {resource_type}')
+        print(f'Resource ID: {resource_id}')
+        print(f'Code: {code}')
+        print()
+    if count:
+        print(f"Number of entries: {count}")
         print()
-        entry = data.get('entry')
-        for item in entry:
-            resource_type = item['resource']['resourceType']
-            resource_id = item['resource']['id']
-            code = item['resource']['code']['coding'][0]['code']
-            display = item['resource']['code']['coding'][0]['display']
-            print(f'Resource type: {resource_type}')
-            print(f'Resource ID: {resource_id}')
-            print(f'Code: {code}')
-            print()
-
     else:
         print('No results found')
 
@@ -93,16 +69,12 @@ def get_one_condition(patient_resource_id):
         and print its type, id, SNOMED code.
     """
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
+    resource = get_first_resource(url, headers=get_headers())
 
-    if 'entry' in data:
-        entry = data['entry'][0]
-        resource_type = entry['resource']['resourceType']
-        resource_id = entry['resource']['id']
-        code = entry['resource']['code']['coding'][0]['code']
-        display = entry['resource']['code']['coding'][0]['display']
+    if resource is not None:
+        resource_type = resource['resourceType']
+        resource_id = resource['id']
+        code = resource['code']['coding'][0]['code']
         print()
         print("Selected condition for patient resource:")
         print(f'Resource type: {resource_type}')
@@ -122,27 +94,31 @@ def get_child_for_code(patient_resource_id):
     """
     # Get the base Condition from OpenEMR
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
-    if 'entry' in data:
-        entry = data['entry'][0]
-        resource_type = entry['resource']['resourceType']
-        resource_id = entry['resource']['id']
-        code = entry['resource']['code']['coding'][0]['code']
-        display = entry['resource']['code']['coding'][0]['display']
-    else:
+    resource = get_first_resource(url, headers=get_headers())
+    if resource is None:
         print('No Condition resources found for this patient')
         return None, None
+    return get_child_for_condition(resource)
 
-    # Use Hermes terminology server to get a child SNOMED concept
-    snomed_url = f'{BASE_HERMES_URL}/search?constraint=<!{code}'
-    response = requests.get(url=snomed_url)
-    print(response.url)
-    data = response.json()
+def get_child_for_condition(condition, lookup=None):
+    """
+        Query Hermes for a child concept of an already fetched Condition's SNOMED code
+        (the one with the lowest id, see first_concept()).
+        `lookup` is an optional table from terminology_batch.resolve_codes(); codes it
+        has an answer for are answered without any I/O, the others go to search_constraint().
+        Returns (child_id, child_term) if found, or (None, None) otherwise.
+    """
+    code = condition['code']['coding'][0]['code']
+
+    # Use Hermes terminology server (through the SNOMED hierarchy cache) to get a child concept
+    # A table built without this operation, or where it failed for the code, has no answer
+    data = (lookup or {}).get(code, {}).get('children')
+    if data is None:
+        data = search_constraint('<!', code)
     if data:
-        child_id = data[0].get('conceptId')
-        child_term = data[0].get('preferredTerm')
+        child = first_concept(data)
+        child_id = child.get('conceptId')
+        child_term = child.get('preferredTerm')
         print(f"Child concept for selected condition: {code}")
         print(f'Child concept ID: {child_id}')
         print(f'Child preferred term: {child_term}')
@@ -152,104 +128,26 @@ def get_child_for_code(patient_resource_id):
         print('No results found')
         return None, None
 
-CONDITION_PROFILE_URL = "http://example.org/StructureDefinition/my-condition-profile"
-def create_condition_resource(primary_patient_id, child_id, child_term):
+def create_condition_resource(primary_patient_id, child_id, child_term, source_condition_id):
     """
         Build a Condition resource using the child SNOMED concept returned from Hermes
         and create it on the Primary Care EHR linked to the primary_patient_id.
+        The write is keyed on the source OpenEMR Condition, so running the task again updates
+        the same child Condition instead of adding another one.
     """
-    condition_resource = {
-        "resourceType": "Condition",
-        "text": {
-            "status": "generated",
-            "div": (
-                '<div xmlns="http://www.w3.org/1999/xhtml">'
-                f"<p>{child_term}</p>"
-                "</div>"
-            )
-        },
-        "clinicalStatus": {
-            "coding": [
-                {
-                    "system": "http://terminology.hl7.org/CodeSystem/condition-clinical",
-                    "code": "active",
-                    "display": "Active"
-                }
-            ]
-        },
-        "verificationStatus": {
-            "coding": [
-                {
-                    "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status",
-                    "code": "confirmed",
-                    "display": "Confirmed"
-                }
-            ]
-        },
-        "category": [
-            {
-                "coding": [
-                    {
-                        "system": "http://terminology.hl7.org/CodeSystem/condition-category",
-                        "code": "encounter-diagnosis",
-                        "display": "Encounter Diagnosis"
-                    }
-                ]
-            }
-        ],
-        "code": {
-            "coding": [
-                {
-                    "system": "http://snomed.info/sct",
-                    "code": child_id,
-                    "display": child_term
-                }
-            ],
-            "text": child_term
-        },
-        "severity": {
-            "coding": [
-                {
-                    "system": "http://snomed.info/sct",
-                    "code": "24484000",
-                    "display": "Severe"
-                }
-            ],
-            "text": "Severe"
-        },
-        "bodySite": [
-            {
-                "coding": [
-                    {
-                        "system": "http://snomed.info/sct",
-                        "code": "34508005",
-                        "display": "Structure of mucous membrane of nose"
-                    }
-                ],
-                "text": "Mucous membrane of nose"
-            }
-        ],
-        "onsetDateTime": "2014-06-01",
-
-        "subject": {
-            "reference": f"Patient/{primary_patient_id}"
-        }
-    }
-
-    # POST new Condition to the Primary Care EHR
-    fhir_url = f'{PRIMARY_FHIR_URL}/Condition'
-    headers = {'Content-Type': 'application/json'}
-    print(f'POST {fhir_url}')
-    response = requests.post(url=fhir_url, headers=headers, json=condition_resource)
-    print(response.url)
+    condition_resource = CONDITION_TEMPLATE.build(patient_id=primary_patient_id, code=child_id,
+                                                  display=child_term, onset="2014-06-01")
 
-    created_condition = response.json()
+    # POST new Condition to the Primary Care EHR (or PUT when it was loaded before)
+    created_condition = conditional_create(condition_resource, source_id=f"{source_condition_id}:child")
+    if created_condition is None:
+        raise RuntimeError(f"Could not create the child Condition of {source_condition_id}")
     print()
     print("Created Condition resource on primary care EHR:")
     resource_type = created_condition.get('resourceType')
     resource_id = created_condition.get('id')
-    code = created_condition['code']['coding'][0]['code']
-    display = created_condition['code']['coding'][0]['display']
+    code = condition_resource['code']['coding'][0]['code']
+    display = condition_resource['code']['coding'][0]['display']
     print(f'Resource type: {resource_type}')
     print(f'Resource ID: {resource_id}')
     print(f'Code: {code}')
@@ -260,10 +158,10 @@ def create_condition_resource(primary_patient_id, child_id, child_term):
 def create_condition_json_for_validation(primary_condition_id):
     """
         Read the child Condition from Primary Care EHR, attach the profile URL,
-        and write it to child_condition.json for validation.
+        and append it to the child_condition artifact stream for validation.
     """
     url = f'{PRIMARY_FHIR_URL}/Condition/{primary_condition_id}'
-    response = requests.get(url=url)
+    response = http_client.get(url=url)
     print(url)
     data = response.json()
 
@@ -301,28 +199,37 @@ def create_condition_json_for_validation(primary_condition_id):
         ]
 
     # Save final JSON for validation
-    with open(data_dir / "child_condition.json", "w") as f:
-        json.dump(data, f, indent=2)
+    path = save_artifact(data, stream="child_condition")
 
-    print("Created child_condition.json for validation")
+    print(f"Saved child Condition for validation to {path}")
     print()
 
 
 if __name__ == '__main__':
     print()
-    # 1. Show the source patient in OpenEMR
-    get_fhir_patient(resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    # 2. Inspect all Conditions on OpenEMR for this patient
-    search_condition(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    get_one_condition(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    # 3. Get child SNOMED concept from Hermes based on patient's Condition
-    get_child_for_code(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    child_id, child_term = get_child_for_code(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
-    # 4. Read the primary_patient_id that was created in Task 1
-    with open(data_dir / "primary_patient_id.txt", "r") as f:
-        primary_patient_id = f.read().strip()
-    # 5. Create child Condition resource on Primary Care EHR
-    condition_resource = create_condition_resource(primary_patient_id=primary_patient_id, child_id=child_id, child_term=child_term)
+    # Repeated GETs within this run are answered from memory
+    http_client.start_run()
+    # 1. Pull the source patient and its Conditions from OpenEMR in a single search
+    compartment = fetch_patient_compartment(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914',
+                                            headers=get_headers())
+    pprint(compartment['Patient'])
+    print(f"Number of Conditions: {len(compartment['Condition'])}")
+    # 2. Pick a child SNOMED concept of the first Condition; a cohort-wide lookup table
+    # (python -m src.terminology_batch) avoids the Hermes round trip
+    if compartment['Condition']:
+        first_condition = compartment['Condition'][0]
+        source_condition_id = first_condition['id']
+        child_id, child_term = get_child_for_condition(first_condition, lookup=load_lookup_table())
+    else:
+        print('No Condition resources found for this patient')
+        source_condition_id, child_id, child_term = None, None, None
+    # 3. Look up the primary_patient_id that was created in Task 1
+    primary_patient_id = load_primary_patient_id('9d036484-c661-485c-899d-fcab43d40914')
+    # 4. Create child Condition resource on Primary Care EHR
+    condition_resource = create_condition_resource(primary_patient_id=primary_patient_id, child_id=child_id,
+                                                   child_term=child_term,
+                                                   source_condition_id=source_condition_id)
     primary_condition_id = condition_resource.get('id')
-    # 6. Export child_condition.json for validation
-    create_condition_json_for_validation(primary_condition_id)
\ No newline at end of file
+    # 5. Export child_condition.json for validation
+    create_condition_json_for_validation(primary_condition_id)
+    http_client.end_run()
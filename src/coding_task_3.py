@@ -1,220 +1,76 @@
-import json
-import requests
+from src import http_client, write_scheduler
 from pprint import pprint
-from pathlib import Path
 from src.registration import data_dir
-
-BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir" # OpenEMR FHIR server
-BASE_HERMES_URL = 'http://159.203.121.13:8080/v1/snomed' # Hermes terminology server
-PRIMARY_FHIR_URL = 'http://159.203.105.138:8080/fhir' # Primary care EHR FHIR server
-
-
-def get_access_token_from_file():
-    """
-        Read the OAuth access token from data/access_token.json.
-        Returns the access_token string, or None if the file is missing/invalid.
-    """
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
+from src.http_client import BASE_URL, PRIMARY_FHIR_URL
+from src.token_provider import get_token_provider
+from src.paging import iter_search_resources
+from src.identity_map import load_primary_patient_id, if_none_exist
+from src.artifact_store import save_artifact
+from src.resource_templates import build_blood_pressure
+from src.bulk_vitals import observation_identifier
 
 
 def get_headers():
     """
         Helper to build the Authorization headers for FHIR requests
-        using the access token read from file.
+        using the in-memory access token, which is refreshed before it expires.
     """
-    access_token = get_access_token_from_file()
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
-
-def load_patient_id_from_file():
-    """
-        Load the PRIMARY EHR patient id (created in Task 1) from
-        primary_patient_id.txt so we can attach the Observation to that patient.
-    """
-    try:
-        with open(data_dir / "primary_patient_id.txt", "r") as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        print("Error: patient_id.txt not found.")
-        return None
+    return get_token_provider().get_headers()
 
 def search_observation(patient_resource_id):
     """
         Check OpenEMR for any existing blood pressure Observations for the patient,
-        using LOINC 85354-9 (Blood pressure panel).
+        using LOINC 85354-9 (Blood pressure panel). Follows every page of the search.
         Returns the first Observation resource () if found, otherwise None.
     """
     url = f'{BASE_URL}/Observation?patient={patient_resource_id}&code=http://loinc.org|85354-9'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    if response.status_code == 200:
-        data = response.json()
-
-        if 'entry' in data:
-            print(f"Number of entries: {len(data['entry'])}")
-            print()
-            entry = data.get('entry')
-            for item in entry:
-                pprint(item)
-                resource_type = item['resource']['resourceType']
-                resource_id = item['resource']['id']
-                print(f'Resource type: {resource_type}')
-                print(f'Resource ID: {resource_id}')
-            # Return the first Observation resource
-            return entry[0]['resource']
-        else:
-            print('No Condition resource found')
-            return None
+    first_observation = None
+    count = 0
+    for resource in iter_search_resources(url, headers=get_headers()):
+        count += 1
+        pprint(resource)
+        resource_type = resource['resourceType']
+        resource_id = resource['id']
+        print(f'Resource type: {resource_type}')
+        print(f'Resource ID: {resource_id}')
+        if first_observation is None:
+            first_observation = resource
+    if count:
+        print(f"Number of entries: {count}")
+        print()
     else:
-        print(f"Error when trying to access data: {response.status_code}")
-        try:
-            print(f'Error: {response.json()}')
-        except ValueError:
-            print(f"Error body is not JSON")
-        return None
+        print('No Observation resource found')
+    # Return the first Observation resource
+    return first_observation
 
-def create_observation(patient_id):
+def create_observation(patient_id, effective="2025-11-27", systolic=120, diastolic=80):
     """
        Create a blood pressure Observation JSON for the given PRIMARY EHR patient id.
+       Its identifier is derived from the patient and the reading time (as in bulk_vitals.py),
+       so the same reading always gets the same identifier and other readings never share it.
     """
-    observation = {
-        "resourceType": "Observation",
-        "meta": {
-            "profile": ["http://hl7.org/fhir/StructureDefinition/vitalsigns"]
-        },
-        "identifier": [
-            {
-                "system": "urn:ietf:rfc:3986",
-                "value": "urn:uuid:187e0c12-8dd2-67e2-99b2-bf273c878281"
-            }
-        ],
-        "status": "final",
-        "category": [{
-            "coding": [{
-                "system": "http://terminology.hl7.org/CodeSystem/observation-category",
-                "code": "vital-signs",
-                "display": "Vital Signs"
-            }]
-        }],
-        "code": {
-            "coding": [{
-                "system": "http://loinc.org",
-                "code": "85354-9",
-                "display": "Blood pressure panel with all children optional"
-            }],
-            "text": "Blood pressure systolic & diastolic"
-        },
-        "subject": {
-            "reference": f"Patient/{patient_id}"
-        },
-        "performer": [
-            {
-                "reference": "Practitioner/8",
-                "display": "Dr. Careful"
-            }
-        ],
-        "effectiveDateTime": "2025-11-27",
-        "interpretation": [{
-            "coding": [{
-                "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation",
-                "code": "N",
-                "display": "Normal"
-            }],
-            "text": "Normal"
-        }],
-        "bodySite": {
-            "coding": [{
-                "system": "http://snomed.info/sct",
-                "code": "368209003",
-                "display": "Right arm"
-            }]
-        },
-        "component": [{
-            "code": {
-                "coding": [{
-                    "system": "http://loinc.org",
-                    "code": "8480-6",
-                    "display": "Systolic blood pressure"
-                },
-                    {
-                        "system": "http://snomed.info/sct",
-                        "code": "271649006",
-                        "display": "Systolic blood pressure"
-                    }]
-            },
-            "valueQuantity": {
-                "value": 120,
-                "unit": "mmHg",
-                "system": "http://unitsofmeasure.org",
-                "code": "mm[Hg]"
-            },
-            "interpretation": [{
-                "coding": [{
-                    "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation",
-                    "code": "N",
-                    "display": "normal"
-                }],
-                "text": "Normal"
-            }]
-        },
-            {
-                "code": {
-                    "coding": [{
-                        "system": "http://loinc.org",
-                        "code": "8462-4",
-                        "display": "Diastolic blood pressure"
-                    },
-                        {
-                            "system": "http://snomed.info/sct",
-                            "code": "271650006",
-                            "display": "Diastolic blood pressure"
-                        }
-                    ]
-                },
-                "valueQuantity": {
-                    "value": 80,
-                    "unit": "mmHg",
-                    "system": "http://unitsofmeasure.org",
-                    "code": "mm[Hg]"
-                },
-                "interpretation": [{
-                    "coding": [{
-                        "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation",
-                        "code": "N",
-                        "display": "normal"
-                    }],
-                    "text": "Normal"
-                }]
-            }]
-    }
+    observation = build_blood_pressure(patient_id=patient_id, identifier=observation_identifier(patient_id, effective),
+                                       effective=effective, systolic=systolic, diastolic=diastolic)
     # Save a copy for validation
-    with open(data_dir / "observation.json", "w") as f:
-        json.dump(observation, f, indent=2)
+    save_artifact(observation)
     return observation
 
 def post_observation_to_primary_fhir(observation):
     """
         POST the Observation resource to the Primary Care EHR FHIR server.
         Also prints and saves the created Observation id to observation_id.txt.
+        The create is conditional on the Observation's identifier, so posting the same reading
+        again returns the existing Observation instead of a duplicate.
     """
     fhir_url = f'{PRIMARY_FHIR_URL}/Observation'
     headers = {'Content-Type': 'application/fhir+json'}
+    if observation.get('identifier'):
+        headers['If-None-Exist'] = if_none_exist(observation['identifier'][0])
     print(f'POST {fhir_url}')
-    response = requests.post(url=fhir_url, headers=headers, json=observation)
+    response = write_scheduler.post(url=fhir_url, headers=headers, json=observation)
     print(response.url)
+    if response.status_code not in (200, 201):
+        raise RuntimeError(f"Error creating Observation: {response.status_code} {response.text}")
 
     created_observation = response.json()
     print(created_observation)
@@ -235,11 +91,14 @@ def post_observation_to_primary_fhir(observation):
     return created_observation
 if __name__ == '__main__':
     print()
+    # Repeated GETs within this run are answered from memory
+    http_client.start_run()
     # 1. Load the Primary Care EHR patient id saved from Task 1
-    patient_id = load_patient_id_from_file()
+    patient_id = load_primary_patient_id('9d036484-c661-485c-899d-fcab43d40914')
     # 2. Check OpenEMR to see if a BP Observation already exists
     search_observation(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
     # 3. Create a new BP Observation for the primary_patient_id
     observation_resource = create_observation(patient_id=patient_id)
     # 4. POST the Observation to the Primary Care EHR server
     post_observation_to_primary_fhir(observation= observation_resource)
+    http_client.end_run()
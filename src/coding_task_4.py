@@ -1,87 +1,49 @@
-import json
-import requests
+import uuid
+from src import http_client, write_scheduler
 from pprint import pprint
-from pathlib import Path
 from src.registration import data_dir
+from src.http_client import BASE_URL, PRIMARY_FHIR_URL
+from src.token_provider import get_token_provider
+from src.paging import iter_search_resources
+from src.identity_map import load_primary_patient_id, if_none_exist
+from src.artifact_store import save_artifact
+from src.resource_templates import IMMUNOTHERAPY_PROCEDURE_TEMPLATE
 
-BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir" # OpenEMR FHIR server
-BASE_HERMES_URL = 'http://159.203.121.13:8080/v1/snomed' # Hermes terminology server
-PRIMARY_FHIR_URL = 'http://159.203.105.138:8080/fhir' # Primary care EHR FHIR server
+# Namespace of the deterministic (uuid5) Procedure identifiers: the same procedure always gets the same id
+PROCEDURE_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "http://example.org/fhir/procedures")
 
 
-def get_access_token_from_file():
-    """
-        Read the OAuth access token from data/access_token.json.
-        Returns the access_token string, or None if the file is missing/invalid.
-    """
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
+def procedure_identifier(patient_id, code, performed):
+    return f"urn:uuid:{uuid.uuid5(PROCEDURE_NAMESPACE, f'{patient_id}|{code}|{performed}')}"
 
 
 def get_headers():
     """
         Helper to build the Authorization headers for FHIR requests
-        using the access token read from file.
+        using the in-memory access token, which is refreshed before it expires.
     """
-    access_token = get_access_token_from_file()
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
-
-
-def load_patient_id_from_file():
-    """
-        Load the PRIMARY EHR patient id (created in Task 1) from
-        primary_patient_id.txt so we can attach the Observation to that patient.
-    """
-    try:
-        with open(data_dir / "primary_patient_id.txt", "r") as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        print("Error: patient_id.txt not found.")
-        return None
+    return get_token_provider().get_headers()
 
 
 def search_procedure(patient_resource_id):
     """
        Search OpenEMR for existing Procedure resources for the given OpenEMR patient id.
-       Prints any found Procedure resources.
+       Prints any found Procedure resources, across all result pages.
        """
     url = f'{BASE_URL}/Procedure?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    if response.status_code == 200:
-        data = response.json()
-        if 'entry' in data:
-            print(f"Number of entries: {len(data['entry'])}")
-            print()
-            entry = data.get('entry')
-            for item in entry:
-                pprint(item)
-                resource_type = item['resource']['resourceType']
-                resource_id = item['resource']['id']
-                print(f'Resource type: {resource_type}')
-                print(f'Resource ID: {resource_id}')
-        else:
-            print('No Procedure resource found')
+    count = 0
+    for resource in iter_search_resources(url, headers=get_headers()):
+        count += 1
+        pprint(resource)
+        resource_type = resource['resourceType']
+        resource_id = resource['id']
+        print(f'Resource type: {resource_type}')
+        print(f'Resource ID: {resource_id}')
+    if count:
+        print(f"Number of entries: {count}")
+        print()
     else:
-        print(f"Error when trying to access Procedure data: {response.status_code}")
-        try:
-            print("Error body:", response.json())
-        except ValueError:
-            print("No JSON body in error response.")
-        return None
+        print('No Procedure resource found')
 
 
 def create_procedure(patient_id):
@@ -89,62 +51,14 @@ def create_procedure(patient_id):
         Create a Procedure resource for the given PRIMARY EHR patient id.
         This procedure is linked to SNOMED code, subject, performer
         """
-    procedure = {
-        "resourceType": "Procedure",
-        "meta": {
-            "versionId": "1"
-        },
-        "text": {
-            "status": "generated",
-            "div": (
-                "<div xmlns=\"http://www.w3.org/1999/xhtml\">"
-                "Subcutaneous allergen immunotherapy for perennial allergic rhinitis"
-                "</div>"
-            )
-        },
-        "status": "completed",
-        "code": {
-            "coding": [
-                {
-                    "system": "http://snomed.info/sct",
-                    "code": "180256009",
-                    "display": "Subcutaneous immunotherapy"
-                }
-            ],
-            "text": "Subcutaneous immunotherapy"
-        },
-        "subject": {
-            "reference": f"Patient/{patient_id}"
-        },
-        "performedDateTime": "2008-09-04",
-        "performer": [
-            {
-                'actor': {
-                    "reference": "Practitioner/8",
-                    "display": "Dr. Careful"
-                }
-            }
-        ],
-        "reasonCode": [
-            {"concept": {
-                "text": "Perennial allergic rhinitis not controlled with medication"
-            }
-        }],
-        "followUp": [
-            {
-                "text": "Follow-up visit in 4 weeks"
-            }
-        ],
-        "note": [
-            {
-                "text": "First dose of maintenance allergen immunotherapy administered without complications."
-            }
-        ]
-    }
-
-    # Save Procedure JSON to file for validation
-    with open(data_dir / "procedure.json", "w") as f:
-        json.dump(procedure, f, indent=2)
+    performed = "2008-09-04"
+    procedure = IMMUNOTHERAPY_PROCEDURE_TEMPLATE.build(patient_id=patient_id, performed=performed)
+    code = procedure['code']['coding'][0]['code']
+    procedure['identifier'] = [{"system": "urn:ietf:rfc:3986",
+                                "value": procedure_identifier(patient_id, code, performed)}]
+
+    # Save Procedure to the artifact stream for validation
+    save_artifact(procedure)
     return procedure
 
 
@@ -152,12 +66,18 @@ def post_procedure_to_primary_fhir(procedure):
     """
         POST the Procedure resource to the Primary Care EHR FHIR server.
         Also prints and saves the created Procedure id to procedure_id.txt.
+        The create is conditional on the Procedure's identifier, so posting the same procedure
+        again returns the existing Procedure instead of a duplicate.
     """
     fhir_url = f'{PRIMARY_FHIR_URL}/Procedure'
     headers = {'Content-Type': 'application/fhir+json'}
+    if procedure.get('identifier'):
+        headers['If-None-Exist'] = if_none_exist(procedure['identifier'][0])
     print(f'POST {fhir_url}')
-    response = requests.post(url=fhir_url, headers=headers, json=procedure)
+    response = write_scheduler.post(url=fhir_url, headers=headers, json=procedure)
     print(response.url)
+    if response.status_code not in (200, 201):
+        raise RuntimeError(f"Error creating Procedure: {response.status_code} {response.text}")
 
     created_procedure = response.json()
     print(created_procedure)
@@ -179,11 +99,14 @@ def post_procedure_to_primary_fhir(procedure):
 
 if __name__ == '__main__':
     print()
+    # Repeated GETs within this run are answered from memory
+    http_client.start_run()
     # 1. Load primary_patient_id created in Task 1
-    patient_id = load_patient_id_from_file()
+    patient_id = load_primary_patient_id('9d036484-c661-485c-899d-fcab43d40914')
     # 2. Check OpenEMR for any existing Procedure resources for the original patient
     search_procedure(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914')
     # 3. Create a Procedure resource for the PRIMARY EHR patient
     procedure_resource = create_procedure(patient_id=patient_id)
     # 4. POST the Procedure to the Primary Care EHR FHIR server
     post_procedure_to_primary_fhir(procedure=procedure_resource)
+    http_client.end_run()
@@ -1,47 +1,24 @@
 import json
-from datetime import datetime
-from pathlib import Path
-import requests
+from src import http_client
 from hl7apy.core import Message
 from src.registration import data_dir
-
-BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir"  # OpenEMR FHIR server
-BASE_HERMES_URL = 'http://159.203.121.13:8080/v1/snomed'  # Hermes terminology server
-PRIMARY_FHIR_URL = 'http://159.203.105.138:8080/fhir'  # Primary care EHR FHIR server
+from src.http_client import BASE_URL, BASE_HERMES_URL
+from src.token_provider import get_token_provider
+from src.icd10_map_index import get_map_index, ICD10_MAP_REFSET_ID
+from src.terminology_batch import load_lookup_table
+from src.artifact_store import load_latest
+from src.er7_serializer import escape, render_adt_a01
 
 # Fixed OpenEMR Patient id used across tasks
 patient_resource_id = "9d036484-c661-485c-899d-fcab43d40914"
 
 
-def get_access_token_from_file():
-    """
-        Read the OAuth access token from data/access_token.json.
-        Returns the access_token string, or None if the file is missing/invalid.
-    """
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
-
-
 def get_headers():
     """
         Helper to build the Authorization headers for FHIR requests
-        using the access token read from file.
+        using the in-memory access token, which is refreshed before it expires.
     """
-    access_token = get_access_token_from_file()
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
+    return get_token_provider().get_headers()
 
 
 def get_fhir_patient(patient_resource_id: str) -> dict:
@@ -50,7 +27,7 @@ def get_fhir_patient(patient_resource_id: str) -> dict:
         Returns dict: Parsed Patient JSON from the FHIR server.
     """
     url = f'{BASE_URL}/Patient/{patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
+    response = http_client.cached_get(url=url, headers=get_headers())
     print("Patient URL:", response.url)
     data = response.json()
     print("Patient from OpenEMR:")
@@ -58,23 +35,38 @@ def get_fhir_patient(patient_resource_id: str) -> dict:
     return data
 
 
-def load_condition_json() -> dict:
+def load_condition() -> dict:
     """
-        Load the parent_condition.json file that was created in Task 1
-        Returns dict: Parsed Condition JSON.
+        Load the parent Condition saved by the latest Task 1 run, streamed from its artifact files.
+        Returns dict: Parsed Condition JSON, or None if Task 1 has not run.
     """
-    with open(data_dir / "parent_condition.json") as f:
-        condition_data = json.load(f)
+    condition_data = load_latest("parent_condition")
+    if condition_data is None:
+        print("Error: no parent_condition artifact found; run coding_task_1.py first.")
     return condition_data
 
 
-def map_snomed_to_icd10(snomed_code: str, snomed_term: str):
+def map_snomed_to_icd10(snomed_code: str, snomed_term: str, lookup: dict = None):
     """
-       Use the Hermes terminology server to map a SNOMED CT code to an ICD-10-CM code using the WHO map refset 447562003.
+       Map a SNOMED CT code to an ICD-10-CM code using the WHO map refset 447562003.
+       A lookup table from terminology_batch.resolve_codes() is used first, then the
+       local map index (icd10_map_index.py); Hermes is only called on a miss.
        Returns (icd10_code, icd10_term)
    """
-    url = f"{BASE_HERMES_URL}/concepts/{snomed_code}/map/447562003"
-    response = requests.get(url=url)
+    if lookup is not None and lookup.get(snomed_code, {}).get("icd10"):
+        icd10_code = lookup[snomed_code]["icd10"][0].get("mapTarget")
+        print(f'{icd10_code} is the mapped ICD-10 code for SNOMED {snomed_code} - {snomed_term} (lookup table)')
+        return icd10_code, snomed_term
+
+    index = get_map_index()
+    records = index.lookup(snomed_code) if index is not None else []
+    if records:
+        icd10_code = records[0]["mapTarget"]
+        print(f'{icd10_code} is the mapped ICD-10 code for SNOMED {snomed_code} - {snomed_term} (local map index)')
+        return icd10_code, snomed_term
+
+    url = f"{BASE_HERMES_URL}/concepts/{snomed_code}/map/{ICD10_MAP_REFSET_ID}"
+    response = http_client.get(url=url)
     try:
         data = response.json()
         print("Response JSON:", data)
@@ -94,11 +86,56 @@ def map_snomed_to_icd10(snomed_code: str, snomed_term: str):
     return icd10_code, icd10_term
 
 
-def create_adt_message(patient_data: dict, condition_data: dict, icd10_code: str, icd10_term: str) -> None:
+def pid_values(patient_data: dict) -> dict:
     """
-        Construct an HL7 v2 ADT^A01 message using:
-          - Patient data from OpenEMR FHIR Patient resource
-          - Condition data (SNOMED condition) from parent_condition.json
+        Raw (unescaped) PID values of an OpenEMR FHIR Patient resource: patient_id, family,
+        given, birthdate (YYYYMMDD), gender (M, F, O or U), line, city, state and postal.
+        Missing name, gender, birthDate or address elements give empty values.
+    """
+    name = (patient_data.get("name") or [{}])[0]
+    given_list = name.get("given", [""])
+    address = (patient_data.get("address") or [{}])[0]
+    return {
+        "patient_id": patient_data.get("id", ""),
+        "family": name.get("family", ""),
+        "given": given_list[0] if given_list else "",
+        "birthdate": patient_data.get("birthDate", "").replace("-", ""),
+        "gender": patient_data.get("gender", "")[:1].upper(),  # male/female/other/unknown -> M/F/O/U
+        "line": (address.get("line") or [""])[0],
+        "city": address.get("city", ""),
+        "state": address.get("state", ""),
+        "postal": address.get("postalCode", ""),
+    }
+
+
+def extract_pid_fields(patient_data: dict) -> dict:
+    """
+        PID fields from an OpenEMR FHIR Patient resource, ER7-ready:
+          - patient_id: PID-3
+          - name: PID-5, Family^Given
+          - birthdate: PID-7, YYYYMMDD
+          - gender: PID-8, M, F, O or U
+          - address: PID-11 (XAD), street^^city^state^zip^^H
+        Each component is HL7-escaped, so a "^" or "&" inside a name or address stays data.
+        patient_columns.PatientColumns.iter_pid_fields() produces the same dicts for a demographics file.
+    """
+    values = pid_values(patient_data)
+    return {
+        "patient_id": values["patient_id"],
+        "name": f"{escape(values['family'])}^{escape(values['given'])}",
+        "birthdate": values["birthdate"],
+        "gender": values["gender"],
+        "address": (f"{escape(values['line'])}^^{escape(values['city'])}^{escape(values['state'])}^"
+                    f"{escape(values['postal'])}^^H"),
+    }
+
+
+def build_adt_message(values: dict, condition_data: dict, icd10_code: str, icd10_term: str, timestamp: str,
+                      control_id: str) -> Message:
+    """
+        Construct an HL7 v2 ADT^A01 message with hl7apy using:
+          - raw PID values from pid_values(); hl7apy does the escaping
+          - Condition data (SNOMED condition) from the parent_condition artifacts
           - ICD-10 code mapped from Hermes terminology server
 
         Segments included:
@@ -106,54 +143,42 @@ def create_adt_message(patient_data: dict, condition_data: dict, icd10_code: str
           - PID: patient identification
           - PV1: patient visit (outpatient)
           - DG1: diagnosis (ICD-10 + SNOMED term)
-    """
-    # Basic patient demographics
-    patient_id = patient_data.get("id", "")
-
-    name = patient_data.get("name")[0]
-    family = name.get("family", "")
-    given_list = name.get("given", [""])
-    given = given_list[0] if given_list else ""
-    full_name = f"{family}^{given}"
-
-    gender = patient_data.get("gender", "").upper()[0]  # M or F
-    birthdate_raw = patient_data.get("birthDate", "")
-    birthdate = birthdate_raw.replace("-", "")
-
-    address = patient_data.get("address")[0]
-    line = address.get("line")[0]
-    city = address.get("city", "")
-    state = address.get("state", "")
-    postal = address.get("postalCode", "")
 
+        er7_serializer.render_adt_a01() writes the same ER7 directly from a template;
+        python -m src.adt_conformance checks that both agree.
+    """
     # SNOMED concept condition description
-    code = condition_data["code"]["coding"][0]
-    snomed_code = code["code"]
-    snomed_term = code["display"]
+    snomed_term = condition_data["code"]["coding"][0]["display"]
 
     # HL7 message
     msg = Message("ADT_A01")
 
     # MSH segment
-    now_ts = datetime.now().strftime("%Y%m%d%H%M%S")
-
     msg.msh.msh_3 = "MyApp"  # sending application
     msg.msh.msh_4 = "OpenEMR"  # sending facility
     msg.msh.msh_5 = "PrimaryCareEHR"  # receiving application
     msg.msh.msh_6 = "PrimaryFacility"  # receiving facility
-    msg.msh.msh_7 = now_ts  # message timestamp
+    msg.msh.msh_7 = timestamp  # message timestamp
     msg.msh.msh_9 = "ADT^A01"  # message type
-    msg.msh.msh_10 = "MSG00001"  # msg control id
+    msg.msh.msh_10 = control_id  # msg control id
     msg.msh.msh_11 = "P"  # Processing ID
     msg.msh.msh_12 = "2.5"  # version
 
-    # PID segment
+    # PID segment; values are assigned to the leaf (sub)components so hl7apy escapes them
     msg.pid.pid_1 = "1"
-    msg.pid.pid_3 = patient_id  # patient id
-    msg.pid.pid_5 = full_name  # Family^Given
-    msg.pid.pid_7 = birthdate  # YYYYMMDD
-    msg.pid.pid_8 = gender  # M/F
-    msg.pid.pid_11 = f"{line}^{city}^{state}^{postal}^^H"  # PID-11 - address: street^city^state^zip^^H
+    msg.pid.pid_3 = values["patient_id"]  # patient id
+    # PID-5: Family^Given; empty parts are left unset, as hl7apy would write their delimiters
+    if values["family"]:
+        msg.pid.pid_5.xpn_1.fn_1 = values["family"]
+    if values["given"]:
+        msg.pid.pid_5.xpn_2 = values["given"]
+    msg.pid.pid_7 = values["birthdate"]  # YYYYMMDD
+    msg.pid.pid_8 = values["gender"]  # M/F/O/U
+    msg.pid.pid_11.xad_1.sad_1 = values["line"]  # PID-11 - address: street^^city^state^zip^^H
+    msg.pid.pid_11.xad_3 = values["city"]
+    msg.pid.pid_11.xad_4 = values["state"]
+    msg.pid.pid_11.xad_5 = values["postal"]
+    msg.pid.pid_11.xad_7 = "H"
 
     # PV1 segment (patient visit)
     msg.pv1.pv1_1 = "1"
@@ -161,29 +186,52 @@ def create_adt_message(patient_data: dict, condition_data: dict, icd10_code: str
 
     # DG1 segment (Diagnosis segment)
     msg.dg1.dg1_1 = "1"
-    msg.dg1.dg1_3 = f"{icd10_code}^{icd10_term}^I10"  # DG1-3: ICD code^ICD description^coding system
+    # DG1-3: ICD code^ICD description^coding system
+    msg.dg1.dg1_3.ce_1 = icd10_code
+    msg.dg1.dg1_3.ce_2 = icd10_term
+    msg.dg1.dg1_3.ce_3 = "I10"
     msg.dg1.dg1_4 = snomed_term  # DG1-4: Diagnosis description
+    return msg
+
+
+def create_adt_message(patient_data: dict, condition_data: dict, icd10_code: str, icd10_term: str,
+                       pid_fields: dict = None) -> str:
+    """
+        Write an HL7 v2 ADT^A01 message (MSH, PID, PV1, DG1) for a Patient and its Condition
+        to data/adt_message.txt, rendered by the ER7 template serializer (er7_serializer.py)
+        with a unique MSH-10 control id. Returns the ER7 string.
+
+        pid_fields (e.g. from patient_columns.PatientColumns) replaces the extraction from patient_data.
+    """
+    # Basic patient demographics
+    pid = pid_fields if pid_fields is not None else extract_pid_fields(patient_data)
+    er7 = render_adt_a01(pid, condition_data, icd10_code, icd10_term)
 
     # Save message to .txt file in ER7 format
     out_path = data_dir / "adt_message.txt"
     with open(out_path, "w") as f:
-        f.write(msg.to_er7())
+        f.write(er7)
 
     print("HL7 ADT^A01 message created and saved to:", out_path)
     print()
     print("ADT Message:")
-    print(msg.to_er7().replace('\r', '\n'))
+    print(er7.replace('\r', '\n'))
+    return er7
 
 
 if __name__ == '__main__':
     print()
+    # Repeated GETs within this run are answered from memory
+    http_client.start_run()
     # 1. Fetch patient data from OpenEMR FHIR Patient resource
     patient_data = get_fhir_patient(patient_resource_id)
-    # 2. Load Condition (parent_condition.json) created in Task 1
-    condition_data = load_condition_json()
+    # 2. Load the parent Condition created in Task 1
+    condition_data = load_condition()
     # 3. Extract SNOMED code/term and map to ICD-10 using Hermes
     snomed_code = condition_data["code"]["coding"][0]["code"]
     snomed_term = condition_data["code"]["coding"][0]["display"]
-    icd10_code, icd10_term = map_snomed_to_icd10(snomed_code, snomed_term)
+    # A cohort-wide lookup table (python -m src.terminology_batch) avoids the Hermes round trip
+    icd10_code, icd10_term = map_snomed_to_icd10(snomed_code, snomed_term, lookup=load_lookup_table())
     # 4. Construct HL7 message
     create_adt_message(patient_data, condition_data, icd10_code, icd10_term)
+    http_client.end_run()
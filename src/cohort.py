@@ -0,0 +1,193 @@
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from urllib.parse import urlparse
+import requests
+from src import http_client
+from src.artifact_store import ArtifactStore, ARTIFACT_DIR
+from src.paging import get_bundle_page, get_next_page_url
+from src.http_client import BASE_URL
+from src.coding_task_1 import get_headers
+from src.compartment import build_compartment_url, server_supports_everything, split_resources_by_type
+
+# Resource types pulled for every patient in the cohort, besides the Patient itself
+COHORT_SEARCHES = {
+    "Condition": "Condition?patient={patient_id}",
+    "Observation": "Observation?patient={patient_id}",
+    "Procedure": "Procedure?patient={patient_id}",
+}
+
+
+def load_patient_ids(source):
+    """
+        Build the list of OpenEMR patient ids for a cohort.
+        `source` is either a path to a text file with one id per line
+        (blank lines and lines starting with # are skipped), a comma-separated
+        string of ids, or any iterable of ids.
+    """
+    if isinstance(source, (str, Path)) and Path(source).is_file():
+        with open(source, "r") as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    if isinstance(source, str):
+        return [patient_id.strip() for patient_id in source.split(",") if patient_id.strip()]
+    return [str(patient_id) for patient_id in source]
+
+
+class HostLimiter:
+    """
+        Caps the number of in-flight requests per host, independent of how many
+        worker threads are running.
+    """
+
+    def __init__(self, per_host_limit):
+        self.per_host_limit = per_host_limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._semaphores[host]
+
+
+def fetch_resource(url, headers, limiter):
+    """
+        GET a single resource under the per-host limit.
+        Returns the parsed JSON, or None on an HTTP error.
+    """
+    with limiter.slot(url):
+        response = http_client.cached_get(url=url, headers=headers)
+    if response.status_code != 200:
+        print(f"Error when trying to access {url}: {response.status_code}")
+        return None
+    return response.json()
+
+
+def fetch_search(url, headers, limiter):
+    """
+        Run a FHIR search under the per-host limit, following every next link.
+        Returns the list of matched resources; raises requests.HTTPError if a page cannot be read.
+    """
+    resources = []
+    while url:
+        with limiter.slot(url):
+            bundle = get_bundle_page(url, headers)
+        resources.extend(entry['resource'] for entry in bundle.get('entry', []) if 'resource' in entry)
+        url = get_next_page_url(bundle)
+    return resources
+
+
+def extract_patient(patient_id, headers, limiter, use_everything=None):
+    """
+        Fetch Patient, Condition, Observation and Procedure resources for one OpenEMR patient.
+        By default the whole patient compartment is pulled in a single search
+        (Patient/$everything or _revinclude); use_everything=None falls back to
+        one request per resource type.
+        Returns a dict keyed by resource type. Raises requests.RequestException when a
+        search cannot be read completely, rather than returning a partial record.
+    """
+    if use_everything is not None:
+        url = build_compartment_url(patient_id, use_everything, tuple(COHORT_SEARCHES), BASE_URL)
+        record = split_resources_by_type(fetch_search(url, headers, limiter), tuple(COHORT_SEARCHES))
+        record["patient_id"] = patient_id
+        return record
+
+    record = {
+        "patient_id": patient_id,
+        "Patient": fetch_resource(f'{BASE_URL}/Patient/{patient_id}', headers, limiter),
+    }
+    for resource_type, query in COHORT_SEARCHES.items():
+        url = f'{BASE_URL}/{query.format(patient_id=patient_id)}'
+        record[resource_type] = fetch_search(url, headers, limiter)
+    return record
+
+
+def extract_or_fail(patient_id, headers, limiter, use_everything=None):
+    """
+        extract_patient(), or {"patient_id", "error"} if the patient could not be read completely.
+    """
+    try:
+        return extract_patient(patient_id, headers, limiter, use_everything)
+    except requests.exceptions.RequestException as e:
+        print(f"Error when extracting patient {patient_id}: {e}")
+        return {"patient_id": patient_id, "error": f"{e}"}
+
+
+def iter_cohort(patient_ids, max_workers=16, per_host_limit=8, headers=None, compartment=True):
+    """
+        Extract a cohort concurrently with a bounded worker pool.
+        Yields one record per patient as soon as it completes (not in input order).
+        At most 2 * max_workers patients are queued at once, so memory stays flat
+        for cohorts of any size.
+        compartment=True fetches each patient in one round trip, see compartment.py.
+        A patient that could not be read completely is yielded as {"patient_id", "error"}.
+        `headers` defaults to coding_task_1.get_headers, called for every request, so a
+        cohort that outlives the access token keeps going with the renewed one.
+    """
+    headers = headers if headers is not None else get_headers
+    limiter = HostLimiter(per_host_limit)
+    use_everything = server_supports_everything(BASE_URL, headers) if compartment else None
+    patient_ids = iter(patient_ids)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for patient_id in patient_ids:
+            pending.add(executor.submit(extract_or_fail, patient_id, headers, limiter, use_everything))
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
+
+
+def extract_cohort(patient_ids, directory=ARTIFACT_DIR, max_workers=16, per_host_limit=8, report_every=100,
+                   compartment=True, headers=None):
+    """
+        Extract every patient in the cohort and append each record as one JSON line to the
+        "cohort" artifact stream (artifact_store.py: compressed, rotated parts, one new run each time).
+        Patients that could not be read completely are left out and listed instead.
+        Prints progress and the overall throughput in patients per second.
+        Returns (patient_count, elapsed_seconds, failed patient ids).
+    """
+    start = time.perf_counter()
+    count = 0
+    failed = []
+    with ArtifactStore(directory) as store:
+        for record in iter_cohort(patient_ids, max_workers=max_workers, per_host_limit=per_host_limit,
+                                  headers=headers, compartment=compartment):
+            if "error" in record:
+                failed.append(record["patient_id"])
+                continue
+            store.write(record, stream="cohort")
+            count += 1
+            if report_every and count % report_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"Extracted {count} patients ({count / elapsed:.1f} patients/s)")
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed else 0.0
+    print(f"Extracted {count} patients in {elapsed:.1f}s ({rate:.1f} patients/s)")
+    for path in store.paths.get("cohort", []):
+        print(f"Cohort records saved to: {path}")
+    if failed:
+        print(f"{len(failed)} patients could not be extracted: {', '.join(failed)}")
+    return count, elapsed, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent multi-patient extraction from OpenEMR")
+    parser.add_argument("patients", help="File with one OpenEMR patient id per line, or a comma-separated list of ids")
+    parser.add_argument("--dir", default=ARTIFACT_DIR, help="Artifact directory (default: data/artifacts)")
+    parser.add_argument("--workers", type=int, default=16, help="Number of worker threads")
+    parser.add_argument("--per-host", type=int, default=8, help="Max in-flight requests per host")
+    parser.add_argument("--per-type", action="store_true",
+                        help="Use one search per resource type instead of a single compartment search")
+    args = parser.parse_args()
+
+    print()
+    http_client.configure(pool_size=max(args.workers, args.per_host))
+    extract_cohort(load_patient_ids(args.patients), directory=args.dir,
+                   max_workers=args.workers, per_host_limit=args.per_host, compartment=not args.per_type)
@@ -0,0 +1,88 @@
+from src import http_client
+from src.http_client import BASE_URL
+from src.paging import iter_search_resources
+
+# Resource types linked to a Patient that the transform stage works with
+COMPARTMENT_TYPES = ("Condition", "Observation", "Procedure")
+
+# Cache of "does this server support Patient/$everything", keyed by base url
+_everything_support = {}
+
+
+def server_supports_everything(base_url=BASE_URL, headers=None):
+    """
+        Read the server CapabilityStatement (GET /metadata) and check whether
+        the Patient/$everything operation is advertised. The answer is cached per server.
+    """
+    if base_url in _everything_support:
+        return _everything_support[base_url]
+    supported = False
+    response = http_client.get(url=f'{base_url}/metadata', headers=headers)
+    if response.status_code == 200:
+        for rest in response.json().get('rest', []):
+            operations = list(rest.get('operation', []))
+            for resource in rest.get('resource', []):
+                if resource.get('type') == 'Patient':
+                    operations.extend(resource.get('operation', []))
+            if any(operation.get('name') == 'everything' for operation in operations):
+                supported = True
+    else:
+        print(f"Could not read CapabilityStatement: {response.status_code}")
+    _everything_support[base_url] = supported
+    return supported
+
+
+def build_compartment_url(patient_resource_id, use_everything=False, resource_types=COMPARTMENT_TYPES, base_url=BASE_URL):
+    """
+        Build the single search url that returns a Patient together with its linked resources.
+        Uses Patient/{id}/$everything, or Patient?_id={id}&_revinclude=<type>:patient for each type.
+    """
+    if use_everything:
+        return f'{base_url}/Patient/{patient_resource_id}/$everything?_type=Patient,{",".join(resource_types)}'
+    revincludes = "".join(f'&_revinclude={resource_type}:patient' for resource_type in resource_types)
+    return f'{base_url}/Patient?_id={patient_resource_id}{revincludes}'
+
+
+def split_resources_by_type(resources, resource_types=COMPARTMENT_TYPES):
+    """
+        Split a stream of resources into typed collections for the transform stage.
+        Returns {"Patient": <Patient or None>, "Condition": [...], "Observation": [...], "Procedure": [...]}.
+        Resource types that were not requested are ignored.
+    """
+    compartment = {"Patient": None}
+    for resource_type in resource_types:
+        compartment[resource_type] = []
+    for resource in resources:
+        resource_type = resource.get('resourceType')
+        if resource_type == 'Patient':
+            compartment['Patient'] = resource
+        elif resource_type in compartment:
+            compartment[resource_type].append(resource)
+    return compartment
+
+
+def fetch_patient_compartment(patient_resource_id, use_everything=None, resource_types=COMPARTMENT_TYPES,
+                              headers=None, base_url=BASE_URL):
+    """
+        Fetch a Patient and all of its Conditions, Observations and Procedures from OpenEMR
+        in a single search (plus next pages, if the result set is paged).
+        use_everything=None picks Patient/$everything when the server supports it
+        and falls back to _revinclude otherwise.
+        Returns the typed collections from split_resources_by_type().
+    """
+    if use_everything is None:
+        use_everything = server_supports_everything(base_url, headers)
+    url = build_compartment_url(patient_resource_id, use_everything, resource_types, base_url)
+    resources = iter_search_resources(url, headers=headers)
+    return split_resources_by_type(resources, resource_types)
+
+
+if __name__ == '__main__':
+    from src.coding_task_1 import get_headers
+    print()
+    compartment = fetch_patient_compartment(patient_resource_id='9d036484-c661-485c-899d-fcab43d40914',
+                                            headers=get_headers())
+    patient = compartment['Patient']
+    print(f"Patient: {patient.get('id') if patient else 'not found'}")
+    for resource_type in COMPARTMENT_TYPES:
+        print(f"{resource_type}: {len(compartment[resource_type])}")
@@ -0,0 +1,156 @@
+import threading
+import uuid
+from datetime import datetime
+from src.resource_templates import Slot
+
+FIELD_SEPARATOR = "|"
+ENCODING_CHARACTERS = "^~\\&"
+SEGMENT_SEPARATOR = "\r"
+
+# HL7 v2 escape sequences for delimiters inside a data value. A raw CR would end the segment, so
+# line breaks are kept as hex data escapes (\X0D\, \X0A\), which are valid in every data type and
+# decode back to the original characters. \.br\ is not used: it is a formatting command that only
+# FT/TX/CF fields interpret, while the values written here (names, addresses, terms) are ST/ID.
+# hl7apy writes CR/LF inside a value unescaped, so adt_conformance checks these by decoding.
+ESCAPES = str.maketrans({
+    "\\": "\\E\\",
+    "|": "\\F\\",
+    "^": "\\S\\",
+    "&": "\\T\\",
+    "~": "\\R\\",
+    "\r": "\\X0D\\",
+    "\n": "\\X0A\\",
+})
+
+
+def escape(value):
+    """
+        Escape the HL7 delimiters of one data value (a component, not a whole field), in one pass.
+    """
+    return f"{value}".translate(ESCAPES)
+
+
+def components(*values):
+    """
+        Field of already escaped components, without trailing empty components (as hl7apy writes it).
+    """
+    return "^".join(values).rstrip("^")
+
+
+class SegmentTemplate:
+    """
+        One segment with constant fields and Slot placeholders, compiled to a %-format string.
+        Fields are given from field 1 on (for MSH, from MSH-2: MSH-1 is the field separator).
+    """
+
+    def __init__(self, segment_id, fields):
+        self.segment_id = segment_id
+        self.slots = [field.name for field in fields if isinstance(field, Slot)]
+        self.format = FIELD_SEPARATOR.join(
+            [segment_id] + ["%s" if isinstance(field, Slot) else field.replace("%", "%%") for field in fields])
+
+
+class MessageTemplate:
+    """
+        Segment templates joined into a single format string, so rendering a message is one
+        %-format of its slot values. render() takes ER7-ready (escaped) field strings.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.slots = [name for segment in segments for name in segment.slots]
+        self.format = SEGMENT_SEPARATOR.join(segment.format for segment in segments)
+
+    def render(self, values):
+        return self.format % tuple(values[name] for name in self.slots)
+
+
+ADT_A01_TEMPLATE = MessageTemplate([
+    SegmentTemplate("MSH", [ENCODING_CHARACTERS, "MyApp", "OpenEMR", "PrimaryCareEHR", "PrimaryFacility",
+                            Slot("timestamp"), "", "ADT^A01", Slot("control_id"), "P", "2.5"]),
+    SegmentTemplate("PID", ["1", "", Slot("patient_id"), "", Slot("name"), "", Slot("birthdate"), Slot("gender"),
+                            "", "", Slot("address")]),
+    SegmentTemplate("PV1", ["1", "O"]),
+    SegmentTemplate("DG1", ["1", "", Slot("diagnosis"), Slot("description")]),
+])
+
+
+# MSH-10 is an ST of at most 20 characters in HL7 v2.5
+CONTROL_ID_LENGTH = 20
+
+
+def random_prefix(length):
+    """
+        `length` upper-case hex digits from uuid4 (4 random bits each).
+    """
+    return uuid.uuid4().hex[:length].upper()
+
+
+class ControlIds:
+    """
+        Unique MSH-10 message control ids of exactly 20 characters: a random prefix (48 bits from
+        uuid4 by default) followed by a zero-padded counter. Processes and hosts draw their own
+        prefixes, so they do not collide unless two random prefixes are equal. When the counter
+        runs out of digits, a new prefix is drawn and the counter restarts. Ids therefore never
+        exceed 20 characters and never repeat within a process. Safe to share between threads.
+    """
+
+    def __init__(self, prefix_length=12, new_prefix=random_prefix):
+        if not 0 < prefix_length < CONTROL_ID_LENGTH:
+            raise ValueError(f"prefix_length must be between 1 and {CONTROL_ID_LENGTH - 1}")
+        self.prefix_length = prefix_length
+        self.width = CONTROL_ID_LENGTH - prefix_length
+        self._new_prefix = new_prefix
+        self.prefix = new_prefix(prefix_length)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __next__(self):
+        with self._lock:
+            if self._next == 10 ** self.width:
+                self.prefix = self._new_prefix(self.prefix_length)
+                self._next = 0
+            number = self._next
+            self._next += 1
+            prefix = self.prefix
+        return f"{prefix}{number:0{self.width}d}"
+
+    def __iter__(self):
+        return self
+
+
+control_ids = ControlIds()
+
+
+def adt_a01_values(pid, condition_data, icd10_code, icd10_term, timestamp, control_id):
+    """
+        ER7 field values of an ADT^A01 message. `pid` is a coding_task_5.extract_pid_fields()
+        dict, whose name and address components are already escaped; the Condition and ICD-10
+        values are raw and escaped here.
+    """
+    snomed_term = condition_data["code"]["coding"][0]["display"]
+    return {
+        "timestamp": timestamp,
+        "control_id": control_id,
+        "patient_id": pid["patient_id"],
+        "name": pid["name"].rstrip("^"),
+        "birthdate": pid["birthdate"],
+        "gender": pid["gender"],
+        "address": pid["address"].rstrip("^"),
+        "diagnosis": components(escape(icd10_code), escape(icd10_term), "I10"),
+        "description": escape(snomed_term),
+    }
+
+
+def render_adt_a01(pid, condition_data, icd10_code, icd10_term, timestamp=None, control_id=None):
+    """
+        ADT^A01 message in ER7, segments separated by \\r with no trailing separator, byte-identical
+        to coding_task_5.build_adt_message(...).to_er7() wherever hl7apy escapes correctly
+        (see adt_conformance.py). A new control id is drawn from
+        `control_ids` unless one is given; timestamp defaults to now.
+    """
+    if timestamp is None:
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    if control_id is None:
+        control_id = next(control_ids)
+    return ADT_A01_TEMPLATE.render(adt_a01_values(pid, condition_data, icd10_code, icd10_term, timestamp, control_id))
@@ -0,0 +1,130 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from src.registration import data_dir
+
+CACHE_FILE = data_dir / "http_cache.sqlite"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Response headers worth replaying when a cached body is served
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+class ResponseCache:
+    """
+        Persistent on-disk cache of GET responses that carry an ETag or Last-Modified
+        validator. Stored entries are revalidated with If-None-Match / If-Modified-Since
+        and a 304 answer is served from disk. The least recently used entries are evicted
+        once the stored bodies exceed max_bytes.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT,"
+            " body BLOB, size INTEGER, last_access REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._db.commit()
+
+    def conditional_headers(self, url):
+        """
+            Validator headers to send for `url`, or {} if nothing is cached for it.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return {}
+        headers = {}
+        if row[0]:
+            headers["If-None-Match"] = row[0]
+        if row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def load(self, url):
+        """
+            Build a 200 Response from the cached entry for `url` (after a 304), or None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT headers, body FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET last_access = ? WHERE url = ?", (time.time(), url))
+            self._db.commit()
+            self.hits += 1
+        response = Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(json.loads(row[0]))
+        response._content = row[1]
+        response.encoding = "utf-8"
+        return response
+
+    def store(self, url, response):
+        """
+            Cache a 200 response for `url` if it has an ETag or Last-Modified validator.
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        with self._lock:
+            self.misses += 1
+            if not etag and not last_modified:
+                return
+            headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+            body = response.content
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, json.dumps(headers), body, len(body), time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, size in self._db.execute("SELECT url, size FROM responses ORDER BY last_access").fetchall():
+            self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def stats(self):
+        """
+            Hit/miss counters for this process plus the current size of the cache on disk.
+        """
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": entries, "bytes": size}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect or clear the on-disk HTTP response cache")
+    parser.add_argument("--clear", action="store_true", help="Remove every cached response")
+    args = parser.parse_args()
+
+    cache = ResponseCache()
+    if args.clear:
+        cache.clear()
+        print(f"Cleared {cache.path}")
+    print(cache.stats())
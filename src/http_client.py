@@ -0,0 +1,221 @@
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from src.registration import TOKEN_URL
+from src.http_cache import ResponseCache
+from src.run_memo import RunMemo
+
+BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir" # OpenEMR FHIR server
+BASE_HERMES_URL = 'http://159.203.121.13:8080/v1/snomed' # Hermes terminology server
+PRIMARY_FHIR_URL = 'http://159.203.105.138:8080/fhir' # Primary care EHR FHIR server
+
+# Base url for every host the pipeline talks to
+HOSTS = {
+    "openemr": BASE_URL,
+    "hermes": BASE_HERMES_URL,
+    "primary": PRIMARY_FHIR_URL,
+    "token": TOKEN_URL,
+}
+
+# (connect, read) timeout in seconds applied to every request unless the caller overrides it
+DEFAULT_TIMEOUT = (5, 30)
+
+# Keep-alive connections kept open per host; size this to the number of concurrent workers
+DEFAULT_POOL_SIZE = 32
+
+_pool_size = DEFAULT_POOL_SIZE
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Conditional-GET cache used by cached_get(); created on first use
+USE_RESPONSE_CACHE = True
+_response_cache = None
+
+# Memo of GET responses for the current run, see run_scope()
+_run_memo = None
+
+# Called with a rejected Authorization header after a 401; returns a fresh one (see token_provider.py)
+_auth_refresher = None
+
+
+def configure(pool_size=None, timeout=None, response_cache=None):
+    """
+        Change the per-host pool size, the default (connect, read) timeout,
+        and/or turn the on-disk response cache on or off.
+        Existing sessions are closed so the new pool size applies to the next request.
+    """
+    global _pool_size, DEFAULT_TIMEOUT, USE_RESPONSE_CACHE
+    if timeout is not None:
+        DEFAULT_TIMEOUT = timeout
+    if response_cache is not None:
+        USE_RESPONSE_CACHE = response_cache
+    if pool_size is not None:
+        _pool_size = pool_size
+        close_sessions()
+
+
+def url_for(host, path=""):
+    """
+        Build a url from one of the HOSTS names and a path, e.g. url_for("primary", "Patient").
+    """
+    base = HOSTS[host]
+    return f'{base}/{path}' if path else base
+
+
+def get_session(url):
+    """
+        Return the shared keep-alive Session for the host of `url`, creating it on first use.
+        One Session (and connection pool) exists per scheme://host:port.
+    """
+    parsed = urlparse(url)
+    key = f'{parsed.scheme}://{parsed.netloc}'
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        if key not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size)
+            session.mount(f'{parsed.scheme}://', adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def close_sessions():
+    """
+        Close every pooled Session (and its open connections).
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def set_auth_refresher(refresher):
+    """
+        Register the callback used to renew the Authorization header after a 401.
+    """
+    global _auth_refresher
+    _auth_refresher = refresher
+
+
+def resolve_headers(headers):
+    """
+        Request headers from a dict, or from a zero-argument function that returns one.
+        A function is called for every request, so a long run can pass e.g.
+        coding_task_1.get_headers and each request carries the current access token.
+    """
+    return headers() if callable(headers) else headers
+
+
+def request(method, url, timeout=None, headers=None, **kwargs):
+    """
+        Send a request through the pooled Session for the url's host,
+        with the default timeout unless one is given.
+        A 401 on a request carrying an Authorization header is retried once
+        with a refreshed token when an auth refresher is registered. If the refresher
+        hands back the same token (e.g. a renewal is backing off), the 401 is returned as is.
+    """
+    headers = resolve_headers(headers)
+    session = get_session(url)
+    timeout = timeout or DEFAULT_TIMEOUT
+    response = session.request(method=method, url=url, timeout=timeout, headers=headers, **kwargs)
+    authorization = (headers or {}).get("Authorization")
+    if response.status_code == 401 and authorization and _auth_refresher is not None:
+        refreshed = _auth_refresher(authorization)
+        if refreshed == authorization:
+            return response
+        response.close()
+        headers = {**headers, "Authorization": refreshed}
+        response = session.request(method=method, url=url, timeout=timeout, headers=headers, **kwargs)
+    return response
+
+
+def start_run(max_entries=None):
+    """
+        Start memoizing idempotent GETs: until end_run(), repeated GETs of the same url
+        with the same auth scope are answered from memory instead of the network.
+    """
+    global _run_memo
+    _run_memo = RunMemo(max_entries) if max_entries else RunMemo()
+    return _run_memo
+
+
+def end_run():
+    """
+        Stop memoizing, print how many network calls the run saved and return the memo.
+    """
+    global _run_memo
+    memo, _run_memo = _run_memo, None
+    if memo is not None:
+        memo.report()
+    return memo
+
+
+@contextmanager
+def run_scope(max_entries=None):
+    """
+        Context manager around start_run() / end_run().
+    """
+    memo = start_run(max_entries)
+    try:
+        yield memo
+    finally:
+        end_run()
+
+
+def _memoized(url, headers, kwargs, fetch):
+    memo = _run_memo
+    if memo is None or kwargs.get("stream"):
+        return fetch()
+    return memo.get_or_fetch(RunMemo.key(url, headers, kwargs.get("params")), fetch)
+
+
+def get(url, headers=None, **kwargs):
+    headers = resolve_headers(headers)
+    return _memoized(url, headers, kwargs, lambda: request("GET", url, headers=headers, **kwargs))
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def get_response_cache():
+    """
+        Return the shared on-disk ResponseCache, opening it on first use.
+    """
+    global _response_cache
+    if _response_cache is None:
+        with _sessions_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache()
+    return _response_cache
+
+
+def cached_get(url, headers=None, **kwargs):
+    """
+        GET through the on-disk response cache: sends If-None-Match / If-Modified-Since
+        for urls cached earlier and serves a 304 answer from disk.
+        The full url (including query string) is the cache key.
+    """
+    headers = resolve_headers(headers)
+    if not USE_RESPONSE_CACHE:
+        return get(url, headers=headers, **kwargs)
+    return _memoized(url, headers, kwargs, lambda: _revalidate(url, headers, **kwargs))
+
+
+def _revalidate(url, headers=None, **kwargs):
+    cache = get_response_cache()
+    validators = cache.conditional_headers(url)
+    response = request("GET", url, headers={**(headers or {}), **validators}, **kwargs)
+    if response.status_code == 304:
+        cached = cache.load(url)
+        if cached is not None:
+            return cached
+        # The entry was evicted between the two lookups: fetch it again without validators
+        response = request("GET", url, headers=headers, **kwargs)
+    if response.status_code == 200:
+        cache.store(url, response)
+    return response
@@ -0,0 +1,167 @@
+import argparse
+import bisect
+import csv
+import mmap
+import struct
+import time
+from pathlib import Path
+from src.registration import data_dir
+
+INDEX_FILE = data_dir / "icd10_map.idx"
+ICD10_MAP_REFSET_ID = "447562003"
+
+# File layout (little endian):
+#   header          magic, record count, string count
+#   concept ids     uint64 * record count, sorted
+#   records         (mapGroup, mapPriority, target, rule, advice) * record count; strings are table indexes
+#   string offsets  uint32 * (string count + 1)
+#   string blob     utf-8
+MAGIC = b"SCTMAP01"
+HEADER = struct.Struct("<8sQQ")
+RECORD = struct.Struct("<HHIII")
+OFFSET = struct.Struct("<I")
+
+
+def read_extended_map_rows(rf2_path, refset_id=ICD10_MAP_REFSET_ID):
+    """
+        Yield the active rows of one map refset from an RF2 extended map snapshot
+        (der2_iisssccRefset_ExtendedMapSnapshot_*.txt).
+    """
+    with open(rf2_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if row["active"] == "1" and row["refsetId"] == refset_id:
+                yield row
+
+
+def build_index(rf2_path, index_path=INDEX_FILE, refset_id=ICD10_MAP_REFSET_ID):
+    """
+        Build the compact on-disk map index from an RF2 snapshot file.
+        Records are sorted by concept id, map group and map priority; rule, advice and
+        target strings are de-duplicated into a shared string table.
+        Returns the number of map records written.
+    """
+    strings = {}
+
+    def intern(value):
+        return strings.setdefault(value or "", len(strings))
+
+    records = []
+    for row in read_extended_map_rows(rf2_path, refset_id):
+        records.append((
+            int(row["referencedComponentId"]), int(row["mapGroup"]), int(row["mapPriority"]),
+            intern(row["mapTarget"]), intern(row["mapRule"]), intern(row["mapAdvice"]),
+        ))
+    records.sort(key=lambda record: record[:3])
+
+    encoded = [value.encode("utf-8") for value in strings]
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), len(encoded)))
+        f.write(struct.pack(f"<{len(records)}Q", *(record[0] for record in records)))
+        for record in records:
+            f.write(RECORD.pack(*record[1:]))
+        offset = 0
+        for value in encoded:
+            f.write(OFFSET.pack(offset))
+            offset += len(value)
+        f.write(OFFSET.pack(offset))
+        for value in encoded:
+            f.write(value)
+    tmp_path.replace(index_path)
+    return len(records)
+
+
+class MapIndex:
+    """
+        Read-only, memory-mapped view of an index written by build_index().
+        lookup() binary-searches the sorted concept ids, so no parsing happens at startup.
+    """
+
+    def __init__(self, index_path=INDEX_FILE):
+        self._file = open(index_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.record_count, string_count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{index_path} is not a SNOMED map index")
+        view = memoryview(self._mmap)
+        ids_start = HEADER.size
+        self._records_start = ids_start + 8 * self.record_count
+        offsets_start = self._records_start + RECORD.size * self.record_count
+        self._strings_start = offsets_start + OFFSET.size * (string_count + 1)
+        self._concept_ids = view[ids_start:self._records_start].cast("Q")
+        self._offsets = view[offsets_start:self._strings_start].cast("I")
+
+    def _string(self, index):
+        start = self._strings_start + self._offsets[index]
+        end = self._strings_start + self._offsets[index + 1]
+        return self._mmap[start:end].decode("utf-8")
+
+    def lookup(self, concept_id):
+        """
+            All map records for a SNOMED concept, ordered by mapGroup then mapPriority.
+            Each record uses the Hermes field names (mapGroup, mapPriority, mapRule,
+            mapAdvice, mapTarget). Returns [] if the concept is not mapped.
+        """
+        concept_id = int(concept_id)
+        position = bisect.bisect_left(self._concept_ids, concept_id)
+        results = []
+        while position < self.record_count and self._concept_ids[position] == concept_id:
+            group, priority, target, rule, advice = RECORD.unpack_from(
+                self._mmap, self._records_start + RECORD.size * position)
+            results.append({
+                "mapGroup": group,
+                "mapPriority": priority,
+                "mapRule": self._string(rule),
+                "mapAdvice": self._string(advice),
+                "mapTarget": self._string(target),
+            })
+            position += 1
+        return results
+
+    def close(self):
+        self._concept_ids.release()
+        self._offsets.release()
+        self._mmap.close()
+        self._file.close()
+
+
+_index = None
+
+
+def get_map_index(index_path=INDEX_FILE):
+    """
+        Return the shared MapIndex, or None if no index has been built yet.
+    """
+    global _index
+    if _index is None and Path(index_path).exists():
+        _index = MapIndex(index_path)
+    return _index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline SNOMED CT to ICD-10 map index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Build the index from an RF2 extended map snapshot")
+    build.add_argument("rf2_file", help="der2_iisssccRefset_ExtendedMapSnapshot_*.txt")
+    build.add_argument("--refset", default=ICD10_MAP_REFSET_ID, help="Map refset id to keep")
+    lookup = subparsers.add_parser("lookup", help="Look up the ICD-10 map records of a SNOMED concept")
+    lookup.add_argument("concept_id")
+    args = parser.parse_args()
+
+    print()
+    if args.command == "build":
+        count = build_index(args.rf2_file, refset_id=args.refset)
+        print(f"Wrote {count} map records to {INDEX_FILE}")
+    else:
+        index = get_map_index()
+        if index is None:
+            print(f"No index found at {INDEX_FILE}; run the build command first")
+        else:
+            start = time.perf_counter()
+            records = index.lookup(args.concept_id)
+            elapsed = time.perf_counter() - start
+            for record in records:
+                print(record)
+            print(f"{len(records)} records in {elapsed * 1e6:.1f} µs")
@@ -0,0 +1,279 @@
+import argparse
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+from src import write_scheduler
+from src.registration import data_dir
+from src.http_client import BASE_URL, PRIMARY_FHIR_URL
+from src.validation_cache import content_hash
+
+MAP_FILE = data_dir / "identity_map.sqlite"
+
+# Where source resources come from; also the base of the stable identifier systems
+SOURCE_SYSTEM = BASE_URL
+
+
+class IdentityMap:
+    """
+        Indexed store of (source system, resource type, source id) -> target id on the
+        Primary Care EHR, in a SQLite file. Lookups are primary-key reads. Each row also keeps
+        the content hash of the resource last written, so unchanged resources are not sent again.
+    """
+
+    def __init__(self, path=MAP_FILE):
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS identity_map ("
+            " source_system TEXT, resource_type TEXT, source_id TEXT, target_id TEXT, updated_at REAL,"
+            " PRIMARY KEY (source_system, resource_type, source_id))"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(identity_map)")]
+        if "content_hash" not in columns:
+            # Maps written before content hashes were kept; their rows are re-sent once
+            self._db.execute("ALTER TABLE identity_map ADD COLUMN content_hash TEXT")
+        self._db.commit()
+
+    def get(self, resource_type, source_id, source_system=SOURCE_SYSTEM):
+        """
+            Target id of a source resource, or None if it has not been loaded.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT target_id FROM identity_map WHERE source_system = ? AND resource_type = ? AND source_id = ?",
+                (source_system, resource_type, str(source_id)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_entry(self, resource_type, source_id, source_system=SOURCE_SYSTEM):
+        """
+            (target id, content hash) of a source resource, or (None, None) if it has not been loaded.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT target_id, content_hash FROM identity_map"
+                " WHERE source_system = ? AND resource_type = ? AND source_id = ?",
+                (source_system, resource_type, str(source_id)),
+            ).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def put(self, resource_type, source_id, target_id, source_system=SOURCE_SYSTEM, content_hash=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO identity_map VALUES (?, ?, ?, ?, ?, ?)",
+                (source_system, resource_type, str(source_id), str(target_id), time.time(), content_hash),
+            )
+            self._db.commit()
+
+    def put_many(self, rows, source_system=SOURCE_SYSTEM):
+        """
+            Store many (resource_type, source_id, target_id[, content_hash]) rows in one transaction.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO identity_map VALUES (?, ?, ?, ?, ?, ?)",
+                [(source_system, row[0], str(row[1]), str(row[2]), now, row[3] if len(row) > 3 else None)
+                 for row in rows],
+            )
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT resource_type, COUNT(*) FROM identity_map GROUP BY resource_type").fetchall()
+        return dict(rows)
+
+
+_identity_map = None
+_identity_map_lock = threading.Lock()
+
+
+def get_identity_map():
+    """
+        Return the process-wide IdentityMap, opening it on first use.
+    """
+    global _identity_map
+    if _identity_map is None:
+        with _identity_map_lock:
+            if _identity_map is None:
+                _identity_map = IdentityMap()
+    return _identity_map
+
+
+def source_identifier(resource_type, source_id, source_system=SOURCE_SYSTEM):
+    """
+        Stable business identifier of a source resource, e.g. {OpenEMR base}/Patient | {OpenEMR id}.
+    """
+    return {"system": f"{source_system}/{resource_type}", "value": str(source_id)}
+
+
+def add_source_identifier(resource, source_id, source_system=SOURCE_SYSTEM):
+    """
+        Add the stable source identifier to a resource (once) and return it.
+    """
+    identifier = source_identifier(resource["resourceType"], source_id, source_system)
+    identifiers = resource.setdefault("identifier", [])
+    if identifier not in identifiers:
+        identifiers.append(identifier)
+    return identifier
+
+
+def if_none_exist(identifier):
+    """
+        If-None-Exist header / Bundle ifNoneExist value matching a resource by identifier.
+    """
+    return urlencode({"identifier": f"{identifier['system']}|{identifier['value']}"})
+
+
+def id_from_location(location):
+    """
+        Resource id from a Location header such as http://host/fhir/Patient/123/_history/1.
+    """
+    parts = (location or "").split("/")
+    if "_history" in parts:
+        parts = parts[:parts.index("_history")]
+    return parts[-1] if len(parts) >= 2 else None
+
+
+def conditional_create(resource, source_id, source_system=SOURCE_SYSTEM, base_url=PRIMARY_FHIR_URL,
+                       identity_map=None):
+    """
+        Create or update `resource` on the Primary Care EHR, once per source resource.
+        A source id already in the identity map is updated in place (PUT) when its content
+        changed since the last write, and answered locally with no request when it did not.
+        Otherwise the resource is POSTed with its stable source identifier and If-None-Exist,
+        so the server returns the existing resource instead of creating a duplicate.
+        Returns the resource as returned by the server, a stub {"resourceType", "id"} for an
+        unchanged identity map hit, or None on an error.
+    """
+    identity_map = identity_map or get_identity_map()
+    resource_type = resource["resourceType"]
+    identifier = add_source_identifier(resource, source_id, source_system)
+    digest = content_hash(resource)
+    target_id, stored_hash = identity_map.get_entry(resource_type, source_id, source_system)
+    if target_id is not None:
+        if stored_hash == digest:
+            print(f"{resource_type} {source_id} is already loaded as {resource_type}/{target_id}, unchanged")
+            return {"resourceType": resource_type, "id": target_id}
+        updated = update(resource, target_id, base_url)
+        if updated is not False:
+            if updated is not None:
+                identity_map.put(resource_type, source_id, target_id, source_system, digest)
+            return updated
+        print(f"{resource_type}/{target_id} is gone from the server; creating it again")
+
+    fhir_url = f'{base_url}/{resource_type}'
+    headers = {'Content-Type': 'application/fhir+json', 'If-None-Exist': if_none_exist(identifier)}
+    print(f'POST {fhir_url}')
+    response = write_scheduler.post(url=fhir_url, headers=headers, json=resource)
+    if response.status_code not in (200, 201):
+        print(f"Error creating {resource_type} for source id {source_id}: {response.status_code}")
+        return None
+    created = response.json() if response.content else {}
+    target_id = created.get("id") or id_from_location(response.headers.get("Location"))
+    if target_id is None:
+        print(f"No id returned for {resource_type} {source_id}")
+        return None
+    if response.status_code == 200:
+        # If-None-Exist matched a resource created before this map knew it; bring it up to date
+        created = update(resource, target_id, base_url) or None
+        if created is None:
+            return None
+    identity_map.put(resource_type, source_id, target_id, source_system, digest)
+    return created or {"resourceType": resource_type, "id": target_id}
+
+
+def update(resource, target_id, base_url=PRIMARY_FHIR_URL):
+    """
+        PUT `resource` as {type}/{target_id} on the Primary Care EHR. Returns the updated
+        resource, False if the target no longer exists (404/410), or None on another error.
+    """
+    resource_type = resource["resourceType"]
+    resource["id"] = target_id
+    fhir_url = f'{base_url}/{resource_type}/{target_id}'
+    print(f'PUT {fhir_url}')
+    response = write_scheduler.put(url=fhir_url, headers={'Content-Type': 'application/fhir+json'}, json=resource)
+    if response.status_code in (404, 410):
+        del resource["id"]
+        return False
+    if response.status_code not in (200, 201):
+        print(f"Error updating {resource_type}/{target_id}: {response.status_code}")
+        return None
+    return (response.json() if response.content else None) or {"resourceType": resource_type, "id": target_id}
+
+
+# Elements never remapped by remap_references(): set by the loader itself, or holding whole resources
+REMAP_SKIP = ("subject", "contained")
+
+# Relative reference Type/id, optionally versioned
+RELATIVE_REFERENCE = re.compile(r"^([A-Z][A-Za-z]+)/([A-Za-z0-9\-.]{1,64})(?:/_history/[A-Za-z0-9\-.]{1,64})?$")
+
+
+def remap_references(resource, identity_map=None, source_system=SOURCE_SYSTEM, skip=REMAP_SKIP, aliases=None):
+    """
+        Point the references of a source resource (encounter, performer, recorder, asserter,
+        basedOn, ...) at the copies loaded on the Primary Care EHR, in place. A relative Type/id
+        reference found in the identity map is rewritten to the target id. An element, or list item,
+        holding any other reference is removed: it points at a resource that only exists on the
+        source server (e.g. an Encounter or Practitioner that is not loaded). `aliases` maps source
+        references to replacements used first, e.g. a Patient created in the same transaction.
+        Returns the resource.
+    """
+    aliases = aliases or {}
+    identity_map = identity_map or get_identity_map()
+
+    def remap(value):
+        # False when value holds a reference that cannot be resolved on the target
+        if isinstance(value, list):
+            return all(remap(item) for item in value)
+        if not isinstance(value, dict):
+            return True
+        reference = value.get("reference")
+        if reference in aliases:
+            value["reference"] = aliases[reference]
+        elif isinstance(reference, str) and not reference.startswith("#"):
+            match = RELATIVE_REFERENCE.match(reference)
+            target_id = match and identity_map.get(match.group(1), match.group(2), source_system)
+            if not target_id:
+                return False
+            value["reference"] = f"{match.group(1)}/{target_id}"
+        return all(remap(item) for key, item in value.items() if key != "reference")
+
+    for key in [key for key in resource if key not in skip]:
+        value = resource[key]
+        if isinstance(value, list):
+            kept = [item for item in value if remap(item)]
+            if kept:
+                resource[key] = kept
+            else:
+                del resource[key]
+        elif not remap(value):
+            del resource[key]
+    return resource
+
+
+def load_primary_patient_id(source_patient_id, source_system=SOURCE_SYSTEM):
+    """
+        Primary Care EHR Patient id of an OpenEMR patient (created in Task 1), or None.
+    """
+    target_id = get_identity_map().get("Patient", source_patient_id, source_system)
+    if target_id is None:
+        print(f"Error: patient {source_patient_id} has not been loaded yet; run coding_task_1.py first.")
+    return target_id
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Source to target identity map of loaded resources")
+    parser.add_argument("resource_type", nargs="?", help="Resource type to look up, e.g. Patient")
+    parser.add_argument("source_id", nargs="?", help="Source (OpenEMR) id to look up")
+    args = parser.parse_args()
+
+    print()
+    if args.resource_type and args.source_id:
+        print(get_identity_map().get(args.resource_type, args.source_id))
+    else:
+        print(get_identity_map().stats())
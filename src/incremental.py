@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+from datetime import datetime
+from urllib.parse import quote
+from src.registration import data_dir
+from src import http_client
+from src.http_client import BASE_URL
+from src.paging import iter_search_resources
+from src.coding_task_1 import get_headers, create_patient_resource, get_parent_for_condition, create_condition_resource
+from src.identity_map import conditional_create, load_primary_patient_id, remap_references
+
+INCREMENTAL_TYPES = ("Patient", "Condition", "Observation", "Procedure")
+WATERMARK_FILE = data_dir / "watermarks.json"
+
+
+def load_watermarks(path=WATERMARK_FILE):
+    """
+        Read the per-resource-type high-water marks ({resourceType: lastUpdated instant}).
+        Returns an empty dict when no run has completed yet.
+    """
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_watermarks(watermarks, path=WATERMARK_FILE):
+    """
+        Write the watermarks atomically, so a crash never leaves a half-written file behind.
+    """
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def parse_instant(value):
+    """
+        Parse a FHIR instant (e.g. 2025-12-10T17:50:30.742+00:00 or ...Z) into an aware datetime.
+    """
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def build_changes_url(resource_type, since=None, base_url=BASE_URL):
+    """
+        Search url for resources of a type changed after `since`, oldest first.
+        With since=None every resource of the type is returned (first full run).
+    """
+    url = f'{base_url}/{resource_type}?_sort=_lastUpdated'
+    if since:
+        # quote() keeps a "+00:00" offset from turning into a space
+        url += f'&_lastUpdated=gt{quote(since)}'
+    return url
+
+
+def primary_patient_id(resource):
+    """
+        Primary Care EHR id of the patient a source resource belongs to, from the identity map.
+        Raises RuntimeError if that patient has not been loaded.
+    """
+    reference = (resource.get("subject") or {}).get("reference", "")
+    patient_id = load_primary_patient_id(reference.split("/")[-1])
+    if patient_id is None:
+        raise RuntimeError(f"{resource.get('resourceType')}/{resource.get('id')}: patient {reference} "
+                           f"is not loaded on the primary server")
+    return patient_id
+
+
+def copy_for_primary(resource):
+    """
+        Copy a source resource for the Primary Care EHR: drop server ids/meta, point the
+        subject at the patient's copy on the primary server and remap (or drop) its other
+        references to source resources.
+    """
+    copy = {key: value for key, value in resource.items() if key not in ("id", "meta")}
+    copy["subject"] = {"reference": f"Patient/{primary_patient_id(resource)}"}
+    return remap_references(copy)
+
+
+def load_changed_patient(resource):
+    create_patient_resource(resource.get("id"), source_patient=resource)
+
+
+def load_changed_condition(resource):
+    parent_id, parent_term = get_parent_for_condition(resource) or (None, None)
+    if parent_id is None:
+        raise RuntimeError(f"Condition/{resource.get('id')}: no SNOMED parent concept found")
+    create_condition_resource(primary_patient_id(resource), parent_id, parent_term, resource.get("id"))
+
+
+def load_changed_resource(resource):
+    """
+        Create the primary copy of a changed Observation/Procedure, or update it in place
+        (PUT) when the source resource was loaded before.
+    """
+    if conditional_create(copy_for_primary(resource), source_id=resource.get("id")) is None:
+        raise RuntimeError(f"Could not load {resource.get('resourceType')}/{resource.get('id')}")
+
+
+# What happens to each changed resource: the same transforms and loads as the tasks
+INCREMENTAL_HANDLERS = {
+    "Patient": load_changed_patient,
+    "Condition": load_changed_condition,
+    "Observation": load_changed_resource,
+    "Procedure": load_changed_resource,
+}
+
+
+def sync_resource_type(resource_type, since, handler, headers=None, base_url=BASE_URL):
+    """
+        Run `handler` on every resource of `resource_type` changed after `since`.
+        Returns (count, new_watermark). The new watermark is the latest meta.lastUpdated
+        seen, or the old one if nothing changed.
+    """
+    count = 0
+    watermark = since
+    for resource in iter_search_resources(build_changes_url(resource_type, since, base_url), headers=headers):
+        handler(resource)
+        count += 1
+        last_updated = resource.get("meta", {}).get("lastUpdated")
+        if last_updated and (watermark is None or parse_instant(last_updated) > parse_instant(watermark)):
+            watermark = last_updated
+    return count, watermark
+
+
+def run_incremental(resource_types=INCREMENTAL_TYPES, handlers=INCREMENTAL_HANDLERS, full=False,
+                    headers=None, base_url=BASE_URL, watermark_path=WATERMARK_FILE):
+    """
+        Extract only what changed in OpenEMR since the last successful run and push it
+        through the transform/load handlers. A handler raises when a resource could not be
+        loaded; the run stops there and the watermark of that resource type is not advanced,
+        so the next run retries from the previous watermark. A search page that cannot be read
+        raises requests.HTTPError (see paging.get_bundle_page()) and stops the run the same way.
+        Loads are keyed on the source ids (identity map), so resources handled before the
+        failure are not duplicated.
+        full=True ignores the stored watermarks (full re-extract).
+        `headers` defaults to coding_task_1.get_headers, called for every page request.
+        Returns {resourceType: number of changed resources processed}.
+    """
+    headers = headers if headers is not None else get_headers
+    watermarks = load_watermarks(watermark_path)
+    counts = {}
+    for resource_type in resource_types:
+        since = None if full else watermarks.get(resource_type)
+        print(f"{resource_type}: changes since {since or 'the beginning'}")
+        count, watermark = sync_resource_type(resource_type, since, handlers[resource_type], headers, base_url)
+        counts[resource_type] = count
+        if watermark:
+            watermarks[resource_type] = watermark
+            save_watermarks(watermarks, watermark_path)
+        print(f"{resource_type}: {count} changed resources processed, watermark {watermark}")
+        print()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incremental OpenEMR extraction using _lastUpdated watermarks")
+    parser.add_argument("--types", default=",".join(INCREMENTAL_TYPES), help="Comma-separated resource types")
+    parser.add_argument("--full", action="store_true", help="Ignore stored watermarks and re-extract everything")
+    args = parser.parse_args()
+
+    print()
+    with http_client.run_scope():
+        run_incremental(resource_types=tuple(args.types.split(",")), full=args.full)
@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from src import http_client
+
+
+def get_bundle_page(url, headers=None):
+    """
+        GET one searchset Bundle page from a FHIR server and return the parsed Bundle dict.
+        Raises requests.HTTPError if the server answered anything but 200: a page that could
+        not be read must not look like the end of the result set.
+    """
+    response = http_client.cached_get(url=url, headers=headers)
+    print(response.url)
+    if response.status_code != 200:
+        print(f"Error when trying to access data: {response.status_code}")
+        try:
+            print(f'Error: {response.json()}')
+        except ValueError:
+            print("Error body is not JSON")
+        raise requests.HTTPError(f"{response.status_code} for search page {url}", response=response)
+    return response.json()
+
+
+def get_next_page_url(bundle):
+    """
+        Return the url of the Bundle link with relation "next", or None on the last page.
+    """
+    for link in bundle.get('link', []):
+        if link.get('relation') == 'next':
+            return link.get('url')
+    return None
+
+
+def iter_bundle_pages(url, headers=None, prefetch=True):
+    """
+        Generator over every page of a FHIR search, following link[relation=next]
+        until the server stops returning one.
+        With prefetch=True the next page is requested on a background thread while
+        the caller is still working on the current page, so at most two pages are
+        held in memory at any time. A page error raises requests.HTTPError once the
+        pages before it have been yielded (see get_bundle_page()).
+    """
+    if not prefetch:
+        while url:
+            bundle = get_bundle_page(url, headers)
+            yield bundle
+            url = get_next_page_url(bundle)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        bundle = get_bundle_page(url, headers)
+        while bundle is not None:
+            next_url = get_next_page_url(bundle)
+            future = executor.submit(get_bundle_page, next_url, headers) if next_url else None
+            yield bundle
+            bundle = future.result() if future else None
+
+
+def iter_search_resources(url, headers=None, prefetch=True):
+    """
+        Generator that yields the resources of a FHIR search one at a time,
+        across all pages of the result set. Raises requests.HTTPError on a page error.
+    """
+    for bundle in iter_bundle_pages(url, headers=headers, prefetch=prefetch):
+        for entry in bundle.get('entry', []):
+            resource = entry.get('resource')
+            if resource is not None:
+                yield resource
+
+
+def get_first_resource(url, headers=None):
+    """
+        Return the first resource of a FHIR search, or None if there are no results.
+        Only the first page is requested; raises requests.HTTPError if it cannot be read.
+    """
+    return next(iter_search_resources(url, headers=headers, prefetch=False), None)
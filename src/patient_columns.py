@@ -0,0 +1,230 @@
+import argparse
+import csv
+import json
+import time
+from itertools import islice
+from pathlib import Path
+import numpy as np
+from src.artifact_store import ArtifactStore, ARTIFACT_DIR
+from src.er7_serializer import ESCAPES
+from src.patient_transform import DEFAULT_DISTRICT
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# Artifact stream of the de-identified Patients, as cohort records bundle_loader.py can load
+PATIENT_STREAM = "demographics"
+
+# Input columns (CSV header names / NDJSON keys) of a demographics file
+DEMOGRAPHIC_FIELDS = ("id", "family", "given", "gender", "birthDate", "line", "city", "district", "state",
+                      "postalCode")
+ADDRESS_FIELDS = ("line", "city", "district", "state", "postalCode")
+
+STRING = np.dtypes.StringDType()
+
+# er7_serializer.ESCAPES as (character, escape sequence) pairs, "\\" first
+ESCAPE_SEQUENCES = sorted(((chr(code), escaped) for code, escaped in ESCAPES.items()),
+                          key=lambda pair: pair[0] != "\\")
+
+
+def iter_demographic_rows(path):
+    """
+        Yield one tuple of strings per patient (DEMOGRAPHIC_FIELDS order, "" when missing) from a
+        CSV file with a header row, or from an NDJSON file with one flat object per line.
+    """
+    path = Path(path)
+    with open(path, "r", newline="") as f:
+        if path.suffix.lower() == ".csv":
+            rows = csv.reader(f)
+            header = next(rows, [])
+            positions = [header.index(field) if field in header else None for field in DEMOGRAPHIC_FIELDS]
+            for row in rows:
+                yield tuple(row[position] if position is not None and position < len(row) else ""
+                            for position in positions)
+        else:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield tuple(f"{row.get(field) or ''}" for field in DEMOGRAPHIC_FIELDS)
+
+
+def patient_from_row(row):
+    """
+        The FHIR Patient of one demographics row, leaving out empty elements: the input of the
+        per-dict path (patient_transform.deidentify_patient, coding_task_5.extract_pid_fields).
+    """
+    values = dict(zip(DEMOGRAPHIC_FIELDS, row))
+    patient = {"resourceType": "Patient", "id": values["id"]}
+    name = {}
+    if values["family"]:
+        name["family"] = values["family"]
+    if values["given"]:
+        name["given"] = [values["given"]]
+    if name:
+        patient["name"] = [name]
+    if values["gender"]:
+        patient["gender"] = values["gender"]
+    if values["birthDate"]:
+        patient["birthDate"] = values["birthDate"]
+    address = {field: [values[field]] if field == "line" else values[field]
+               for field in ADDRESS_FIELDS if values[field]}
+    if address:
+        patient["address"] = [address]
+    return patient
+
+
+def escape_column(values):
+    """
+        er7_serializer.escape() over a string column. The escape character goes first,
+        so the backslashes the other replacements add are not escaped again.
+    """
+    # Delimiters are rare in names and addresses: one scan of the joined column finds the ones
+    # present, cheaper than a vectorized find (or replace) per delimiter
+    joined = "".join(values.tolist())
+    for character, escaped in ESCAPE_SEQUENCES:
+        if character in joined:
+            values = np.strings.replace(values, character, escaped)
+    return values
+
+
+class PatientColumns:
+    """
+        A chunk of demographics rows as columns, one per DEMOGRAPHIC_FIELDS entry: `values[field]`
+        holds the strings as read, and the NumPy string columns (attributes named like the fields,
+        postalCode as postal_code) are built once for the normalizations, which run once per column
+        instead of once per patient dict: the de-identification address rules (default district,
+        address text) for the FHIR load stage and the PID-3/5/7/8/11 fields for the ADT builder.
+        Results are identical to the per-dict path on patient_from_row().
+    """
+
+    def __init__(self, rows):
+        columns = list(zip(*rows)) or [()] * len(DEMOGRAPHIC_FIELDS)
+        self.values = dict(zip(DEMOGRAPHIC_FIELDS, columns))
+        (self.id, self.family, self.given, self.gender, self.birth_date, self.line, self.city, self.district,
+         self.state, self.postal_code) = (np.array(values, dtype=STRING) for values in columns)
+
+    def __len__(self):
+        return len(self.id)
+
+    def has_address(self):
+        present = np.zeros(len(self), dtype=bool)
+        for values in (self.line, self.city, self.district, self.state, self.postal_code):
+            present |= values != ""
+        return present
+
+    def filled_district(self):
+        """
+            District column after the de-identification rule: blank districts become DEFAULT_DISTRICT.
+        """
+        return np.where(self.district == "", DEFAULT_DISTRICT, self.district).astype(STRING)
+
+    def address_text(self, district):
+        """
+            "line city, district, state postalCode" for every row, vectorized.
+        """
+        return np.strings.strip(self.line + " " + self.city + ", " + district + ", " + self.state + " "
+                                + self.postal_code)
+
+    def iter_patients(self):
+        """
+            The de-identified Patient of every row, in input order: the same dicts as
+            patient_transform.deidentify_patient(patient_from_row(row)).
+        """
+        district = self.filled_district()
+        # Only district and text change; the other elements are taken as read
+        values = self.values
+        columns = (values["family"], values["given"], values["gender"], values["birthDate"], values["line"],
+                   values["city"], district.tolist(), values["state"], values["postalCode"],
+                   self.address_text(district).tolist(), self.has_address().tolist())
+        for family, given, gender, birth_date, line, city, district, state, postal_code, text, has_address in zip(
+                *columns):
+            patient = {"resourceType": "Patient"}
+            if family or given:
+                name = {"family": family} if family else {}
+                if given:
+                    name["given"] = [given]
+                patient["name"] = [name]
+            if gender:
+                patient["gender"] = gender
+            if birth_date:
+                patient["birthDate"] = birth_date
+            if has_address:
+                address = {"line": [line]} if line else {}
+                if city:
+                    address["city"] = city
+                address["district"] = district
+                if state:
+                    address["state"] = state
+                if postal_code:
+                    address["postalCode"] = postal_code
+                address["text"] = text
+                patient["address"] = [address]
+            yield patient
+
+    def pid_fields(self):
+        """
+            PID-3, PID-5, PID-7, PID-8 and PID-11 for every row as columns, the vectorized
+            counterpart of coding_task_5.extract_pid_fields().
+        """
+        return {
+            "patient_id": self.id,
+            "name": escape_column(self.family) + "^" + escape_column(self.given),
+            "birthdate": np.strings.replace(self.birth_date, "-", ""),
+            "gender": np.strings.upper(np.strings.slice(self.gender, 0, 1)),
+            "address": (escape_column(self.line) + "^^" + escape_column(self.city) + "^" + escape_column(self.state)
+                        + "^" + escape_column(self.postal_code) + "^^H"),
+        }
+
+    def iter_pid_fields(self):
+        """
+            One PID field dict per row, in input order, for coding_task_5.create_adt_message(pid_fields=...)
+            or er7_serializer.render_adt_a01().
+        """
+        # PID-3 is the id as read
+        columns = {name: self.values["id"] if name == "patient_id" else column.tolist()
+                   for name, column in self.pid_fields().items()}
+        names = tuple(columns)
+        for values in zip(*columns.values()):
+            yield dict(zip(names, values))
+
+
+def iter_patient_columns(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Read a demographics file as PatientColumns of at most chunk_size rows.
+    """
+    rows = iter_demographic_rows(path)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield PatientColumns(chunk)
+
+
+def write_patients(path, directory=ARTIFACT_DIR, chunk_size=DEFAULT_CHUNK_SIZE, stream=PATIENT_STREAM):
+    """
+        De-identify every Patient of a demographics file and write them as cohort records
+        ({"patient_id", "Patient"}) to the `stream` artifact stream, for bundle_loader.py.
+        Returns (number written, paths of the published parts).
+    """
+    count = 0
+    with ArtifactStore(directory) as store:
+        for columns in iter_patient_columns(path, chunk_size):
+            for patient_id, patient in zip(columns.values["id"], columns.iter_patients()):
+                store.write({"patient_id": patient_id, "Patient": patient}, stream=stream)
+                count += 1
+    return count, store.paths.get(stream, [])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Columnar de-identification of a demographics file")
+    parser.add_argument("demographics", help=f"CSV (with header) or NDJSON file of {', '.join(DEMOGRAPHIC_FIELDS)}")
+    parser.add_argument("--dir", default=ARTIFACT_DIR, help="Artifact directory (default: data/artifacts)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    print()
+    start = time.perf_counter()
+    count, paths = write_patients(args.demographics, args.dir, args.chunk_size)
+    elapsed = time.perf_counter() - start
+    print(f"De-identified {count} Patients in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f}/s)")
+    for path in paths:
+        print(f"Patients saved to: {path}")
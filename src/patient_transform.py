@@ -0,0 +1,89 @@
+SSN_SYSTEM_MARKER = "us-ssn"
+DEFAULT_DISTRICT = "Not found"
+
+# Rules applied to an OpenEMR Patient before it is created on the Primary Care EHR
+DEIDENTIFY_RULES = {
+    "drop_fields": ("id", "meta", "extension"),
+    "drop_identifier_systems": (SSN_SYSTEM_MARKER,),
+    "default_district": DEFAULT_DISTRICT,
+    "replace_blank_district": True,
+    "rebuild_address_text": True,
+}
+
+
+def compile_patient_transform(drop_fields=(), drop_identifier_systems=(), default_district=None,
+                              replace_blank_district=False, rebuild_address_text=False, profile=None):
+    """
+        Compile a rule set into a single function that modifies a Patient dict in place and returns it.
+        The rules are checked once here, so the returned function only runs the steps that are enabled.
+          - drop_fields: top-level elements to remove (e.g. id, meta, extension)
+          - drop_identifier_systems: identifiers whose system contains any of these markers are removed
+          - default_district: set on every address without a district (also on blank ones
+            when replace_blank_district is set)
+          - rebuild_address_text: address.text = "line city, district, state postalCode" for every address
+          - profile: meta.profile is set to [profile]
+    """
+    steps = []
+
+    if drop_fields:
+        def drop(patient):
+            for field in drop_fields:
+                patient.pop(field, None)
+        steps.append(drop)
+
+    if drop_identifier_systems:
+        markers = tuple(drop_identifier_systems)
+
+        def drop_identifiers(patient):
+            identifiers = patient.get("identifier")
+            if not identifiers:
+                return
+            # Compact the list in place instead of copying it
+            keep = 0
+            for identifier in identifiers:
+                system = identifier.get("system", "")
+                if not any(marker in system for marker in markers):
+                    identifiers[keep] = identifier
+                    keep += 1
+            del identifiers[keep:]
+            if not identifiers:
+                del patient["identifier"]
+        steps.append(drop_identifiers)
+
+    if default_district is not None or rebuild_address_text:
+        def fix_addresses(patient):
+            for address in patient.get("address") or ():
+                if default_district is not None:
+                    if "district" not in address or (replace_blank_district and not address["district"]):
+                        address["district"] = default_district
+                if rebuild_address_text:
+                    line = (address.get("line") or [""])[0]
+                    address["text"] = (f"{line} {address.get('city', '')}, {address.get('district', '')}, "
+                                       f"{address.get('state', '')} {address.get('postalCode', '')}").strip()
+        steps.append(fix_addresses)
+
+    if profile is not None:
+        def set_profile(patient):
+            patient.setdefault("meta", {})["profile"] = [profile]
+        steps.append(set_profile)
+
+    steps = tuple(steps)
+
+    def transform(patient):
+        for step in steps:
+            step(patient)
+        return patient
+
+    return transform
+
+
+def transform_patients(patients, transform):
+    """
+        Apply a compiled transform to a stream of Patient dicts, yielding each one
+        (modified in place) as soon as it is done.
+    """
+    for patient in patients:
+        yield transform(patient)
+
+
+deidentify_patient = compile_patient_transform(**DEIDENTIFY_RULES)
@@ -0,0 +1,478 @@
+import argparse
+import hashlib
+import json
+import re
+import tarfile
+import threading
+from pathlib import Path
+from src import http_client
+from src.registration import data_dir
+from src.http_client import PRIMARY_FHIR_URL
+from src.resource_templates import PATIENT_PROFILE_URL, CONDITION_PROFILE_URL, VITAL_SIGNS_PROFILE_URL
+
+# StructureDefinitions as published by the Primary FHIR server (or an IG package), compiled locally
+PROFILE_DIR = data_dir / "profiles"
+
+# Profiles the pipeline's resources declare
+PIPELINE_PROFILES = (PATIENT_PROFILE_URL, CONDITION_PROFILE_URL, VITAL_SIGNS_PROFILE_URL)
+
+# Relative (Type/id[/_history/vid]), absolute (base/Type/id), urn:uuid and contained (#id) references
+REFERENCE_PATTERN = re.compile(
+    r"^(?:(?:https?://\S+/)?(?P<type>[A-Z][A-Za-z]+)/[A-Za-z0-9\-.]{1,64}(?:/_history/[A-Za-z0-9\-.]{1,64})?"
+    r"|urn:uuid:[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+    r"|#[A-Za-z0-9\-.]*)$"
+)
+
+NO_ISSUES = {"severity": "information", "code": "informational",
+             "diagnostics": "No issues detected during validation"}
+
+
+def issue(severity, code, diagnostics, expression):
+    return {"severity": severity, "code": code, "diagnostics": diagnostics, "expression": [expression]}
+
+
+def operation_outcome(issues):
+    """
+        OperationOutcome for a list of issues, with the single information issue the
+        server returns when nothing was found.
+    """
+    return {"resourceType": "OperationOutcome", "issue": issues or [dict(NO_ISSUES)]}
+
+
+def parse_element_id(element_id):
+    """
+        Split an element id such as "Observation.category:VSCat.coding.system" into the id of the
+        innermost slice it belongs to ("Observation.category:VSCat", or None), the JSON keys below
+        that slice (or below the resource) and the slice name of the last segment (or None).
+        A type slice of a choice element (value[x]:valueQuantity) is not a slice: it becomes its
+        JSON key, valueQuantity.
+    """
+    segments = element_id.split(".")
+    keys, slice_names = [], []
+    for segment in segments[1:]:
+        name, _, slice_name = segment.partition(":")
+        if name.endswith("[x]") and slice_name.startswith(name[:-3]):
+            name, slice_name = slice_name, ""
+        keys.append(name)
+        slice_names.append(slice_name or None)
+    enclosing = None
+    for index in range(len(keys) - 2, -1, -1):
+        if slice_names[index] is not None:
+            enclosing, keys = ".".join(segments[:index + 2]), keys[index + 1:]
+            break
+    return enclosing, keys, slice_names[-1] if slice_names else None
+
+
+def children(expression, node, key):
+    """
+        (expression, value) pairs of one element of a dict: list items are indexed, and a
+        choice key such as onset[x] matches onsetDateTime, onsetPeriod, ...
+    """
+    if not isinstance(node, dict):
+        return []
+    if key.endswith("[x]"):
+        prefix = key[:-3]
+        names = [name for name in node if name.startswith(prefix) and name[len(prefix):][:1].isupper()]
+    else:
+        names = [key] if key in node else []
+    found = []
+    for name in names:
+        value = node[name]
+        if isinstance(value, list):
+            found.extend((f"{expression}.{name}[{i}]", item) for i, item in enumerate(value))
+        else:
+            found.append((f"{expression}.{name}", value))
+    return found
+
+
+def resolve(nodes, keys):
+    """
+        Every (expression, value) reached by following keys from each (expression, value) node.
+    """
+    for key in keys:
+        nodes = [child for expression, node in nodes for child in children(expression, node, key)]
+    return nodes
+
+
+def matches_pattern(value, pattern):
+    """
+        FHIR pattern[x] semantics: every element present in the pattern must appear in the value;
+        each item of a pattern list must be matched by some item of the value list.
+    """
+    if isinstance(pattern, dict) and isinstance(value, list):
+        # A pattern built from a slice's fixed children matches any repetition
+        return any(matches_pattern(item, pattern) for item in value)
+    if isinstance(pattern, dict):
+        return isinstance(value, dict) and all(matches_pattern(value.get(key), item) for key, item in pattern.items())
+    if isinstance(pattern, list):
+        return isinstance(value, list) and all(any(matches_pattern(v, item) for v in value) for item in pattern)
+    return value == pattern
+
+
+def prefixed(element, prefix):
+    """
+        (type suffix, value) of the element property starting with prefix, e.g. fixedUri, or None.
+    """
+    for name, value in element.items():
+        if name.startswith(prefix) and name[len(prefix):][:1].isupper():
+            return name[len(prefix):], value
+    return None
+
+
+def nest(keys, value):
+    """
+        {"coding": {"system": value}} for keys ["coding", "system"].
+    """
+    for key in reversed(keys):
+        value = {key: value}
+    return value
+
+
+def merge(pattern, addition):
+    for key, value in addition.items():
+        if isinstance(value, dict) and isinstance(pattern.get(key), dict):
+            merge(pattern[key], value)
+        else:
+            pattern[key] = value
+    return pattern
+
+
+def compile_cardinality(path, keys, minimum, maximum):
+    parent_keys, key = keys[:-1], keys[-1]
+
+    def check(nodes):
+        for expression, parent in resolve(nodes, parent_keys):
+            count = len(children(expression, parent, key))
+            # Reported on the element itself so issues group by element path
+            if count < minimum:
+                yield issue("error", "required", f"{path}: minimum required = {minimum}, but only found {count}",
+                            f"{expression}.{key}")
+            elif maximum is not None and count > maximum:
+                yield issue("error", "structure", f"{path}: max allowed = {maximum}, but found {count}",
+                            f"{expression}.{key}")
+    return check
+
+
+def compile_slice(path, keys, slice_name, minimum, maximum, pattern):
+    parent_keys, key = keys[:-1], keys[-1]
+
+    def check(nodes):
+        for expression, parent in resolve(nodes, parent_keys):
+            count = sum(1 for _, value in children(expression, parent, key) if matches_pattern(value, pattern))
+            if count < minimum:
+                yield issue("error", "required",
+                            f"{path}:{slice_name}: minimum required = {minimum}, but only found {count}",
+                            f"{expression}.{key}")
+            elif maximum is not None and count > maximum:
+                yield issue("error", "structure",
+                            f"{path}:{slice_name}: max allowed = {maximum}, but found {count}", f"{expression}.{key}")
+    return check
+
+
+def compile_fixed(path, keys, fixed):
+    def check(nodes):
+        for expression, value in resolve(nodes, keys):
+            if value != fixed:
+                yield issue("error", "value", f"Value is '{value}' but must be '{fixed}'", expression)
+    return check
+
+
+def compile_pattern(path, keys, pattern):
+    def check(nodes):
+        for expression, value in resolve(nodes, keys):
+            if not matches_pattern(value, pattern):
+                yield issue("error", "value", f"The value does not match the pattern required by {path}", expression)
+    return check
+
+
+def compile_reference(path, keys, target_types):
+    def check(nodes):
+        for expression, value in resolve(nodes, keys):
+            reference = value.get("reference") if isinstance(value, dict) else None
+            if reference is None:
+                continue
+            match = REFERENCE_PATTERN.match(reference)
+            if match is None:
+                yield issue("error", "invalid", f"Invalid reference format '{reference}'", f"{expression}.reference")
+            elif match.group("type") and target_types and match.group("type") not in target_types:
+                yield issue("error", "invalid",
+                            f"{path}: reference to {match.group('type')} is not allowed (allowed: "
+                            f"{', '.join(sorted(target_types))})", f"{expression}.reference")
+    return check
+
+
+def slice_members(keys, pattern):
+    """
+        Scope of the elements below a slice: the repetitions under keys that match its pattern.
+    """
+    def members(nodes):
+        return [(expression, value) for expression, value in resolve(nodes, keys) if matches_pattern(value, pattern)]
+    return members
+
+
+def within(scope, rule):
+    if scope is None:
+        return rule
+    return lambda nodes: rule(scope(nodes))
+
+
+class CompiledProfile:
+    """
+        Rules of one StructureDefinition, compiled once from its differential (or snapshot):
+        cardinality (min/max), fixed[x] and pattern[x] values (required codings and systems),
+        slices discriminated by value or pattern (given on the slice itself, by its fixed children
+        as in vitalsigns' VSCat, or by the profile of an extension slice), and Reference formats
+        and target types. Elements below a slice are checked on the repetitions in that slice.
+        Element properties outside that set are listed in `unsupported` and not checked.
+    """
+
+    def __init__(self, definition):
+        self.url = definition["url"]
+        self.version = definition.get("version")
+        self.type = definition["type"]
+        # Changes whenever the StructureDefinition content changes
+        self.digest = hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+        self.rules = []
+        self.unsupported = []
+        elements = (definition.get("differential") or definition.get("snapshot") or {}).get("element", [])
+        # Values fixed below a slice discriminate it, e.g. category:VSCat.coding.code = vital-signs
+        self._slice_patterns = {}
+        for element in elements:
+            enclosing, keys, _ = parse_element_id(element.get("id") or element["path"])
+            value = prefixed(element, "fixed") or prefixed(element, "pattern")
+            if enclosing is not None and value is not None:
+                merge(self._slice_patterns.setdefault(enclosing, {}), nest(keys, value[1]))
+        # Slice id -> scope function for the elements below it
+        self._scopes = {}
+        for element in elements:
+            self._compile(element)
+
+    def _slice_pattern(self, element_id, element):
+        pattern = prefixed(element, "pattern") or prefixed(element, "fixed")
+        if pattern is not None:
+            return pattern[1]
+        if element_id in self._slice_patterns:
+            return self._slice_patterns[element_id]
+        extension_profiles = [profile for type_ in element.get("type", []) if type_.get("code") == "Extension"
+                              for profile in type_.get("profile", [])]
+        if extension_profiles:
+            return {"url": extension_profiles[0]}
+        return None
+
+    def _compile(self, element):
+        path = element["path"]
+        element_id = element.get("id") or path
+        enclosing, keys, slice_name = parse_element_id(element_id)
+        if not keys:
+            return
+        if enclosing is not None and enclosing not in self._scopes:
+            # Below a slice that could not be compiled; the slice itself is reported
+            return
+        scope = self._scopes.get(enclosing)
+        minimum = element.get("min", 0)
+        maximum = element.get("max")
+        maximum = None if maximum in (None, "*") else int(maximum)
+        fixed = prefixed(element, "fixed")
+        pattern = prefixed(element, "pattern")
+
+        if slice_name is not None:
+            slice_pattern = self._slice_pattern(element_id, element)
+            if slice_pattern is None:
+                self.unsupported.append(f"{element_id} (slice without a value or pattern discriminator)")
+                return
+            self.rules.append(within(scope, compile_slice(path, keys, slice_name, minimum, maximum, slice_pattern)))
+            members = slice_members(keys, slice_pattern)
+            self._scopes[element_id] = members if scope is None else (lambda nodes: members(scope(nodes)))
+            return
+        if minimum or maximum is not None:
+            self.rules.append(within(scope, compile_cardinality(path, keys, minimum, maximum)))
+        if fixed is not None:
+            self.rules.append(within(scope, compile_fixed(path, keys, fixed[1])))
+        if pattern is not None:
+            self.rules.append(within(scope, compile_pattern(path, keys, pattern[1])))
+        targets = {profile.rsplit("/", 1)[-1] for type_ in element.get("type", []) if type_.get("code") == "Reference"
+                   for profile in type_.get("targetProfile", [])}
+        if any(type_.get("code") == "Reference" for type_ in element.get("type", [])):
+            self.rules.append(within(scope, compile_reference(path, keys, targets)))
+        for name in element:
+            if name in ("binding", "constraint") or name.startswith("maxLength"):
+                self.unsupported.append(f"{element_id} ({name})")
+
+    def validate(self, resource):
+        """
+            Issues (OperationOutcome.issue dicts) of a resource against this profile.
+        """
+        if resource.get("resourceType") != self.type:
+            return [issue("error", "invalid",
+                          f"Profile {self.url} applies to {self.type}, not {resource.get('resourceType')}",
+                          resource.get("resourceType", ""))]
+        nodes = [(self.type, resource)]
+        return [found for rule in self.rules for found in rule(nodes)]
+
+
+def load_profiles(directory=PROFILE_DIR):
+    """
+        Compile every StructureDefinition JSON file of a directory. Returns {url: CompiledProfile}.
+    """
+    profiles = {}
+    for path in sorted(Path(directory).glob("*.json")):
+        with open(path) as f:
+            definition = json.load(f)
+        if definition.get("resourceType") == "StructureDefinition":
+            profile = CompiledProfile(definition)
+            profiles[profile.url] = profile
+    return profiles
+
+
+def save_definition(definition, directory=PROFILE_DIR):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{definition.get('id') or definition['url'].rsplit('/', 1)[-1]}.json"
+    with open(path, "w") as f:
+        json.dump(definition, f, indent=2)
+    return path
+
+
+def fetch_profile(url, base_url=PRIMARY_FHIR_URL, directory=PROFILE_DIR):
+    """
+        Download the StructureDefinition with this canonical url from the FHIR server
+        (StructureDefinition?url=...) and save it to directory. Returns it, or None.
+    """
+    response = http_client.get(url=f"{base_url}/StructureDefinition", params={"url": url},
+                               headers={"Accept": "application/fhir+json"})
+    if response.status_code != 200:
+        print(f"Error when fetching the StructureDefinition {url}: {response.status_code}")
+        return None
+    for entry in response.json().get("entry", []):
+        definition = entry.get("resource", {})
+        if definition.get("resourceType") == "StructureDefinition" and definition.get("url") == url:
+            print(f"StructureDefinition {url} saved to: {save_definition(definition, directory)}")
+            return definition
+    print(f"StructureDefinition {url} not found on {base_url}")
+    return None
+
+
+def import_package(package_path, urls=None, directory=PROFILE_DIR):
+    """
+        Save the profiles (constraint StructureDefinitions) of a FHIR NPM package (.tgz, e.g. an IG
+        or hl7.fhir.r4.core for vitalsigns) to directory; only those in urls when given.
+        Returns the urls imported.
+    """
+    imported = []
+    with tarfile.open(package_path, "r:gz") as package:
+        for member in package:
+            if not (member.isfile() and member.name.startswith("package/") and member.name.endswith(".json")):
+                continue
+            definition = json.load(package.extractfile(member))
+            if (definition.get("resourceType") != "StructureDefinition"
+                    or definition.get("derivation") != "constraint"
+                    or (urls and definition.get("url") not in urls)):
+                continue
+            save_definition(definition, directory)
+            imported.append(definition["url"])
+    return imported
+
+
+_profiles = None
+_missing = set()
+_profiles_lock = threading.Lock()
+
+
+def get_profiles():
+    """
+        Return the profiles of PROFILE_DIR, compiling them on first use.
+    """
+    global _profiles
+    if _profiles is None:
+        with _profiles_lock:
+            if _profiles is None:
+                _profiles = load_profiles()
+    return _profiles
+
+
+def get_profile(url):
+    """
+        Compiled profile for a canonical url. A profile not in PROFILE_DIR is fetched from the
+        Primary FHIR server once; returns None if it is not available there either.
+    """
+    profiles = get_profiles()
+    if url in profiles or url in _missing:
+        return profiles.get(url)
+    with _profiles_lock:
+        if url not in profiles and url not in _missing:
+            definition = fetch_profile(url)
+            if definition is None:
+                _missing.add(url)
+            else:
+                profiles[url] = CompiledProfile(definition)
+    return profiles.get(url)
+
+
+def declared_profiles(resource, profiles=None):
+    """
+        (url, CompiledProfile or None) for every meta.profile of a resource.
+    """
+    lookup = get_profile if profiles is None else profiles.get
+    return [(url.split("|")[0], lookup(url.split("|")[0]))
+            for url in (resource.get("meta") or {}).get("profile", [])]
+
+
+def validate(resource, profiles=None):
+    """
+        Validate a resource against the local profiles named in its meta.profile.
+        Returns an OperationOutcome like the server's $validate. A profile that is not
+        available locally or on the server gives a warning issue instead of being checked.
+    """
+    issues = []
+    for url, profile in declared_profiles(resource, profiles):
+        if profile is None:
+            issues.append(issue("warning", "not-supported",
+                                f"Profile reference '{url}' has not been checked because it is not known locally",
+                                resource.get("resourceType", "")))
+        else:
+            issues.extend(profile.validate(resource))
+    return operation_outcome(issues)
+
+
+def has_errors(outcome):
+    return any(found["severity"] in ("error", "fatal") for found in outcome.get("issue", []))
+
+
+def is_unchecked(outcome):
+    """
+        True if a declared profile could not be checked (not available locally).
+    """
+    return any(found["code"] == "not-supported" for found in outcome.get("issue", []))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validate FHIR resources against compiled StructureDefinitions")
+    subparsers = parser.add_subparsers(dest="command")
+    fetch_parser = subparsers.add_parser("fetch", help="Download profiles from the Primary FHIR server")
+    fetch_parser.add_argument("urls", nargs="*", default=PIPELINE_PROFILES, help="Canonical urls (default: the pipeline's)")
+    fetch_parser.add_argument("--base-url", default=PRIMARY_FHIR_URL, help="FHIR server base url")
+    import_parser = subparsers.add_parser("import", help="Import profiles from a FHIR package (.tgz)")
+    import_parser.add_argument("package", help="FHIR NPM package, e.g. an IG's package.tgz")
+    import_parser.add_argument("--all", action="store_true", help="Import every profile, not only the pipeline's")
+    validate_parser = subparsers.add_parser("validate", help="Validate resource JSON files")
+    validate_parser.add_argument("files", nargs="+", help="Resource JSON files to validate")
+    args = parser.parse_args()
+
+    print()
+    if args.command == "fetch":
+        for url in args.urls:
+            fetch_profile(url, base_url=args.base_url)
+    elif args.command == "import":
+        for url in import_package(args.package, urls=None if args.all else PIPELINE_PROFILES):
+            print(f"Imported {url}")
+    elif args.command == "validate":
+        for file_name in args.files:
+            with open(file_name) as f:
+                print(json.dumps(validate(json.load(f)), indent=2))
+    else:
+        for profile in get_profiles().values():
+            print(f"{profile.url}|{profile.version}: {len(profile.rules)} rules")
+            for unsupported in profile.unsupported:
+                print(f"  not checked: {unsupported}")
+        for url in [url for url in PIPELINE_PROFILES if url not in get_profiles()]:
+            print(f"{url}: not available locally (python -m src.profile_validator fetch)")
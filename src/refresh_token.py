@@ -1,6 +1,6 @@
 from pathlib import Path
 import json
-import requests
+from src import http_client
 from src.registration import get_client_id_from_file, data_dir, TOKEN_URL
 
 
@@ -43,7 +43,11 @@ def get_headers():
 
 
 def renew_access_token():
-    response = requests.request(method="POST", url=TOKEN_URL, data=get_payload(), headers=get_headers())
+    """
+        Exchange the refresh token for a new access token and save it to access_token.json.
+        Returns the token response (dict), or None if the token endpoint returned an error.
+    """
+    response = http_client.post(url=TOKEN_URL, data=get_payload(), headers=get_headers())
     if response.status_code == 200:
         access_token_path = Path(data_dir / "access_token.json")
         access_token_path.touch(exist_ok=True)
@@ -51,9 +55,11 @@ def renew_access_token():
             json.dump(response.json(), f, ensure_ascii=False, indent=4)
         print(f'New access token generated and saved to {access_token_path.name}')
         print(f"access_token:{response.json().get('access_token')}")
+        return response.json()
     else:
         print(f"Error when trying to generate access token: {response.status_code}")
         print(f"Error: {response.json()}")
+        return None
 
 
 if __name__ == '__main__':
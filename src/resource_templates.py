@@ -0,0 +1,255 @@
+import copy
+import json
+
+PATIENT_PROFILE_URL = "http://example.org/StructureDefinition/my-patient-profile"
+CONDITION_PROFILE_URL = "http://example.org/StructureDefinition/my-condition-profile"
+VITAL_SIGNS_PROFILE_URL = "http://hl7.org/fhir/StructureDefinition/vitalsigns"
+
+
+class Slot:
+    """
+        Placeholder for a per-resource value in a template skeleton.
+        `format` (e.g. "Patient/{}") is applied to the value when the resource is built.
+    """
+    __slots__ = ("name", "format")
+
+    def __init__(self, name, format=None):
+        self.name = name
+        self.format = format
+
+
+class ResourceTemplate:
+    """
+        A resource skeleton compiled once: every subtree without a Slot is built a single
+        time and shared by reference between all resources the template produces, and
+        build() only allocates the containers that lead to a slot.
+
+        Shared subtrees must not be modified in place. Use thaw() on a built resource
+        before mutating it; verify() checks that no shared subtree has been changed.
+        share_constants=False rebuilds every container on each call, like a dict literal.
+    """
+
+    def __init__(self, skeleton, share_constants=True):
+        self.share_constants = share_constants
+        self._shared = []
+        constant, value = self._compile(copy.deepcopy(skeleton))
+        if constant:
+            raise ValueError("A resource template needs at least one Slot")
+        self._build = value
+        self._snapshots = [json.dumps(subtree, sort_keys=True) for subtree in self._shared]
+
+    def _compile(self, node):
+        """
+            Returns (True, node) for a constant subtree, or (False, builder) where
+            builder(values) creates the subtree for one resource.
+        """
+        if isinstance(node, Slot):
+            name, fmt = node.name, node.format
+            if fmt is None:
+                return False, lambda values: values[name]
+            return False, lambda values: fmt.format(values[name])
+        if isinstance(node, dict):
+            items = tuple((key,) + self._compile(value) for key, value in node.items())
+            if self.share_constants and all(constant for _, constant, _ in items):
+                return True, node
+            self._share(value for _, constant, value in items if constant)
+            items = tuple((key, value if constant else None, None if constant else value)
+                          for key, constant, value in items)
+            return False, lambda values: {key: value if build is None else build(values)
+                                          for key, value, build in items}
+        if isinstance(node, list):
+            items = tuple(self._compile(value) for value in node)
+            if self.share_constants and all(constant for constant, _ in items):
+                return True, node
+            self._share(value for constant, value in items if constant)
+            items = tuple((value if constant else None, None if constant else value) for constant, value in items)
+            return False, lambda values: [value if build is None else build(values) for value, build in items]
+        return True, node
+
+    def _share(self, subtrees):
+        self._shared.extend(subtree for subtree in subtrees if isinstance(subtree, (dict, list)))
+
+    def build(self, **values):
+        """
+            Build one resource, filling every Slot from the keyword arguments.
+        """
+        return self._build(values)
+
+    def verify(self):
+        """
+            True if none of the shared constant subtrees has been modified since compilation.
+        """
+        return all(json.dumps(subtree, sort_keys=True) == snapshot
+                   for subtree, snapshot in zip(self._shared, self._snapshots))
+
+
+def thaw(resource):
+    """
+        Fully independent copy of a templated resource, safe to modify in place.
+    """
+    return copy.deepcopy(resource)
+
+
+CONDITION_SKELETON = {
+    "resourceType": "Condition",
+    "text": {
+        "status": "generated",
+        "div": Slot("display", '<div xmlns="http://www.w3.org/1999/xhtml"><p>{}</p></div>'),
+    },
+    "clinicalStatus": {
+        "coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/condition-clinical",
+            "code": "active",
+            "display": "Active",
+        }]
+    },
+    "verificationStatus": {
+        "coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status",
+            "code": "confirmed",
+            "display": "Confirmed",
+        }]
+    },
+    "category": [{
+        "coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/condition-category",
+            "code": "encounter-diagnosis",
+            "display": "Encounter Diagnosis",
+        }]
+    }],
+    "code": {
+        "coding": [{"system": "http://snomed.info/sct", "code": Slot("code"), "display": Slot("display")}],
+        "text": Slot("display"),
+    },
+    "severity": {
+        "coding": [{"system": "http://snomed.info/sct", "code": "24484000", "display": "Severe"}],
+        "text": "Severe",
+    },
+    "bodySite": [{
+        "coding": [{
+            "system": "http://snomed.info/sct",
+            "code": "34508005",
+            "display": "Structure of mucous membrane of nose",
+        }],
+        "text": "Mucous membrane of nose",
+    }],
+    "onsetDateTime": Slot("onset"),
+    "subject": {"reference": Slot("patient_id", "Patient/{}")},
+}
+CONDITION_TEMPLATE = ResourceTemplate(CONDITION_SKELETON)
+
+
+def interpretation(code, display, text):
+    return [{
+        "coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation",
+            "code": code,
+            "display": display,
+        }],
+        "text": text,
+    }]
+
+
+# Interpretation elements by code (N normal, H high, L low), shared by every Observation like template constants
+PANEL_INTERPRETATIONS = {
+    "N": interpretation("N", "Normal", "Normal"),
+    "H": interpretation("H", "High", "High"),
+    "L": interpretation("L", "Low", "Low"),
+}
+COMPONENT_INTERPRETATIONS = {
+    "N": interpretation("N", "normal", "Normal"),
+    "H": interpretation("H", "high", "High"),
+    "L": interpretation("L", "low", "Low"),
+}
+
+
+def blood_pressure_component(loinc_code, snomed_code, display, value_slot):
+    return {
+        "code": {
+            "coding": [
+                {"system": "http://loinc.org", "code": loinc_code, "display": display},
+                {"system": "http://snomed.info/sct", "code": snomed_code, "display": display},
+            ]
+        },
+        "valueQuantity": {
+            "value": Slot(value_slot),
+            "unit": "mmHg",
+            "system": "http://unitsofmeasure.org",
+            "code": "mm[Hg]",
+        },
+        "interpretation": Slot(f"{value_slot}_interpretation"),
+    }
+
+
+BLOOD_PRESSURE_TEMPLATE = ResourceTemplate({
+    "resourceType": "Observation",
+    "meta": {"profile": [VITAL_SIGNS_PROFILE_URL]},
+    "identifier": [{"system": "urn:ietf:rfc:3986", "value": Slot("identifier")}],
+    "status": "final",
+    "category": [{
+        "coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/observation-category",
+            "code": "vital-signs",
+            "display": "Vital Signs",
+        }]
+    }],
+    "code": {
+        "coding": [{
+            "system": "http://loinc.org",
+            "code": "85354-9",
+            "display": "Blood pressure panel with all children optional",
+        }],
+        "text": "Blood pressure systolic & diastolic",
+    },
+    "subject": {"reference": Slot("patient_id", "Patient/{}")},
+    "performer": [{"reference": "Practitioner/8", "display": "Dr. Careful"}],
+    "effectiveDateTime": Slot("effective"),
+    "interpretation": Slot("interpretation"),
+    "bodySite": {
+        "coding": [{"system": "http://snomed.info/sct", "code": "368209003", "display": "Right arm"}]
+    },
+    "component": [
+        blood_pressure_component("8480-6", "271649006", "Systolic blood pressure", "systolic"),
+        blood_pressure_component("8462-4", "271650006", "Diastolic blood pressure", "diastolic"),
+    ],
+})
+
+
+
+def build_blood_pressure(patient_id, identifier, effective, systolic, diastolic,
+                         systolic_code="N", diastolic_code="N", panel_code="N"):
+    """
+        Blood pressure panel Observation with the given values and N/H/L interpretation codes.
+    """
+    return BLOOD_PRESSURE_TEMPLATE.build(
+        patient_id=patient_id, identifier=identifier, effective=effective,
+        systolic=systolic, diastolic=diastolic,
+        interpretation=PANEL_INTERPRETATIONS[panel_code],
+        systolic_interpretation=COMPONENT_INTERPRETATIONS[systolic_code],
+        diastolic_interpretation=COMPONENT_INTERPRETATIONS[diastolic_code],
+    )
+
+
+IMMUNOTHERAPY_PROCEDURE_TEMPLATE = ResourceTemplate({
+    "resourceType": "Procedure",
+    "meta": {"versionId": "1"},
+    "text": {
+        "status": "generated",
+        "div": (
+            '<div xmlns="http://www.w3.org/1999/xhtml">'
+            "Subcutaneous allergen immunotherapy for perennial allergic rhinitis"
+            "</div>"
+        ),
+    },
+    "status": "completed",
+    "code": {
+        "coding": [{"system": "http://snomed.info/sct", "code": "180256009", "display": "Subcutaneous immunotherapy"}],
+        "text": "Subcutaneous immunotherapy",
+    },
+    "subject": {"reference": Slot("patient_id", "Patient/{}")},
+    "performedDateTime": Slot("performed"),
+    "performer": [{"actor": {"reference": "Practitioner/8", "display": "Dr. Careful"}}],
+    "reasonCode": [{"concept": {"text": "Perennial allergic rhinitis not controlled with medication"}}],
+    "followUp": [{"text": "Follow-up visit in 4 weeks"}],
+    "note": [{"text": "First dose of maintenance allergen immunotherapy administered without complications."}],
+})
@@ -0,0 +1,81 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+DEFAULT_MAX_ENTRIES = 4096
+
+
+def auth_scope(headers):
+    """
+        Short fingerprint of the Authorization header, so responses fetched with
+        one token are never replayed for another.
+    """
+    authorization = (headers or {}).get("Authorization")
+    if not authorization:
+        return ""
+    return hashlib.sha256(authorization.encode()).hexdigest()[:16]
+
+
+class RunMemo:
+    """
+        Run-scoped memoization of idempotent GETs, keyed by url, query params and auth scope.
+        Concurrent requests for the same key share one network call (single flight).
+        Only 200 responses are kept; the least recently used entries are dropped
+        once max_entries is reached.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.requests = 0
+        self.saved = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, headers=None, params=None):
+        return url, repr(sorted(params.items())) if params else "", auth_scope(headers)
+
+    def get_or_fetch(self, key, fetch):
+        """
+            Return the memoized response for `key`, or call fetch() once and remember its result.
+        """
+        with self._lock:
+            self.requests += 1
+            future = self._entries.get(key)
+            if future is not None:
+                self._entries.move_to_end(key)
+                self.saved += 1
+                owner = False
+            else:
+                future = Future()
+                self._entries[key] = future
+                owner = True
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if not owner:
+            return future.result()
+
+        try:
+            response = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            self._forget(key, future)
+            raise
+        future.set_result(response)
+        if response.status_code != 200:
+            self._forget(key, future)
+        return response
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._entries.get(key) is future:
+                del self._entries[key]
+
+    def report(self):
+        """
+            Print how many GETs were answered from the memo instead of the network.
+        """
+        network_calls = self.requests - self.saved
+        print(f"Run memoization: {self.requests} GET requests, {network_calls} network calls, "
+              f"{self.saved} saved")
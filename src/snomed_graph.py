@@ -0,0 +1,271 @@
+import argparse
+import csv
+import json
+import time
+from collections import deque
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+from src.registration import data_dir
+
+GRAPH_DIR = data_dir / "snomed_graph"
+IS_A_TYPE_ID = "116680003"
+SYNONYM_TYPE_ID = "900000000000013009"
+PREFERRED_ACCEPTABILITY_ID = "900000000000548007"
+
+# Constraint operators answered locally: >! parents, <! children, > ancestors, < descendants
+GRAPH_EXPRESSIONS = (">!", "<!", ">", "<")
+
+GRAPH_ARRAYS = ("concept_ids", "parent_indptr", "parent_indices", "child_indptr", "child_indices",
+                "term_offsets", "term_blob")
+
+# Written next to the arrays: the RF2 release (latest effectiveTime, YYYYMMDD) the graph was built from
+METADATA_FILE = "metadata.json"
+
+
+def read_rf2(path):
+    """
+        Yield the active rows of an RF2 snapshot file as dicts.
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if row["active"] == "1":
+                yield row
+
+
+def read_preferred_terms(descriptions_path, language_refset_path=None):
+    """
+        Map concept id -> preferred term. With a language refset the synonym marked
+        preferred is used; otherwise the first active synonym of each concept.
+    """
+    preferred_ids = None
+    if language_refset_path:
+        preferred_ids = {row["referencedComponentId"] for row in read_rf2(language_refset_path)
+                         if row["acceptabilityId"] == PREFERRED_ACCEPTABILITY_ID}
+    terms = {}
+    for row in read_rf2(descriptions_path):
+        if row["typeId"] != SYNONYM_TYPE_ID:
+            continue
+        concept_id = int(row["conceptId"])
+        if preferred_ids is not None:
+            if row["id"] in preferred_ids:
+                terms[concept_id] = row["term"]
+        else:
+            terms.setdefault(concept_id, row["term"])
+    return terms
+
+
+def build_csr(row_indices, column_indices, size):
+    """
+        Compressed sparse row arrays (indptr, indices) for the edges row -> column.
+    """
+    order = np.argsort(row_indices, kind="stable")
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_indices, minlength=size), out=indptr[1:])
+    return indptr, column_indices[order].astype(np.int32)
+
+
+def build_graph(relationships_path, descriptions_path=None, language_refset_path=None, graph_dir=GRAPH_DIR):
+    """
+        Load the active is-a relationships of an RF2 relationship snapshot into
+        integer-indexed CSR arrays (parents and children of every concept) and save them,
+        together with the preferred terms, as .npy files that can be memory-mapped.
+        The release (the latest effectiveTime of the is-a rows) is saved in metadata.json.
+        Returns the number of concepts.
+    """
+    sources, destinations = [], []
+    release = ""
+    for row in read_rf2(relationships_path):
+        if row["typeId"] == IS_A_TYPE_ID:
+            sources.append(int(row["sourceId"]))
+            destinations.append(int(row["destinationId"]))
+            release = max(release, row["effectiveTime"])
+    sources = np.array(sources, dtype=np.int64)
+    destinations = np.array(destinations, dtype=np.int64)
+
+    terms = read_preferred_terms(descriptions_path, language_refset_path) if descriptions_path else {}
+    concept_ids = np.unique(np.concatenate([sources, destinations, np.array(list(terms), dtype=np.int64)]))
+    source_index = np.searchsorted(concept_ids, sources)
+    destination_index = np.searchsorted(concept_ids, destinations)
+    parent_indptr, parent_indices = build_csr(source_index, destination_index, len(concept_ids))
+    child_indptr, child_indices = build_csr(destination_index, source_index, len(concept_ids))
+
+    encoded = [terms.get(int(concept_id), "").encode("utf-8") for concept_id in concept_ids]
+    term_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(term) for term in encoded], out=term_offsets[1:])
+    term_blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    graph_dir = Path(graph_dir)
+    graph_dir.mkdir(parents=True, exist_ok=True)
+    arrays = dict(zip(GRAPH_ARRAYS, (concept_ids, parent_indptr, parent_indices, child_indptr, child_indices,
+                                     term_offsets, term_blob)))
+    for name, array in arrays.items():
+        np.save(graph_dir / f"{name}.npy", array)
+    with open(graph_dir / METADATA_FILE, "w") as f:
+        json.dump({"release": release or None, "concepts": len(concept_ids)}, f)
+    return len(concept_ids)
+
+
+class SnomedGraph:
+    """
+        In-process SNOMED CT is-a hierarchy over memory-mapped CSR arrays.
+        Parents/children are direct slices; ancestor and descendant sets (the transitive
+        closure) are built lazily by breadth-first search and memoized per concept.
+    """
+
+    def __init__(self, graph_dir=GRAPH_DIR, closure_cache_size=65536):
+        arrays = {name: np.load(Path(graph_dir) / f"{name}.npy", mmap_mode="r") for name in GRAPH_ARRAYS}
+        self.concept_ids = arrays["concept_ids"]
+        self._parent_indptr = arrays["parent_indptr"]
+        self._parent_indices = arrays["parent_indices"]
+        self._child_indptr = arrays["child_indptr"]
+        self._child_indices = arrays["child_indices"]
+        self._term_offsets = arrays["term_offsets"]
+        self._term_blob = arrays["term_blob"]
+        self._ancestors = lru_cache(maxsize=closure_cache_size)(self._closure_of_parents)
+        self._descendants = lru_cache(maxsize=closure_cache_size)(self._closure_of_children)
+        # Graphs built before metadata.json was written do not know their release
+        metadata_path = Path(graph_dir) / METADATA_FILE
+        self.release = None
+        if metadata_path.exists():
+            with open(metadata_path, "r") as f:
+                self.release = json.load(f).get("release")
+
+    def index_of(self, concept_id):
+        """
+            Row index of a concept id, or None if the concept is not in the graph
+            (including ids that are not SNOMED identifiers at all, e.g. "abc").
+        """
+        if not f"{concept_id}".isdigit():
+            return None
+        concept_id = int(concept_id)
+        position = int(np.searchsorted(self.concept_ids, concept_id))
+        if position < len(self.concept_ids) and self.concept_ids[position] == concept_id:
+            return position
+        return None
+
+    def has(self, concept_id):
+        """
+            True if the concept is in the graph (the release it was built from knows it).
+        """
+        return self.index_of(concept_id) is not None
+
+    @property
+    def has_terms(self):
+        """
+            True if the graph was built with descriptions, so answers carry preferred terms.
+        """
+        return len(self._term_blob) > 0
+
+    def term(self, index):
+        start, end = self._term_offsets[index], self._term_offsets[index + 1]
+        return bytes(self._term_blob[start:end]).decode("utf-8")
+
+    def _parents(self, index):
+        return self._parent_indices[self._parent_indptr[index]:self._parent_indptr[index + 1]]
+
+    def _children(self, index):
+        return self._child_indices[self._child_indptr[index]:self._child_indptr[index + 1]]
+
+    def _closure(self, index, neighbours):
+        seen = set()
+        queue = deque([index])
+        while queue:
+            for neighbour in neighbours(queue.popleft()).tolist():
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    queue.append(neighbour)
+        return np.array(sorted(seen), dtype=np.int32)
+
+    def _closure_of_parents(self, index):
+        return self._closure(index, self._parents)
+
+    def _closure_of_children(self, index):
+        return self._closure(index, self._children)
+
+    def _ids(self, indices):
+        return [int(self.concept_ids[index]) for index in indices]
+
+    def parents(self, concept_id):
+        index = self.index_of(concept_id)
+        return [] if index is None else self._ids(self._parents(index))
+
+    def children(self, concept_id):
+        index = self.index_of(concept_id)
+        return [] if index is None else self._ids(self._children(index))
+
+    def ancestors(self, concept_id):
+        index = self.index_of(concept_id)
+        return [] if index is None else self._ids(self._ancestors(index))
+
+    def descendants(self, concept_id):
+        index = self.index_of(concept_id)
+        return [] if index is None else self._ids(self._descendants(index))
+
+    def subsumes(self, ancestor_id, concept_id):
+        """
+            True if `ancestor_id` is `concept_id` itself or one of its ancestors.
+        """
+        ancestor, index = self.index_of(ancestor_id), self.index_of(concept_id)
+        if ancestor is None or index is None:
+            return False
+        if ancestor == index:
+            return True
+        ancestors = self._ancestors(index)
+        position = int(np.searchsorted(ancestors, ancestor))
+        return position < len(ancestors) and ancestors[position] == ancestor
+
+    def constraint(self, expression, code):
+        """
+            Answer the Hermes constraint searches the pipeline uses, without a network call:
+            ">!" parents, "<!" children, ">" ancestors, "<" descendants of `code`.
+            Returns a Hermes-style list of {"conceptId", "preferredTerm"} dicts.
+        """
+        index = self.index_of(code)
+        if index is None:
+            return []
+        operators = {">!": self._parents, "<!": self._children, ">": self._ancestors, "<": self._descendants}
+        indices = operators[expression](index).tolist()
+        return [{"conceptId": str(int(self.concept_ids[i])), "preferredTerm": self.term(i)} for i in indices]
+
+
+_graph = None
+
+
+def get_snomed_graph(graph_dir=GRAPH_DIR):
+    """
+        Return the shared SnomedGraph, or None if no graph has been built yet.
+    """
+    global _graph
+    if _graph is None and (Path(graph_dir) / "concept_ids.npy").exists():
+        _graph = SnomedGraph(graph_dir)
+    return _graph
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local SNOMED CT is-a hierarchy engine")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Build the graph from RF2 snapshot files")
+    build.add_argument("relationships", help="sct2_Relationship_Snapshot_*.txt")
+    build.add_argument("--descriptions", help="sct2_Description_Snapshot-en_*.txt, for preferred terms")
+    build.add_argument("--language-refset", help="der2_cRefset_LanguageSnapshot-en_*.txt, to pick preferred synonyms")
+    query = subparsers.add_parser("query", help="Run a constraint: >! parents, <! children, > ancestors, < descendants")
+    query.add_argument("expression", choices=GRAPH_EXPRESSIONS)
+    query.add_argument("code")
+    args = parser.parse_args()
+
+    print()
+    if args.command == "build":
+        count = build_graph(args.relationships, args.descriptions, args.language_refset)
+        print(f"Wrote is-a graph with {count} concepts to {GRAPH_DIR}")
+    else:
+        start = time.perf_counter()
+        graph = get_snomed_graph()
+        if graph is None:
+            print(f"No graph found at {GRAPH_DIR}; run the build command first")
+        else:
+            results = graph.constraint(args.expression, args.code)
+            elapsed = time.perf_counter() - start
+            for result in results:
+                print(f"{result['conceptId']} | {result['preferredTerm']}")
+            print(f"{len(results)} concepts in {elapsed * 1000:.2f} ms (including load)")
@@ -0,0 +1,164 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlparse
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+        Serves canned responses from server.routes, keyed by (method, path).
+        A route is either a (status, headers, body) tuple or a callable
+        handler(request_handler) returning that tuple. dict/list bodies are sent as JSON.
+        Speaks HTTP/1.1 so clients can keep connections alive.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.request_body = self.rfile.read(length) if length else b""
+        route = self.server.routes.get((method, urlparse(self.path).path))
+        if route is None:
+            status, headers, body = 404, {}, {"resourceType": "OperationOutcome"}
+        elif callable(route):
+            status, headers, body = route(self)
+        else:
+            status, headers, body = route
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers = {"Content-Type": "application/fhir+json", **headers}
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond("GET")
+
+    def do_POST(self):
+        self._respond("POST")
+
+    def do_PUT(self):
+        self._respond("PUT")
+
+    def do_DELETE(self):
+        self._respond("DELETE")
+
+
+def start_stub_server(routes=None):
+    """
+        Start a local stub HTTP server on a free port in a background thread.
+        Returns (server, base_url); call server.shutdown() when done.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.routes = routes if routes is not None else {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_bulk_export_stub(resources_by_type, pending_polls=1, group_ids=("1",)):
+    """
+        Start a stub FHIR Bulk Data server with kick-off urls for every export level
+        (/$export, /Patient/$export and /Group/{id}/$export for each of `group_ids`),
+        a status url that answers 202 `pending_polls` times before returning the manifest,
+        and one NDJSON file per resource type. The kick-off urls requested are kept in
+        server.kickoffs. Returns (server, base_url).
+    """
+    server, base_url = start_stub_server()
+    server.kickoffs = []
+    polls = {"count": 0}
+
+    def kickoff(handler):
+        server.kickoffs.append(handler.path)
+        return 202, {"Content-Location": f"{base_url}/export-status/1"}, b""
+
+    def status(handler):
+        if polls["count"] < pending_polls:
+            polls["count"] += 1
+            return 202, {"Retry-After": "0", "X-Progress": f"poll {polls['count']}"}, b""
+        manifest = {
+            "transactionTime": "2025-12-10T00:00:00Z",
+            "request": f"{base_url}/$export",
+            "requiresAccessToken": True,
+            "output": [{"type": resource_type, "url": f"{base_url}/export-files/{resource_type}.ndjson"}
+                       for resource_type in resources_by_type],
+            "error": [],
+        }
+        return 200, {}, manifest
+
+    server.routes[("GET", "/$export")] = kickoff
+    server.routes[("GET", "/Patient/$export")] = kickoff
+    for group_id in group_ids:
+        server.routes[("GET", f"/Group/{group_id}/$export")] = kickoff
+    server.routes[("GET", "/export-status/1")] = status
+    for resource_type, resources in resources_by_type.items():
+        body = "".join(json.dumps(resource) + "\n" for resource in resources)
+        server.routes[("GET", f"/export-files/{resource_type}.ndjson")] = (
+            200, {"Content-Type": "application/fhir+ndjson"}, body)
+    return server, base_url
+
+
+def start_bundle_stub():
+    """
+        Start a stub FHIR server that processes transaction and batch Bundles POSTed to its base
+        like a real server: every entry gets an id, ifNoneExist (identifier=system|value) matches
+        resources created before (200) instead of creating them again (201), and in a transaction
+        every reference to an entry's urn:uuid fullUrl is rewritten to the Type/id it was given.
+        Created resources are kept in server.resources ({"Type/id": resource}).
+        Returns (server, base_url).
+    """
+    server, base_url = start_stub_server()
+    server.resources = {}
+    lock = threading.Lock()
+
+    def matching(resource_type, if_none_exist):
+        system, _, value = unquote(if_none_exist.partition("identifier=")[2]).partition("|")
+        for key, existing in server.resources.items():
+            if key.startswith(f"{resource_type}/") and any(
+                    identifier.get("system") == system and identifier.get("value") == value
+                    for identifier in existing.get("identifier", [])):
+                return key
+        return None
+
+    def resolve(value, full_urls):
+        if isinstance(value, dict):
+            if value.get("reference") in full_urls:
+                value["reference"] = full_urls[value["reference"]]
+            for item in value.values():
+                resolve(item, full_urls)
+        elif isinstance(value, list):
+            for item in value:
+                resolve(item, full_urls)
+
+    def process(handler):
+        bundle = json.loads(handler.request_body)
+        responses, full_urls, created = [], {}, []
+        with lock:
+            for entry in bundle.get("entry", []):
+                resource = entry["resource"]
+                resource_type = resource["resourceType"]
+                key = matching(resource_type, entry["request"].get("ifNoneExist", ""))
+                status = "200 OK"
+                if key is None:
+                    key, status = f"{resource_type}/{len(server.resources) + len(created) + 1}", "201 Created"
+                    resource["id"] = key.split("/")[1]
+                    created.append((key, resource))
+                if entry.get("fullUrl"):
+                    full_urls[entry["fullUrl"]] = key
+                responses.append({"response": {"status": status, "location": f"{key}/_history/1"}})
+            if bundle.get("type") == "transaction":
+                for _, resource in created:
+                    resolve(resource, full_urls)
+            server.resources.update(created)
+        return 200, {}, {"resourceType": "Bundle", "type": f"{bundle.get('type')}-response", "entry": responses}
+
+    server.routes[("POST", "/")] = process
+    return server, base_url
@@ -0,0 +1,92 @@
+import argparse
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from src import http_client
+from src.registration import data_dir
+from src.terminology_cache import search_constraint, search_icd10_map, codes_from_ndjson
+
+LOOKUP_FILE = data_dir / "terminology_lookup.json"
+
+# Terminology operations resolved for every code, and how each one is answered
+OPERATIONS = {
+    "parents": lambda code: search_constraint(">!", code),
+    "children": lambda code: search_constraint("<!", code),
+    "icd10": search_icd10_map,
+}
+
+# Max in-flight Hermes requests per operation
+DEFAULT_IN_FLIGHT = {"parents": 4, "children": 4, "icd10": 4}
+
+
+def resolve_codes(codes, operations=tuple(OPERATIONS), max_in_flight=None):
+    """
+        Resolve parents, children and ICD-10 maps for a set of SNOMED codes concurrently.
+        Duplicate codes are coalesced. All operations share one thread pool: each operation
+        gets max_in_flight[operation] workers that take its codes from a shared queue, so no
+        more than that many requests of one kind are outstanding.
+        Returns the lookup table {code: {"parents": [...], "children": [...], "icd10": [...]}};
+        an operation that failed for a code is stored as None.
+    """
+    max_in_flight = {**DEFAULT_IN_FLIGHT, **(max_in_flight or {})}
+    codes = sorted({str(code) for code in codes})
+    table = {code: {} for code in codes}
+    queues = {operation: deque(codes) for operation in operations}
+
+    def drain(operation):
+        queue = queues[operation]
+        while True:
+            try:
+                code = queue.popleft()
+            except IndexError:
+                return
+            try:
+                table[code][operation] = OPERATIONS[operation](code)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # One unreachable lookup must not cost the rest of the batch
+                print(f"Error when resolving {operation} of {code}: {e}")
+                table[code][operation] = None
+
+    workers = [operation for operation in operations for _ in range(min(max_in_flight[operation], len(codes)))]
+    if not workers:
+        return table
+    with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+        for future in [executor.submit(drain, operation) for operation in workers]:
+            future.result()
+    return table
+
+
+def save_lookup_table(table, path=LOOKUP_FILE):
+    with open(path, "w") as f:
+        json.dump(table, f, indent=2)
+
+
+def load_lookup_table(path=LOOKUP_FILE):
+    """
+        Load a lookup table written by save_lookup_table(), or None if there is none.
+    """
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Resolve SNOMED parents, children and ICD-10 maps for a cohort")
+    parser.add_argument("ndjson", help="Cohort extract (cohort.py) or bulk export (bulk_export.py) NDJSON file "
+                                       "or artifact stream, e.g. cohort")
+    parser.add_argument("--in-flight", type=int, default=4, help="Max in-flight Hermes requests per operation")
+    args = parser.parse_args()
+
+    print()
+    codes = codes_from_ndjson(args.ndjson)
+    print(f"Distinct SNOMED codes in cohort: {len(codes)}")
+    http_client.configure(pool_size=max(http_client.DEFAULT_POOL_SIZE, args.in_flight * len(OPERATIONS)))
+    start = time.perf_counter()
+    table = resolve_codes(codes, max_in_flight={operation: args.in_flight for operation in OPERATIONS})
+    elapsed = time.perf_counter() - start
+    save_lookup_table(table)
+    print(f"Resolved {len(table)} codes in {elapsed:.1f}s")
+    print(f"Lookup table saved to: {LOOKUP_FILE}")
@@ -0,0 +1,289 @@
+import argparse
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from src import http_client
+from src.registration import data_dir
+from src.http_client import BASE_HERMES_URL
+from src.snomed_graph import get_snomed_graph, GRAPH_EXPRESSIONS
+from src.icd10_map_index import get_map_index, ICD10_MAP_REFSET_ID
+from src.artifact_store import iter_source
+
+CACHE_FILE = data_dir / "terminology_cache.sqlite"
+
+# Release dates (YYYYMMDD) in the release descriptions of Hermes' status endpoint
+RELEASE_DATE = re.compile(r"\b(\d{8})\b")
+
+DEFAULT_TTL = 30 * 24 * 3600  # seconds
+DEFAULT_MEMORY_ENTRIES = 10000
+
+# Hermes constraint operators used by the pipeline: >! parents, <! children
+HIERARCHY_EXPRESSIONS = (">!", "<!")
+
+
+def hermes_release(base_url):
+    """
+        SNOMED release Hermes serves, from its status endpoint: the dates of the installed
+        releases (e.g. "20250101"), joined with "+" when an extension is installed too.
+        Returns None if Hermes cannot be reached or does not say.
+    """
+    try:
+        response = http_client.get(url=f"{base_url}/status")
+    except requests.exceptions.RequestException as e:
+        print(f"Could not read the Hermes status: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Hermes status error: {response.status_code}")
+        return None
+    releases = response.json().get("releases", [])
+    return "+".join(sorted({date for release in releases for date in RELEASE_DATE.findall(release)})) or None
+
+
+def snomed_release():
+    """
+        SNOMED release Hermes reports, or None if Hermes cannot say (see TerminologyCache).
+    """
+    return hermes_release(BASE_HERMES_URL)
+
+
+class TerminologyCache:
+    """
+        Two-tier cache of Hermes constraint search results keyed by
+        (expression, code, SNOMED release): an in-memory LRU in front of a SQLite file.
+        Entries expire after `ttl` seconds and are dropped when the release changes.
+        The release defaults to snomed_release(). Only a release Hermes reported (or one
+        given explicitly) purges the entries of other releases: when Hermes cannot be
+        asked, the most recently stored release is kept, and nothing is deleted. An empty
+        cache then starts under the RF2 release of the local graph (snomed_graph.py),
+        or "unknown".
+    """
+
+    def __init__(self, path=CACHE_FILE, release=None, ttl=DEFAULT_TTL,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES):
+        if release is None:
+            release = snomed_release()
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS constraint_results ("
+            " expression TEXT, code TEXT, release TEXT, result TEXT, stored_at REAL,"
+            " PRIMARY KEY (expression, code, release))"
+        )
+        if release is None:
+            self.release = self._latest_release()
+            return
+        self.release = release
+        # Version-based invalidation: answers from another SNOMED release are never valid again
+        self._db.execute("DELETE FROM constraint_results WHERE release != ?", (release,))
+        self._db.commit()
+
+    def _latest_release(self):
+        row = self._db.execute("SELECT release FROM constraint_results ORDER BY stored_at DESC LIMIT 1").fetchone()
+        if row is not None:
+            return row[0]
+        graph = get_snomed_graph()
+        return graph.release if graph is not None and graph.release else "unknown"
+
+    def get(self, expression, code):
+        """
+            Cached result list for `expression` + `code`, or None on a miss / expired entry.
+        """
+        key = (expression, code)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            row = self._db.execute(
+                "SELECT result, stored_at FROM constraint_results WHERE expression = ? AND code = ? AND release = ?",
+                (expression, code, self.release),
+            ).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                result = json.loads(row[0])
+                self._remember(key, result, row[1])
+                self.disk_hits += 1
+                return result
+            self.misses += 1
+            return None
+
+    def put(self, expression, code, result):
+        stored_at = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO constraint_results VALUES (?, ?, ?, ?, ?)",
+                (expression, code, self.release, json.dumps(result), stored_at),
+            )
+            self._db.commit()
+            self._remember((expression, code), result, stored_at)
+
+    def _remember(self, key, result, stored_at):
+        self._memory[key] = (result, stored_at)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM constraint_results")
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM constraint_results").fetchone()[0]
+        return {"release": self.release, "memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                "misses": self.misses, "memory_entries": len(self._memory), "disk_entries": entries}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_terminology_cache():
+    """
+        Return the process-wide TerminologyCache, opening it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TerminologyCache()
+    return _cache
+
+
+def search_constraint(expression, code):
+    """
+        Hermes constraint search (e.g. ">!" for parents, "<!" for children of `code`)
+        answered in-process by the local is-a graph (snomed_graph.py) when one has been
+        built with preferred terms and knows the code, otherwise from the terminology cache
+        when possible, otherwise by Hermes. A code missing from the graph (e.g. a concept newer
+        than the graph's RF2 release) is not answered with an empty list, and an answer with a
+        concept the graph has no preferred term for goes to Hermes too (callers use the term).
+        Returns the list of matching concepts, or None if Hermes returned an error.
+    """
+    graph = get_snomed_graph()
+    if graph is not None and expression in GRAPH_EXPRESSIONS and graph.has_terms and graph.has(code):
+        result = graph.constraint(expression, code)
+        if all(concept["preferredTerm"] for concept in result):
+            return result
+    cache = get_terminology_cache()
+    result = cache.get(expression, code)
+    if result is not None:
+        return result
+    snomed_url = f'{BASE_HERMES_URL}/search?constraint={expression}{code}'
+    response = http_client.get(url=snomed_url)
+    print(response.url)
+    if response.status_code != 200:
+        print(f"Hermes error: {response.status_code}")
+        return None
+    result = response.json()
+    cache.put(expression, code, result)
+    return result
+
+
+def first_concept(concepts):
+    """
+        The concept with the lowest SNOMED id in a constraint search result. The local graph
+        and Hermes list the same concepts in different orders; picking by id makes callers
+        choose the same parent/child whichever of them answered.
+    """
+    return min(concepts, key=lambda concept: int(concept["conceptId"]))
+
+
+def search_icd10_map(code, refset_id=ICD10_MAP_REFSET_ID):
+    """
+        ICD-10 map records of a SNOMED `code`: the local map index (icd10_map_index.py) first,
+        then the terminology cache, then Hermes. Results are cached under the expression "map/<refset>".
+        Returns the list of map records, or None if Hermes returned an error.
+    """
+    index = get_map_index()
+    if index is not None:
+        records = index.lookup(code)
+        if records:
+            return records
+    cache = get_terminology_cache()
+    expression = f"map/{refset_id}"
+    result = cache.get(expression, code)
+    if result is not None:
+        return result
+    response = http_client.get(url=f"{BASE_HERMES_URL}/concepts/{code}/map/{refset_id}")
+    if response.status_code != 200:
+        print(f"Hermes error: {response.status_code}")
+        return None
+    result = response.json()
+    cache.put(expression, code, result)
+    return result
+
+
+def condition_codes(conditions):
+    """
+        Distinct SNOMED codes of a list of Condition resources.
+    """
+    codes = set()
+    for condition in conditions:
+        for coding in condition.get("code", {}).get("coding", []):
+            if coding.get("system") == "http://snomed.info/sct" and coding.get("code"):
+                codes.add(coding["code"])
+    return codes
+
+
+def codes_from_ndjson(source):
+    """
+        Collect the distinct SNOMED codes of every Condition in an NDJSON source (a file, or an
+        artifact stream such as "cohort" or "bulk_export"), either cohort records (cohort.py,
+        one patient per line) or plain resources (bulk_export.py).
+    """
+    codes = set()
+    for record in iter_source(source):
+        conditions = [record] if record.get("resourceType") == "Condition" else record.get("Condition", [])
+        codes |= condition_codes(conditions)
+    return codes
+
+
+def warm_up(codes, expressions=HIERARCHY_EXPRESSIONS, max_workers=8):
+    """
+        Pre-resolve every (expression, code) pair so later runs never wait on Hermes.
+        Returns the number of lookups that had to go to Hermes.
+    """
+    cache = get_terminology_cache()
+    misses_before = cache.misses
+    pairs = [(expression, code) for code in sorted(codes) for expression in expressions]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda pair: search_constraint(*pair), pairs))
+    return cache.misses - misses_before
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Persistent SNOMED hierarchy cache for Hermes lookups")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    warm = subparsers.add_parser("warm-up", help="Pre-resolve every distinct Condition code in a cohort")
+    warm.add_argument("ndjson", help="Cohort extract (cohort.py) or bulk export (bulk_export.py) NDJSON file "
+                                     "or artifact stream, e.g. cohort")
+    warm.add_argument("--workers", type=int, default=8)
+    subparsers.add_parser("stats", help="Show cache statistics")
+    subparsers.add_parser("clear", help="Remove every cached entry")
+    args = parser.parse_args()
+
+    print()
+    if args.command == "warm-up":
+        codes = codes_from_ndjson(args.ndjson)
+        print(f"Distinct SNOMED codes in cohort: {len(codes)}")
+        fetched = warm_up(codes, max_workers=args.workers)
+        print(f"Resolved {fetched} lookups from Hermes")
+    elif args.command == "clear":
+        get_terminology_cache().clear()
+    print(get_terminology_cache().stats())
@@ -0,0 +1,157 @@
+import json
+import threading
+import time
+from pathlib import Path
+from src import http_client
+from src.registration import data_dir
+from src.refresh_token import renew_access_token
+
+# Refresh this many seconds before the access token expires
+REFRESH_MARGIN = 60
+
+# After a failed renew, wait this long before the next attempt, doubling per failure up to the cap
+RETRY_BASE = 5  # seconds
+RETRY_CAP = 300  # seconds
+
+
+class TokenProvider:
+    """
+        Holds the OpenEMR access token in memory and tracks its expiry (expires_in).
+        A background timer renews it through renew_access_token() shortly before it
+        expires, and a lock makes sure concurrent workers trigger a single refresh.
+        A failed renew is retried with exponential backoff (retry_base doubling up to
+        retry_cap); until then callers get the current token without another attempt.
+    """
+
+    def __init__(self, token_path=None, refresh_margin=REFRESH_MARGIN, renew=renew_access_token,
+                 retry_base=RETRY_BASE, retry_cap=RETRY_CAP):
+        self.token_path = Path(token_path or data_dir / "access_token.json")
+        self.refresh_margin = refresh_margin
+        self.renew = renew
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.access_token = None
+        self.expires_at = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _set_token(self, token_data, issued_at):
+        self.access_token = token_data.get("access_token")
+        expires_in = token_data.get("expires_in")
+        self.expires_at = issued_at + float(expires_in) if expires_in else None
+        self.failures = 0
+        self.retry_at = 0.0
+        self._schedule_refresh()
+
+    def _renew_failed(self):
+        """
+            Back off after a failed renew and schedule the next attempt.
+        """
+        delay = min(self.retry_cap, self.retry_base * 2 ** self.failures)
+        self.failures += 1
+        self.retry_at = time.monotonic() + delay
+        print(f"Access token renewal failed {self.failures} time(s); retrying in {delay:.0f}s")
+        self._schedule_timer(delay)
+
+    def _load_from_file(self):
+        """
+            Read access_token.json once. The file's modification time is taken as the
+            moment the token was issued, since renew_access_token() writes it on receipt.
+        """
+        if not self.token_path.exists():
+            print("Error: access_token.json file not found.")
+            return
+        try:
+            with open(self.token_path, 'r') as json_file:
+                token_data = json.load(json_file)
+        except json.JSONDecodeError as e:
+            print(f"Error reading access token from file: {e}")
+            return
+        self._set_token(token_data, self.token_path.stat().st_mtime)
+
+    def _schedule_refresh(self):
+        if self.expires_at is None:
+            self._schedule_timer(None)
+            return
+        self._schedule_timer(max(0.0, self.expires_at - self.refresh_margin - time.time()))
+
+    def _schedule_timer(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if delay is None:
+            return
+        self._timer = threading.Timer(delay, self.refresh, kwargs={"stale_token": self.access_token})
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _needs_refresh(self):
+        return (self.expires_at is not None and time.time() >= self.expires_at - self.refresh_margin
+                and time.monotonic() >= self.retry_at)
+
+    def get_token(self):
+        """
+            Return the current access token, loading it on first use and
+            refreshing it first if it is about to expire.
+        """
+        with self._lock:
+            if self.access_token is None:
+                self._load_from_file()
+            stale_token = self.access_token if self._needs_refresh() else None
+        if stale_token is not None:
+            self.refresh(stale_token=stale_token)
+        return self.access_token
+
+    def refresh(self, stale_token=None):
+        """
+            Renew the access token (single flight). If `stale_token` is given and another
+            caller already replaced it, the newer token is kept and no request is made.
+            Within the backoff after a failed renew no request is made either.
+            Returns the current access token.
+        """
+        with self._lock:
+            if stale_token is not None and self.access_token != stale_token:
+                return self.access_token
+            if time.monotonic() < self.retry_at:
+                return self.access_token
+            try:
+                token_data = self.renew()
+            except (OSError, ValueError) as e:
+                print(f"Error when refreshing access token: {e}")
+                token_data = None
+            if token_data and token_data.get("access_token"):
+                self._set_token(token_data, time.time())
+            else:
+                self._renew_failed()
+            return self.access_token
+
+    def get_headers(self):
+        return {"Authorization": f"Bearer {self.get_token()}"}
+
+    def refresh_authorization(self, stale_authorization):
+        """
+            Hook for http_client: given the Authorization header that got a 401,
+            refresh once and return the new Authorization header value.
+        """
+        stale_token = stale_authorization.removeprefix("Bearer ")
+        return f"Bearer {self.refresh(stale_token=stale_token)}"
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_token_provider():
+    """
+        Return the process-wide TokenProvider and register it with http_client,
+        so a request that gets a 401 is retried once with a refreshed token.
+    """
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = TokenProvider()
+                http_client.set_auth_refresher(_provider.refresh_authorization)
+    return _provider
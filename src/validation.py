@@ -1,34 +1,100 @@
+import argparse
 import json
-import requests
-from pathlib import Path
-from src.registration import data_dir
+import random
+from src import write_scheduler
+from src.http_client import PRIMARY_FHIR_URL
+from src.artifact_store import iter_artifacts
+from src.profile_validator import validate, has_errors, is_unchecked
+from src.validation_cache import cached_validation
 
-PRIMARY_FHIR_URL = "http://159.203.105.138:8080/fhir" # Primary FHIR EHR server
+# Share of resources also sent to the server's $validate, to catch drift between the compiled
+# profiles and the server's validator (bindings and invariants are only checked there)
+DEFAULT_SERVER_SAMPLE = 0.05
 
-def validate_resource(file_name: str, resource_type: str):
+
+def validate_on_server(resource: dict, resource_type: str = None, verbose: bool = True):
     """
-       Validate a local FHIR resource JSON file against the PRIMARY_FHIR_URL server.
+       Validate a FHIR resource with the PRIMARY_FHIR_URL server's $validate operation.
+       Returns the OperationOutcome. When the server does not answer 200 with JSON, the
+       outcome is a fatal "exception" issue (never cached) followed by the issues of any
+       OperationOutcome the server sent.
    """
-    # Load the resource from data/<file_name>.json
-    with open(data_dir / f"{file_name}.json") as f:
-        resource = json.load(f)
-
-    # Call the $validate operation on the FHIR server
-    response = requests.post(
+    resource_type = resource_type or resource["resourceType"]
+    response = write_scheduler.post(
         f"{PRIMARY_FHIR_URL}/{resource_type}/$validate",
         headers={"Content-Type": "application/fhir+json"},
         json=resource,
     )
-    # Print HTTP status and the OperationOutcome details
-    print(response.status_code)
-    print(json.dumps(response.json(), indent=2))
+    if verbose:
+        print(f"Server $validate: {response.status_code}")
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if response.status_code == 200 and isinstance(body, dict):
+        return body
+    server_issues = []
+    if isinstance(body, dict) and body.get("resourceType") == "OperationOutcome":
+        server_issues = body.get("issue", [])
+    return {"resourceType": "OperationOutcome",
+            "issue": [{"severity": "fatal", "code": "exception",
+                       "diagnostics": f"Server $validate answered {response.status_code}"}] + server_issues}
+
+
+# Outcomes of unchanged resources are reused from the validation cache (validation_cache.py)
+validate_locally = cached_validation("local", validate)
+validate_on_server_cached = cached_validation("server", lambda resource: validate_on_server(resource))
+
+
+def validate_resource(resource: dict, resource_type: str = None, server_sample: float = DEFAULT_SERVER_SAMPLE):
+    """
+       Validate a FHIR resource against the compiled profiles (profile_validator.py), and send a
+       sampled share of resources (server_sample, 0..1) to the server's $validate as a second pass.
+       A resource whose profile could not be checked locally always goes to the server.
+       Both passes skip resources whose content and profiles were validated before.
+       Prints and returns the local OperationOutcome (the server's when a profile was not checked);
+       a sampled server verdict that disagrees on whether there are errors is reported.
+   """
+    outcome = validate_locally(resource)
+    print(json.dumps(outcome, indent=2))
+    if is_unchecked(outcome):
+        server_outcome = validate_on_server_cached(resource)
+        print("Server OperationOutcome:")
+        print(json.dumps(server_outcome, indent=2))
+        return server_outcome
+    if server_sample and random.random() < server_sample:
+        server_outcome = validate_on_server_cached(resource)
+        if has_errors(server_outcome) != has_errors(outcome):
+            print("Local and server validation disagree; server OperationOutcome:")
+            print(json.dumps(server_outcome, indent=2))
+    return outcome
+
+
+def validate_stream(stream: str, run: str = "latest", server_sample: float = DEFAULT_SERVER_SAMPLE):
+    """
+       Validate every resource of an artifact stream (see artifact_store.py), reading
+       the files one line at a time. By default only the latest run's files are validated.
+   """
+    count = 0
+    for resource in iter_artifacts(stream, run=run):
+        validate_resource(resource, server_sample=server_sample)
+        count += 1
+    if not count:
+        print(f"No {stream} artifacts found")
+    return count
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate the Task 1 & 2 artifacts against their profiles")
+    parser.add_argument("--server-sample", type=float, default=DEFAULT_SERVER_SAMPLE,
+                        help=f"Share of resources (0..1) also sent to the server's $validate "
+                             f"(default: {DEFAULT_SERVER_SAMPLE})")
+    args = parser.parse_args()
+
     print()
     # Validate the Patient and both Condition profiles created in Task 1 & 2
-    validate_resource("patient", "Patient")
+    validate_stream("Patient", server_sample=args.server_sample)
     print()
-    validate_resource("parent_condition", "Condition")
+    validate_stream("parent_condition", server_sample=args.server_sample)
     print()
-    validate_resource("child_condition", "Condition")
+    validate_stream("child_condition", server_sample=args.server_sample)
@@ -0,0 +1,228 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from src.registration import data_dir
+from src.profile_validator import declared_profiles
+
+CACHE_FILE = data_dir / "validation_cache.sqlite"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_ENTRIES = 10000
+
+# LRU access times are written to disk in batches of this many hits, not on every hit
+TOUCH_BATCH = 1000
+
+# Issue codes of outcomes that describe the attempt rather than the resource; never cached
+# (not-supported: a declared profile was not available, so the resource was not checked against it)
+TRANSIENT_CODES = {"exception", "transient", "timeout", "throttled", "lock-error", "no-store", "not-supported"}
+
+
+def content_hash(resource):
+    """
+        sha256 of the canonical JSON of a resource without id and meta.lastUpdated, so the
+        same content stored on two servers or saved twice hashes the same.
+    """
+    content = {key: value for key, value in resource.items() if key != "id"}
+    if isinstance(content.get("meta"), dict):
+        content["meta"] = {key: value for key, value in content["meta"].items() if key != "lastUpdated"}
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def profile_key(resource):
+    """
+        ("url|version ...", digest) of the profiles a resource declares. The digest combines the
+        content hashes of the local StructureDefinitions, so editing one changes it.
+    """
+    urls, digests = [], []
+    for url, profile in sorted(declared_profiles(resource), key=lambda item: item[0]):
+        urls.append(f"{url}|{profile.version}" if profile is not None else url)
+        digests.append(profile.digest if profile is not None else "unknown")
+    return " ".join(urls), hashlib.sha256(" ".join(digests).encode()).hexdigest()
+
+
+def is_cacheable(outcome):
+    return (isinstance(outcome, dict) and outcome.get("resourceType") == "OperationOutcome"
+            and not any(found.get("code") in TRANSIENT_CODES for found in outcome.get("issue", [])))
+
+
+class ValidationCache:
+    """
+        Persistent cache of validation outcomes keyed by (validator, content hash, profile
+        url|version). Each entry keeps the digest of the StructureDefinitions it was validated
+        against; an entry whose digest no longer matches the local profiles is a miss and is
+        deleted. The least recently used entries are evicted once the outcomes exceed max_bytes.
+        Recently used entries are also kept in an in-memory LRU, so repeated hits skip SQLite.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_bytes=DEFAULT_MAX_BYTES, memory_entries=DEFAULT_MEMORY_ENTRIES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outcomes ("
+            " validator TEXT, content_hash TEXT, profile TEXT, profile_digest TEXT, outcome TEXT,"
+            " size INTEGER, last_access REAL, PRIMARY KEY (validator, content_hash, profile))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS outcomes_last_access ON outcomes (last_access)")
+        self._db.commit()
+
+    def get(self, validator, resource):
+        """
+            Cached OperationOutcome of `resource` for a validator name, or None.
+        """
+        profile, digest = profile_key(resource)
+        key = (validator, content_hash(resource), profile)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] == digest:
+                self._memory.move_to_end(key)
+                self._touch(key)
+                self.hits += 1
+                return json.loads(entry[0])
+            row = self._db.execute(
+                "SELECT outcome, profile_digest FROM outcomes WHERE validator = ? AND content_hash = ? AND profile = ?",
+                key,
+            ).fetchone()
+            if row is not None and row[1] != digest:
+                # The StructureDefinition changed since this outcome was stored
+                self._memory.pop(key, None)
+                self._db.execute("DELETE FROM outcomes WHERE validator = ? AND content_hash = ? AND profile = ?", key)
+                self._db.commit()
+                self.invalidated += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._remember(key, row[0], row[1])
+            self._touch(key)
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, validator, resource, outcome):
+        if not is_cacheable(outcome):
+            return
+        profile, digest = profile_key(resource)
+        key = (validator, content_hash(resource), profile)
+        body = json.dumps(outcome, separators=(",", ":"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, digest, body, len(body), time.time()),
+            )
+            self._remember(key, body, digest)
+            self._flush_touches()
+            self._evict()
+            self._db.commit()
+
+    def _remember(self, key, body, digest):
+        self._memory[key] = (body, digest)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key):
+        self._touched[key] = time.time()
+        if len(self._touched) >= TOUCH_BATCH:
+            self._flush_touches()
+            self._db.commit()
+
+    def _flush_touches(self):
+        if self._touched:
+            self._db.executemany(
+                "UPDATE outcomes SET last_access = ? WHERE validator = ? AND content_hash = ? AND profile = ?",
+                [(accessed, *key) for key, accessed in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def flush(self):
+        """
+            Write pending LRU access times to disk.
+        """
+        with self._lock:
+            self._flush_touches()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM outcomes").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT validator, content_hash, profile, size FROM outcomes ORDER BY last_access")
+        for validator, digest, profile, size in rows.fetchall():
+            key = (validator, digest, profile)
+            self._db.execute("DELETE FROM outcomes WHERE validator = ? AND content_hash = ? AND profile = ?", key)
+            self._memory.pop(key, None)
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+            self._db.execute("DELETE FROM outcomes")
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            self._flush_touches()
+            self._db.commit()
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outcomes").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "invalidated": self.invalidated,
+                "evictions": self.evictions, "entries": entries, "bytes": size}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_validation_cache():
+    """
+        Return the process-wide ValidationCache, opening it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ValidationCache()
+    return _cache
+
+
+def cached_validation(name, validator):
+    """
+        Wrap a validator (resource -> OperationOutcome) so outcomes are looked up in and
+        stored to the shared cache under `name`.
+    """
+    def validate(resource):
+        cache = get_validation_cache()
+        outcome = cache.get(name, resource)
+        if outcome is None:
+            outcome = validator(resource)
+            cache.put(name, resource, outcome)
+        return outcome
+    return validate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect or clear the validation outcome cache")
+    parser.add_argument("--clear", action="store_true", help="Remove every cached outcome")
+    args = parser.parse_args()
+
+    cache = ValidationCache()
+    if args.clear:
+        cache.clear()
+        print(f"Cleared {cache.path}")
+    print(cache.stats())
@@ -0,0 +1,379 @@
+import argparse
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from src import http_client
+
+# Statuses worth retrying; 429 and 503 mean the server did not process the request at all
+RETRY_STATUSES = {429, 502, 503, 504}
+REJECTED_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+DEFAULT_RATE = 50.0  # writes per second
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds, doubled per attempt
+BACKOFF_CAP = 30.0
+
+# A write is "slow" when its latency exceeds the baseline (10th percentile of recent latencies) by this factor
+LATENCY_TOLERANCE = 2.0
+BASELINE_PERCENTILE = 0.1
+DECREASE_FACTOR = 0.5
+# Shrink the concurrency limit at most once per interval, so one overload event halves it only once
+DECREASE_INTERVAL = 1.0
+LATENCY_WINDOW = 200
+
+# Print the metrics line at most this often (seconds) while writes are flowing; None turns it off
+REPORT_INTERVAL = 30.0
+
+
+class TokenBucket:
+    """
+        Rate limiter: `rate` tokens per second, up to `burst` saved up. acquire() blocks for a token.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AIMDLimiter:
+    """
+        Adaptive cap on in-flight writes. Every healthy response adds 1/limit (about +1 per round
+        of requests); an error, a throttling status or a latency above LATENCY_TOLERANCE times the
+        baseline latency multiplies the limit by DECREASE_FACTOR.
+    """
+
+    def __init__(self, initial=DEFAULT_INITIAL_CONCURRENCY, maximum=DEFAULT_MAX_CONCURRENCY, minimum=1,
+                 tolerance=LATENCY_TOLERANCE, decrease_factor=DECREASE_FACTOR, decrease_interval=DECREASE_INTERVAL,
+                 window=LATENCY_WINDOW):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.in_flight = 0
+        self._latencies = deque(maxlen=window)
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, overloaded=False):
+        """
+            Give back a slot and adjust the limit from the outcome of the write.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if latency is not None:
+                self._latencies.append(latency)
+            if overloaded or (latency is not None and latency > self.baseline() * self.tolerance):
+                now = time.monotonic()
+                if now - self._last_decrease >= self.decrease_interval:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def baseline(self):
+        """
+            Low percentile of the recent latencies: a single unusually fast write does not make every
+            other one look slow, and old samples drop out, so a lasting change is accepted.
+        """
+        return percentile(self._latencies, BASELINE_PERCENTILE) if self._latencies else float("inf")
+
+
+def retry_after(response):
+    """
+        Seconds to wait from a Retry-After header (delay-seconds or HTTP-date), or None.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_idempotent(method, url, headers=None):
+    """
+        Whether sending the request twice is harmless: safe methods, $validate, and
+        conditional creates (If-None-Exist) can be retried after a timeout.
+    """
+    return (method.upper() in IDEMPOTENT_METHODS or "/$validate" in url
+            or "If-None-Exist" in (headers or {}))
+
+
+def is_bundle(kwargs):
+    """
+        Whether a request posts a transaction/batch Bundle: its latency grows with the number of
+        entries, so it is not comparable with the latency of a single-resource write.
+    """
+    body = kwargs.get("json")
+    return isinstance(body, dict) and body.get("resourceType") == "Bundle"
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class WriteScheduler:
+    """
+        Front door for writes to the Primary Care EHR: a TokenBucket caps the request rate, an
+        AIMDLimiter caps in-flight writes, and 429/5xx responses and connection errors are retried
+        with Retry-After or jittered exponential backoff. A Retry-After pauses every caller, not
+        only the one that got it. Non-idempotent requests are only retried on 429/503, which
+        the server rejected without processing.
+        Bundle POSTs have their own AIMDLimiter (bundle_limiter), so a slow Bundle of many entries
+        does not read as congestion to single writes, nor the other way round. Only 2xx/3xx
+        latencies are AIMD samples; other 4xx responses count as failed and leave the limit as is.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None, initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP, report_interval=REPORT_INTERVAL):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.limiter = AIMDLimiter(initial=initial_concurrency, maximum=max_concurrency)
+        self.bundle_limiter = AIMDLimiter(initial=initial_concurrency, maximum=max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.report_interval = report_interval
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._bundle_latencies = deque(maxlen=LATENCY_WINDOW)
+        self._counts = {"requests": 0, "completed": 0, "failed": 0, "retries": 0, "throttled": 0, "errors": 0}
+        self._started = time.monotonic()
+        self._last_report = self._started
+
+    def backoff(self, attempt):
+        """
+            Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)].
+        """
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _wait_for_pause(self):
+        while True:
+            with self._lock:
+                wait = self._paused_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _count(self, name, latency=None, bundle=False):
+        with self._lock:
+            self._counts[name] += 1
+            if latency is not None:
+                (self._bundle_latencies if bundle else self._latencies).append(latency)
+
+    def send(self, method, url, idempotent=None, **kwargs):
+        """
+            Send a request through http_client.request() under the rate and concurrency limits,
+            retrying throttled and failed attempts. Returns the last response; a connection error
+            or timeout is raised once retries are used up (or at once for non-idempotent writes),
+            and any other exception is raised at once. Every attempt gives its concurrency slot back.
+        """
+        if idempotent is None:
+            idempotent = is_idempotent(method, url, kwargs.get("headers"))
+        bundle = is_bundle(kwargs)
+        limiter = self.bundle_limiter if bundle else self.limiter
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_pause()
+            if self.bucket is not None:
+                self.bucket.acquire()
+            limiter.acquire()
+            self._count("requests")
+            start = time.perf_counter()
+            latency, overloaded, error = None, True, None
+            try:
+                response = http_client.request(method, url, **kwargs)
+                overloaded = response.status_code in RETRY_STATUSES or response.status_code >= 500
+                # A rejected write (4xx) says nothing about how loaded the server is
+                if response.status_code < 400:
+                    latency = time.perf_counter() - start
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except Exception:
+                # Broken bodies, redirect loops, token refresh errors, ...: not retried, but still failures
+                self._count("errors")
+                self._count("failed")
+                raise
+            finally:
+                # The slot is given back on every path; a request that raised counts as congestion
+                limiter.release(latency, overloaded=overloaded)
+            if error is not None:
+                self._count("errors")
+                if attempt == self.max_retries or not idempotent:
+                    self._count("failed")
+                    raise error
+                delay = self.backoff(attempt)
+                print(f"{method} {url} failed ({type(error).__name__}), retrying in {delay:.1f}s")
+            else:
+                status = response.status_code
+                if status in REJECTED_STATUSES:
+                    self._count("throttled")
+                retryable = status in REJECTED_STATUSES or (status in RETRY_STATUSES and idempotent)
+                if not retryable or attempt == self.max_retries:
+                    self._count("completed" if status < 400 else "failed", latency, bundle)
+                    self._maybe_report()
+                    return response
+                delay = retry_after(response)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                else:
+                    self.pause(delay)
+                response.close()
+                print(f"{method} {url} returned {status}, retrying in {delay:.1f}s")
+            self._count("retries")
+            time.sleep(delay)
+
+    def post(self, url, **kwargs):
+        return self.send("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.send("PUT", url, **kwargs)
+
+    def metrics(self):
+        """
+            Snapshot of the scheduler; safe to call from any thread while writes are running.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+            latencies = list(self._latencies)
+            bundle_latencies = list(self._bundle_latencies)
+            elapsed = time.monotonic() - self._started
+        return {
+            **counts,
+            "in_flight": self.limiter.in_flight + self.bundle_limiter.in_flight,
+            "concurrency_limit": round(self.limiter.limit, 2),
+            "bundle_concurrency_limit": round(self.bundle_limiter.limit, 2),
+            "rate_limit": self.bucket.rate if self.bucket is not None else None,
+            "throughput": round(counts["completed"] / elapsed, 2) if elapsed else 0.0,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "bundle_latency_p50": percentile(bundle_latencies, 0.5),
+            "bundle_latency_p95": percentile(bundle_latencies, 0.95),
+        }
+
+    def report(self):
+        m = self.metrics()
+        latency = (f"p50 {m['latency_p50'] * 1000:.0f}ms p95 {m['latency_p95'] * 1000:.0f}ms"
+                   if m["latency_p50"] is not None else "no latency samples")
+        if m["bundle_latency_p50"] is not None:
+            latency += (f" | Bundles: limit {m['bundle_concurrency_limit']}, "
+                        f"p50 {m['bundle_latency_p50'] * 1000:.0f}ms p95 {m['bundle_latency_p95'] * 1000:.0f}ms")
+        print(f"Writes: {m['completed']} completed, {m['failed']} failed, {m['retries']} retries, "
+              f"{m['throttled']} throttled, {m['errors']} connection errors | "
+              f"in flight {m['in_flight']}/{m['concurrency_limit']}, {m['throughput']}/s, {latency}")
+
+    def _maybe_report(self):
+        if self.report_interval is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_report < self.report_interval:
+                return
+            self._last_report = now
+        self.report()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_write_scheduler():
+    """
+        Return the process-wide WriteScheduler, creating it with the defaults on first use.
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = WriteScheduler()
+    return _scheduler
+
+
+def configure(**settings):
+    """
+        Replace the shared scheduler, e.g. configure(rate=20, max_concurrency=8).
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = WriteScheduler(**settings)
+    return _scheduler
+
+
+def post(url, **kwargs):
+    """
+        POST through the shared scheduler; drop-in replacement for http_client.post().
+    """
+    return get_write_scheduler().post(url, **kwargs)
+
+
+def put(url, **kwargs):
+    """
+        PUT through the shared scheduler.
+    """
+    return get_write_scheduler().put(url, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Probe the write scheduler against a FHIR server with $validate")
+    parser.add_argument("resource", help="JSON file of a resource to validate repeatedly")
+    parser.add_argument("--base-url", default=http_client.PRIMARY_FHIR_URL)
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE)
+    args = parser.parse_args()
+
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    print()
+    with open(args.resource) as f:
+        resource = json.load(f)
+    scheduler = configure(rate=args.rate, report_interval=5.0)
+    url = f"{args.base_url}/{resource['resourceType']}/$validate"
+    headers = {"Content-Type": "application/fhir+json"}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(lambda _: scheduler.post(url, headers=headers, json=resource), range(args.count)))
+    scheduler.report()
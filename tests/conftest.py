@@ -0,0 +1,22 @@
+import pytest
+from src import write_scheduler
+from src.stub_server import start_stub_server
+
+
+@pytest.fixture
+def stub():
+    """
+        A local stub FHIR server; add routes to server.routes. Yields (server, base_url).
+    """
+    server, base_url = start_stub_server()
+    yield server, base_url
+    server.shutdown()
+
+
+@pytest.fixture
+def scheduler():
+    """
+        A fresh shared write scheduler without rate limit, periodic report or long backoffs.
+    """
+    yield write_scheduler.configure(rate=None, report_interval=None, backoff_base=0.001, backoff_cap=0.01)
+    write_scheduler.configure()
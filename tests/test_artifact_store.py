@@ -0,0 +1,174 @@
+import gzip
+import io
+import json
+import uuid
+import pytest
+from src import artifact_store
+from src.artifact_store import (ArtifactStore, ArtifactWriter, artifact_paths, iter_artifacts, iter_file, iter_source,
+                                load_latest, save_artifact)
+from src.bulk_export import run_bulk_export
+from src.bulk_vitals import iter_blood_pressure_observations, write_observations
+from src.stub_server import start_bulk_export_stub
+
+
+def test_saves_in_the_same_second_never_overwrite_each_other(tmp_path):
+    first = save_artifact({"resourceType": "Patient", "id": "1"}, directory=tmp_path)
+    second = save_artifact({"resourceType": "Patient", "id": "2"}, directory=tmp_path)
+    assert first != second
+    assert [resource["id"] for resource in iter_artifacts("Patient", tmp_path)] == ["1", "2"]
+    assert load_latest("Patient", tmp_path)["id"] == "2"
+
+
+def test_writer_rotates_parts_and_publishes_the_open_part_on_close(tmp_path):
+    # Uncompressed, so the bytes on disk follow every write (gzip holds small writes in its buffer)
+    writer = ArtifactWriter("Observation", tmp_path, compression=None, max_bytes=2000)
+    for number in range(500):
+        writer.write({"resourceType": "Observation", "id": str(number), "identifier": [{"value": str(uuid.uuid4())}]})
+    rotated = artifact_paths("Observation", tmp_path)
+    assert rotated and len(list(tmp_path.glob(".*.tmp"))) == 1
+    paths = writer.close()
+    assert artifact_paths("Observation", tmp_path) == paths
+    assert len(paths) == len(rotated) + 1
+    assert [resource["id"] for resource in iter_source(tmp_path)] == [str(number) for number in range(500)]
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+@pytest.mark.parametrize("compression, suffix", [(None, ".ndjson"), ("gzip", ".ndjson.gz")])
+def test_compressed_parts_round_trip(tmp_path, compression, suffix):
+    resources = [{"resourceType": "Condition", "id": str(number), "note": [{"text": "é" * number}]}
+                 for number in range(50)]
+    writer = ArtifactWriter("Condition", tmp_path, compression=compression)
+    for resource in resources:
+        writer.write(resource)
+    [path] = writer.close()
+    assert path.name.endswith(suffix) and path.name.startswith(f"Condition.{writer.run_id}.0001")
+    assert list(iter_file(path)) == resources
+    raw = path.read_bytes()
+    lines = (gzip.decompress(raw) if compression else raw).splitlines()
+    # Compact NDJSON, one resource per line
+    assert lines[0] == json.dumps(resources[0], separators=(",", ":")).encode()
+    assert len(lines) == 50
+
+
+def test_zstd_parts_round_trip(tmp_path):
+    pytest.importorskip("zstandard")
+    resources = [{"resourceType": "Patient", "id": str(number)} for number in range(1000)]
+    writer = ArtifactWriter("Patient", tmp_path, compression="zstd")
+    for resource in resources:
+        writer.write(resource)
+    [path] = writer.close()
+    assert path.name.endswith(".ndjson.zst")
+    assert list(iter_file(path)) == resources
+
+
+def test_zstd_without_the_package_or_an_unknown_compression_is_rejected(tmp_path, monkeypatch):
+    with pytest.raises(ValueError):
+        ArtifactWriter("Patient", tmp_path, compression="bz2")
+    monkeypatch.setattr(artifact_store, "zstandard", None)
+    writer = ArtifactWriter("Patient", tmp_path, compression="zstd")
+    with pytest.raises(ValueError):
+        writer.write({"resourceType": "Patient"})
+
+
+def test_lines_are_split_across_read_chunks():
+    reader = io.BytesIO(b'{"id":"1"}\n\n{"id":"22"}\n{"id":"333"}')
+    assert list(artifact_store._iter_lines(reader, chunk_size=4)) == [b'{"id":"1"}', b"", b'{"id":"22"}',
+                                                                      b'{"id":"333"}']
+
+
+def test_store_writes_one_stream_per_resource_type_under_one_run_id(tmp_path):
+    with ArtifactStore(tmp_path) as store:
+        store.write({"resourceType": "Patient", "id": "1"})
+        store.write({"resourceType": "Condition", "id": "c1"})
+        store.write({"resourceType": "Patient", "id": "2"})
+        store.write({"resourceType": "Patient", "id": "3"}, stream="Patient_extra")
+        # Nothing is published before the store closes
+        assert artifact_paths("Patient", tmp_path) == []
+    assert set(store.paths) == {"Patient", "Condition", "Patient_extra"}
+    assert {path.name.split(".")[1] for paths in store.paths.values() for path in paths} == {store.run_id}
+    assert [resource["id"] for resource in iter_artifacts("Patient", tmp_path)] == ["1", "2"]
+    assert [resource["id"] for resource in iter_artifacts("Patient_extra", tmp_path)] == ["3"]
+
+
+def test_store_discards_unfinished_parts_on_an_exception(tmp_path):
+    save_artifact({"resourceType": "Patient", "id": "1"}, directory=tmp_path)
+    with pytest.raises(RuntimeError):
+        with ArtifactStore(tmp_path) as store:
+            store.write({"resourceType": "Patient", "id": "2"})
+            raise RuntimeError("export failed")
+    assert store.paths == {}
+    assert not list(tmp_path.glob(".*.tmp"))
+    # Readers still see the last complete run
+    assert load_latest("Patient", tmp_path)["id"] == "1"
+
+
+def test_artifact_paths_select_a_run(tmp_path):
+    first = save_artifact({"resourceType": "Patient", "id": "1"}, directory=tmp_path)
+    second = save_artifact({"resourceType": "Patient", "id": "2"}, directory=tmp_path)
+    assert artifact_paths("Patient", tmp_path) == [first, second]
+    assert artifact_paths("Patient", tmp_path, run="latest") == [second]
+    assert artifact_paths("Patient", tmp_path, run=first.name.split(".")[1]) == [first]
+    assert artifact_paths("Condition", tmp_path, run="latest") == []
+    assert load_latest("Condition", tmp_path) is None
+
+
+def test_iter_source_reads_files_directories_and_streams(tmp_path):
+    plain = tmp_path / "input" / "patients.ndjson"
+    plain.parent.mkdir()
+    plain.write_text('{"resourceType":"Patient","id":"a"}\n\n{"resourceType":"Patient","id":"b"}\n')
+    (plain.parent / ".hidden.ndjson.tmp").write_text('{"resourceType":"Patient","id":"x"}\n')
+    save_artifact({"resourceType": "Patient", "id": "old"}, directory=tmp_path)
+    save_artifact({"resourceType": "Patient", "id": "new"}, directory=tmp_path)
+    assert [resource["id"] for resource in iter_source(plain)] == ["a", "b"]
+    assert [resource["id"] for resource in iter_source(plain.parent)] == ["a", "b"]
+    # A stream name reads only the latest run
+    assert [resource["id"] for resource in iter_source("Patient", tmp_path)] == ["new"]
+
+
+def test_bulk_export_streams_into_the_artifact_store(tmp_path):
+    patients = [{"resourceType": "Patient", "id": str(number), "name": [{"family": "Doe"}]} for number in range(3)]
+    conditions = [{"resourceType": "Condition", "id": "c1", "subject": {"reference": "Patient/0"}}]
+    server, base_url = start_bulk_export_stub({"Patient": patients, "Condition": conditions}, pending_polls=1)
+    try:
+        counts = run_bulk_export(resource_types=("Patient", "Condition"), directory=tmp_path, headers={},
+                                 base_url=base_url, poll_interval=0)
+    finally:
+        server.shutdown()
+    assert counts == {"Patient": 3, "Condition": 1}
+    exported = list(iter_source("bulk_export", tmp_path))
+    assert [resource["resourceType"] for resource in exported] == ["Patient"] * 3 + ["Condition"]
+    # Patients went through the export transform (de-identification drops the source id)
+    assert all("id" not in resource for resource in exported[:3])
+
+
+@pytest.mark.parametrize("level, group_id, kickoff", [
+    ("patient", None, "/Patient/$export"),
+    ("group", "cohort-7", "/Group/cohort-7/$export"),
+])
+def test_patient_and_group_level_exports(tmp_path, level, group_id, kickoff):
+    conditions = [{"resourceType": "Condition", "id": "c1", "subject": {"reference": "Patient/0"}}]
+    server, base_url = start_bulk_export_stub({"Condition": conditions}, group_ids=("cohort-7",))
+    try:
+        counts = run_bulk_export(level=level, group_id=group_id, resource_types=("Condition",), directory=tmp_path,
+                                 headers={}, base_url=base_url, poll_interval=0)
+    finally:
+        server.shutdown()
+    assert counts == {"Condition": 1}
+    assert [path.split("?")[0] for path in server.kickoffs] == [kickoff]
+
+
+def test_bulk_vitals_write_a_new_run_of_the_observation_stream_each_time(tmp_path):
+    readings = tmp_path / "readings.csv"
+    readings.write_text("patient,timestamp,systolic,diastolic\n"
+                        "p1,2025-12-01T08:00:00Z,150,85\n"
+                        "p1,2025-12-02T08:00:00Z,,85\n"
+                        "p2,2025-12-01T09:00:00Z,118.5,72\n")
+    stats = {}
+    count, paths = write_observations(iter_blood_pressure_observations(readings, stats=stats), tmp_path)
+    assert (count, stats) == (2, {"readings": 2, "skipped": 1})
+    assert paths == artifact_paths("bp_observations", tmp_path)
+    # A second run does not overwrite the first one; the latest run is what iter_source reads
+    write_observations(iter_blood_pressure_observations(readings), tmp_path)
+    assert len(artifact_paths("bp_observations", tmp_path)) == 2
+    observations = list(iter_source("bp_observations", tmp_path))
+    assert [observation["interpretation"][0]["coding"][0]["code"] for observation in observations] == ["H", "N"]
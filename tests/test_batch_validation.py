@@ -0,0 +1,104 @@
+import gzip
+import json
+import os
+from src import batch_validation, validation_cache
+from src.batch_validation import ValidationReport, iter_resources, validate_batch, validate_concurrently
+from src.validation_cache import ValidationCache
+
+
+def validated_by(resource):
+    """
+        Module-level, so a process pool can pickle it: records which process validated the resource.
+    """
+    return {"resourceType": "OperationOutcome",
+            "issue": [{"severity": "information", "code": "informational", "diagnostics": str(os.getpid())}]}
+
+
+def patients(count):
+    return [{"resourceType": "Patient", "id": str(number), "gender": "female", "birthDate": f"19{number:02d}-01-01"}
+            for number in range(count)]
+
+
+def test_process_pool_validates_outside_the_main_process_and_caches_in_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(validation_cache, "_cache", ValidationCache(tmp_path / "cache.sqlite"))
+    results = list(validate_concurrently(patients(20), validated_by, workers=2, processes=True, cache_name="test"))
+    assert sorted(resource["id"] for resource, _, _ in results) == sorted(str(number) for number in range(20))
+    pids = {outcome["issue"][0]["diagnostics"] for _, outcome, _ in results}
+    assert str(os.getpid()) not in pids
+
+    # The second pass is answered from the cache of this process, without the pool
+    cache = validation_cache.get_validation_cache()
+    again = list(validate_concurrently(patients(20), validated_by, workers=2, processes=True, cache_name="test"))
+    assert cache.hits == 20
+    assert {outcome["issue"][0]["diagnostics"] for _, outcome, _ in again} == pids
+
+
+def test_process_tasks_carry_chunks_and_one_worker_validates_in_process():
+    results = list(validate_concurrently(patients(10), validated_by, workers=2, processes=True, chunk_size=4))
+    assert sorted(int(resource["id"]) for resource, _, _ in results) == list(range(10))
+    # 10 resources in chunks of 4: three tasks, each answered by one process
+    assert len({outcome["issue"][0]["diagnostics"] for _, outcome, _ in results}) <= 2
+    results = list(validate_concurrently(patients(3), validated_by, workers=1, processes=True))
+    assert {outcome["issue"][0]["diagnostics"] for _, outcome, _ in results} == {str(os.getpid())}
+
+
+def outcome(*issues):
+    return {"resourceType": "OperationOutcome",
+            "issue": [{"severity": severity, "code": code, "expression": expression}
+                      for severity, code, expression in issues]}
+
+
+def test_report_counts_issues_and_paths_without_indexes():
+    report = ValidationReport()
+    report.add({"resourceType": "Patient"}, outcome(("error", "required", ["Patient.name[0].family"]),
+                                                    ("warning", "not-supported", None)), 0.010)
+    report.add({"resourceType": "Patient"}, outcome(("error", "required", ["Patient.name[3].family"]),
+                                                    ("fatal", "exception", None)), 0.030)
+    report.add({"resourceType": "Patient"}, outcome(("information", "informational", None)), 0.020)
+    for number in range(20):
+        report.add({"resourceType": "Observation"}, outcome(("error", "value", ["Observation.component[1].code"])),
+                   (number + 1) / 1000)
+    summary = report.summary(top=2)
+    assert summary["resources"] == {"Patient": 3, "Observation": 20}
+    assert summary["failed"] == {"Patient": 2, "Observation": 20}
+    assert summary["issues"] == {"error/value": 20, "error/required": 2, "warning/not-supported": 1,
+                                 "fatal/exception": 1, "information/informational": 1}
+    assert summary["top_failing_paths"] == {"Observation.component.code": 20, "Patient.name.family": 2}
+    # A fatal issue without an expression counts against the resource type
+    assert report.paths["Patient"] == 1
+    assert summary["latency_ms"] == {"Patient": {"p50": 20.0, "p95": 30.0}, "Observation": {"p50": 11.0, "p95": 20.0}}
+    assert ValidationReport().summary()["top_failing_paths"] == {}
+
+
+def test_iter_resources_reads_ndjson_gzip_bundles_and_directories(tmp_path):
+    (tmp_path / "a.ndjson").write_text("".join(json.dumps(resource) + "\n" for resource in patients(2)))
+    with gzip.open(tmp_path / "b.ndjson.gz", "wt") as f:
+        f.write(json.dumps({"resourceType": "Condition", "id": "c1"}) + "\n")
+    (tmp_path / "c.json").write_text(json.dumps({"resourceType": "Bundle", "entry": [
+        {"resource": {"resourceType": "Observation", "id": "o1"}}, {"request": {"method": "GET"}}]}))
+    (tmp_path / "d.json").write_text(json.dumps({"resourceType": "Procedure", "id": "p1"}))
+    (tmp_path / ".hidden.ndjson").write_text("not json\n")
+    (tmp_path / "notes.txt").write_text("ignored")
+    assert [(resource["resourceType"], resource["id"]) for resource in iter_resources(tmp_path)] == [
+        ("Patient", "0"), ("Patient", "1"), ("Condition", "c1"), ("Observation", "o1"), ("Procedure", "p1")]
+    assert [resource["id"] for resource in iter_resources(tmp_path / "c.json")] == ["o1"]
+
+
+def test_validate_batch_streams_results_and_reports(tmp_path, monkeypatch):
+    def required_gender(resource):
+        if "gender" in resource:
+            return outcome(("information", "informational", None))
+        return outcome(("error", "required", ["Patient.gender"]))
+
+    monkeypatch.setitem(batch_validation.VALIDATORS, "local", required_gender)
+    resources = patients(3)
+    del resources[1]["gender"]
+    (tmp_path / "patients.ndjson").write_text("".join(json.dumps(resource) + "\n" for resource in resources))
+    out_path = tmp_path / "results.ndjson"
+    report = validate_batch(tmp_path / "patients.ndjson", out_path=out_path, use_cache=False)
+    lines = [json.loads(line) for line in out_path.read_text().splitlines()]
+    assert [line["id"] for line in lines] == ["0", "1", "2"]
+    assert lines[1]["outcome"]["issue"][0]["expression"] == ["Patient.gender"]
+    summary = report.summary()
+    assert (summary["resources"], summary["failed"]) == ({"Patient": 3}, {"Patient": 1})
+    assert summary["top_failing_paths"] == {"Patient.gender": 1}
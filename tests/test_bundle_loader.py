@@ -0,0 +1,101 @@
+import copy
+import pytest
+from src import bundle_loader
+from src.artifact_store import iter_source
+from src.bulk_vitals import iter_blood_pressure_observations, write_observations
+from src.bundle_loader import load_batches, load_observations, load_transactions
+from src.identity_map import IdentityMap
+from src.stub_server import start_bundle_stub
+
+
+def record(patient_id):
+    def subject():
+        return {"reference": f"Patient/{patient_id}"}
+    return {
+        "patient_id": patient_id,
+        "Patient": {"resourceType": "Patient", "id": patient_id, "name": [{"family": "Doe"}]},
+        "Condition": [{"resourceType": "Condition", "id": f"{patient_id}-c1", "subject": subject(),
+                       "encounter": {"reference": "Encounter/enc-1"},
+                       "recorder": {"reference": "Practitioner/dr-1"}, "asserter": subject()}],
+        "Observation": [{"resourceType": "Observation", "id": f"{patient_id}-o1", "subject": subject(),
+                         "performer": [{"reference": "Practitioner/dr-1"}, subject()]}],
+        "Procedure": [],
+    }
+
+
+@pytest.fixture
+def primary(tmp_path, scheduler, monkeypatch):
+    identity_map = IdentityMap(tmp_path / "map.sqlite")
+    monkeypatch.setattr(bundle_loader, "get_identity_map", lambda: identity_map)
+    server, base_url = start_bundle_stub()
+    yield server, base_url, identity_map
+    server.shutdown()
+
+
+def test_transaction_resolves_the_patient_urn_and_reloads_idempotently(primary):
+    server, base_url, identity_map = primary
+    results = list(load_transactions([record("src-1")], base_url=base_url))
+    assert [result["status"] for result in results] == ["201 Created"] * 3
+    patient_id = identity_map.get("Patient", "src-1")
+    condition = server.resources[f"Condition/{identity_map.get('Condition', 'src-1-c1')}"]
+    observation = server.resources[f"Observation/{identity_map.get('Observation', 'src-1-o1')}"]
+    # The urn:uuid of the Patient entry became the id the server gave it
+    assert condition["subject"] == condition["asserter"] == {"reference": f"Patient/{patient_id}"}
+    assert observation["performer"] == [{"reference": f"Patient/{patient_id}"}]
+    # The source Encounter and Practitioner do not exist on the primary server
+    assert "encounter" not in condition and "recorder" not in condition
+
+    count = len(server.resources)
+    results = list(load_transactions([record("src-1")], base_url=base_url))
+    assert [result["status"] for result in results] == ["200 OK"] * 3
+    assert len(server.resources) == count
+
+
+def test_records_without_a_patient_are_skipped_and_reported(primary):
+    server, base_url, identity_map = primary
+    broken = {**record("src-2"), "Patient": None}
+    for load in (load_transactions, load_batches):
+        results = list(load([copy.deepcopy(broken), record("src-3")], base_url=base_url))
+        assert results[0] == {"resourceType": "Patient", "source_id": "src-2", "status": "skipped",
+                              "target_id": None, "outcome": "record has no Patient"}
+        assert all(result["target_id"] for result in results[1:])
+    assert identity_map.get("Condition", "src-2-c1") is None
+    assert not any(resource.get("identifier", [{}])[0].get("value", "").startswith("src-2")
+                   for resource in server.resources.values())
+
+
+def test_batch_mode_points_dependents_at_the_created_patient(primary):
+    server, base_url, identity_map = primary
+    results = list(load_batches([record("src-4")], base_url=base_url))
+    assert [result["resourceType"] for result in results] == ["Patient", "Condition", "Observation"]
+    condition = server.resources[f"Condition/{identity_map.get('Condition', 'src-4-c1')}"]
+    assert condition["subject"] == {"reference": f"Patient/{identity_map.get('Patient', 'src-4')}"}
+    assert "recorder" not in condition
+
+
+def test_bulk_vitals_observations_are_loaded_for_loaded_patients(tmp_path, primary):
+    server, base_url, identity_map = primary
+    list(load_transactions([record("src-1")], base_url=base_url))
+    patient_id = identity_map.get("Patient", "src-1")
+    readings = tmp_path / "readings.csv"
+    readings.write_text("patient,timestamp,systolic,diastolic\n"
+                        "src-1,2025-11-27T08:00:00Z,150,95\n"
+                        "src-9,2025-11-27T08:00:00Z,120,80\n"
+                        "src-1,2025-11-28T08:00:00Z,118,76\n")
+    _, paths = write_observations(iter_blood_pressure_observations(readings), tmp_path / "artifacts")
+
+    results = list(load_observations(iter_source(paths[0]), batch_size=2, base_url=base_url))
+    assert [result["status"] for result in results] == ["201 Created", "skipped", "201 Created"]
+    assert results[1]["outcome"] == "patient Patient/src-9 is not loaded"
+    loaded = [server.resources[f"Observation/{result['target_id']}"] for result in results if result["target_id"]]
+    assert [observation["subject"] for observation in loaded] == [{"reference": f"Patient/{patient_id}"}] * 2
+    assert [observation["effectiveDateTime"] for observation in loaded] == ["2025-11-27T08:00:00Z",
+                                                                           "2025-11-28T08:00:00Z"]
+    assert loaded[0]["interpretation"][0]["coding"][0]["code"] == "H"
+    assert loaded[0]["performer"][0]["reference"] == "Practitioner/8"
+
+    # Reloading the stream sends nothing for the readings already loaded
+    count = len(server.resources)
+    results = list(load_observations(iter_source(paths[0]), base_url=base_url))
+    assert [result["status"] for result in results] == ["mapped", "skipped", "mapped"]
+    assert len(server.resources) == count
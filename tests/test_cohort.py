@@ -0,0 +1,110 @@
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import pytest
+from src import cohort, http_client
+from src.artifact_store import iter_artifacts
+from src.cohort import extract_cohort, load_patient_ids
+
+PATIENT_IDS = ("1", "2", "3", "4", "5", "6")
+
+
+def searchset(resources, next_url=None):
+    bundle = {"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": r} for r in resources]}
+    if next_url:
+        bundle["link"] = [{"relation": "next", "url": next_url}]
+    return bundle
+
+
+@pytest.fixture
+def openemr(stub, monkeypatch):
+    """
+        Stub OpenEMR with patients 1-6, each with two Conditions (on two pages), one Observation and no
+        Procedure. Patient 4's Observation search fails. Records the peak number of concurrent requests.
+    """
+    server, base_url = stub
+    monkeypatch.setattr(cohort, "BASE_URL", base_url)
+    monkeypatch.setattr(http_client, "USE_RESPONSE_CACHE", False)
+    lock = threading.Lock()
+    state = {"in_flight": 0, "peak": 0, "requests": []}
+
+    def tracked(respond):
+        def handler(request):
+            with lock:
+                state["in_flight"] += 1
+                state["peak"] = max(state["peak"], state["in_flight"])
+                state["requests"].append(request.path)
+            time.sleep(0.01)
+            try:
+                return respond(request)
+            finally:
+                with lock:
+                    state["in_flight"] -= 1
+        return handler
+
+    def query(request):
+        return {key: values[0] for key, values in parse_qs(urlparse(request.path).query).items()}
+
+    def conditions(request):
+        patient_id, page = query(request)["patient"], query(request).get("page", "1")
+        if page == "1":
+            return 200, {}, searchset([{"resourceType": "Condition", "id": f"{patient_id}-c1"}],
+                                      f"{base_url}/Condition?patient={patient_id}&page=2")
+        return 200, {}, searchset([{"resourceType": "Condition", "id": f"{patient_id}-c2"}])
+
+    def observations(request):
+        patient_id = query(request)["patient"]
+        if patient_id == "4":
+            return 500, {}, {"resourceType": "OperationOutcome"}
+        return 200, {}, searchset([{"resourceType": "Observation", "id": f"{patient_id}-o1"}])
+
+    for patient_id in PATIENT_IDS:
+        server.routes[("GET", f"/Patient/{patient_id}")] = tracked(
+            lambda request, patient_id=patient_id: (200, {}, {"resourceType": "Patient", "id": patient_id}))
+    server.routes[("GET", "/Condition")] = tracked(conditions)
+    server.routes[("GET", "/Observation")] = tracked(observations)
+    server.routes[("GET", "/Procedure")] = tracked(lambda request: (200, {}, searchset([])))
+    return server, base_url, state
+
+
+def test_load_patient_ids_from_a_file_a_list_or_ids(tmp_path):
+    path = tmp_path / "ids.txt"
+    path.write_text("# cohort A\n1\n\n 2 \n#3\n4\n")
+    assert load_patient_ids(path) == ["1", "2", "4"]
+    assert load_patient_ids("1, 2,,3") == ["1", "2", "3"]
+    assert load_patient_ids([1, 2]) == ["1", "2"]
+
+
+def test_per_type_extraction_writes_complete_records_under_the_host_limit(tmp_path, openemr):
+    _, _, state = openemr
+    count, _, failed = extract_cohort(PATIENT_IDS, directory=tmp_path, max_workers=6, per_host_limit=2,
+                                      compartment=False, headers={})
+    records = {record["patient_id"]: record for record in iter_artifacts("cohort", tmp_path)}
+    # Patient 4's Observations could not be read: no partial record, listed as failed
+    assert (count, failed) == (5, ["4"])
+    assert sorted(records) == ["1", "2", "3", "5", "6"]
+    assert records["2"] == {"patient_id": "2", "Patient": {"resourceType": "Patient", "id": "2"},
+                            "Condition": [{"resourceType": "Condition", "id": "2-c1"},
+                                          {"resourceType": "Condition", "id": "2-c2"}],
+                            "Observation": [{"resourceType": "Observation", "id": "2-o1"}], "Procedure": []}
+    # 6 workers, but never more than 2 requests at a time on the one host
+    assert state["peak"] <= 2
+
+
+def test_compartment_mode_reads_each_patient_in_one_search(tmp_path, openemr):
+    server, base_url, state = openemr
+    server.routes[("GET", "/metadata")] = (200, {}, {"resourceType": "CapabilityStatement", "rest": [
+        {"resource": [{"type": "Patient", "operation": [{"name": "everything"}]}]}]})
+    for patient_id in PATIENT_IDS:
+        server.routes[("GET", f"/Patient/{patient_id}/$everything")] = (200, {}, searchset([
+            {"resourceType": "Patient", "id": patient_id},
+            {"resourceType": "Condition", "id": f"{patient_id}-c1"},
+            {"resourceType": "Encounter", "id": f"{patient_id}-e1"}]))
+    count, _, failed = extract_cohort(PATIENT_IDS, directory=tmp_path, compartment=True, headers={})
+    assert (count, failed) == (6, [])
+    records = {record["patient_id"]: record for record in iter_artifacts("cohort", tmp_path)}
+    assert records["3"] == {"patient_id": "3", "Patient": {"resourceType": "Patient", "id": "3"},
+                            "Condition": [{"resourceType": "Condition", "id": "3-c1"}], "Observation": [],
+                            "Procedure": []}
+    # The per-type routes were never asked
+    assert state["requests"] == []
@@ -0,0 +1,82 @@
+from urllib.parse import parse_qs, urlparse
+import pytest
+from src import compartment, http_client
+from src.compartment import build_compartment_url, fetch_patient_compartment, server_supports_everything
+
+
+@pytest.fixture
+def openemr(stub, monkeypatch):
+    monkeypatch.setattr(http_client, "USE_RESPONSE_CACHE", False)
+    return stub
+
+
+def capability(*operations, resource_operations=()):
+    return {"resourceType": "CapabilityStatement", "rest": [{
+        "operation": [{"name": name} for name in operations],
+        "resource": [{"type": "Patient", "operation": [{"name": name} for name in resource_operations]}]}]}
+
+
+def test_everything_support_is_read_once_per_server(openemr, monkeypatch):
+    server, base_url = openemr
+    calls = []
+    server.routes[("GET", "/metadata")] = lambda handler: calls.append(1) or (
+        200, {}, capability(resource_operations=("everything",)))
+    assert server_supports_everything(base_url, headers={})
+    assert server_supports_everything(base_url, headers={})
+    assert len(calls) == 1
+
+    for statement, supported in ((capability("everything"), True),
+                                 (capability("export", resource_operations=("validate",)), False)):
+        monkeypatch.setattr(compartment, "_everything_support", {})
+        server.routes[("GET", "/metadata")] = (200, {}, statement)
+        assert server_supports_everything(base_url, headers={}) is supported
+    # An unreadable CapabilityStatement means no $everything
+    monkeypatch.setattr(compartment, "_everything_support", {})
+    server.routes[("GET", "/metadata")] = (503, {}, {})
+    assert server_supports_everything(base_url, headers={}) is False
+
+
+def test_compartment_urls():
+    assert build_compartment_url("p1", True, ("Condition",), "http://openemr/fhir") == (
+        "http://openemr/fhir/Patient/p1/$everything?_type=Patient,Condition")
+    assert build_compartment_url("p1", False, ("Condition", "Procedure"), "http://openemr/fhir") == (
+        "http://openemr/fhir/Patient?_id=p1&_revinclude=Condition:patient&_revinclude=Procedure:patient")
+
+
+def test_revinclude_fallback_splits_every_page_by_type(openemr):
+    server, base_url = openemr
+    asked = []
+
+    def search(handler):
+        query = parse_qs(urlparse(handler.path).query)
+        asked.append(query)
+        if "page" not in query:
+            return 200, {}, {"resourceType": "Bundle", "type": "searchset", "entry": [
+                {"resource": {"resourceType": "Patient", "id": "p1"}},
+                {"resource": {"resourceType": "Condition", "id": "c1"}}],
+                "link": [{"relation": "next", "url": f"{base_url}/Patient?_id=p1&page=2"}]}
+        return 200, {}, {"resourceType": "Bundle", "type": "searchset", "entry": [
+            {"resource": {"resourceType": "Observation", "id": "o1"}},
+            {"resource": {"resourceType": "Condition", "id": "c2"}},
+            # Not requested: left out
+            {"resource": {"resourceType": "Encounter", "id": "e1"}},
+            {"search": {"mode": "outcome"}}]}
+
+    server.routes[("GET", "/Patient")] = search
+    found = fetch_patient_compartment("p1", use_everything=False, headers={}, base_url=base_url)
+    assert asked[0]["_revinclude"] == ["Condition:patient", "Observation:patient", "Procedure:patient"]
+    assert found == {"Patient": {"resourceType": "Patient", "id": "p1"},
+                           "Condition": [{"resourceType": "Condition", "id": "c1"},
+                                         {"resourceType": "Condition", "id": "c2"}],
+                           "Observation": [{"resourceType": "Observation", "id": "o1"}], "Procedure": []}
+
+
+def test_everything_is_used_when_the_server_advertises_it(openemr):
+    server, base_url = openemr
+    server.routes[("GET", "/metadata")] = (200, {}, capability("everything"))
+    server.routes[("GET", "/Patient/p2/$everything")] = (200, {}, {"resourceType": "Bundle", "entry": [
+        {"resource": {"resourceType": "Procedure", "id": "pr1"}}]})
+    found = fetch_patient_compartment("p2", headers={}, base_url=base_url)
+    # A compartment without the Patient (e.g. not visible to this client) keeps Patient None
+    assert found == {"Patient": None, "Condition": [], "Observation": [],
+                           "Procedure": [{"resourceType": "Procedure", "id": "pr1"}]}
@@ -0,0 +1,44 @@
+import threading
+import pytest
+from src.adt_conformance import CASES, run_cases, unescape
+from src.er7_serializer import CONTROL_ID_LENGTH, ControlIds, escape
+
+
+def test_delimiters_and_line_breaks_are_escaped_and_decode_back():
+    value = "A|B^C&D~E\\F\rG\nH"
+    escaped = escape(value)
+    assert escaped == "A\\F\\B\\S\\C\\T\\D\\R\\E\\E\\F\\X0D\\G\\X0A\\H"
+    assert not set("|^&~\r\n") & set(escaped)
+    assert unescape(escaped) == value
+    # Text that looks like an escape sequence stays data
+    assert unescape(escape("\\F\\ \\X0D\\")) == "\\F\\ \\X0D\\"
+
+
+def test_template_output_matches_hl7apy_and_decodes_to_the_raw_values():
+    assert run_cases(CASES) == []
+
+
+def test_control_ids_are_unique_across_threads_and_within_20_characters():
+    control_ids = ControlIds()
+    ids = []
+    threads = [threading.Thread(target=lambda: ids.extend(next(control_ids) for _ in range(2000)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 8000
+    assert {len(control_id) for control_id in ids} == {CONTROL_ID_LENGTH}
+    # Two generators (e.g. two processes started in the same second) draw different prefixes
+    assert ControlIds().prefix != control_ids.prefix
+
+
+def test_control_ids_draw_a_new_prefix_instead_of_growing_past_20_characters():
+    prefixes = iter(["A" * 18, "B" * 18])
+    control_ids = ControlIds(prefix_length=18, new_prefix=lambda length: next(prefixes))
+    ids = [next(control_ids) for _ in range(101)]
+    assert ids[99] == "A" * 18 + "99"
+    assert ids[100] == "B" * 18 + "00"
+    assert len(set(ids)) == 101
+    with pytest.raises(ValueError):
+        ControlIds(prefix_length=20)
@@ -0,0 +1,71 @@
+import pytest
+from src import http_client
+from src.http_cache import ResponseCache
+
+
+@pytest.fixture
+def response_cache(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "http_cache.sqlite")
+    monkeypatch.setattr(http_client, "_response_cache", cache)
+    monkeypatch.setattr(http_client, "USE_RESPONSE_CACHE", True)
+    return cache
+
+
+def test_etag_revalidation_serves_a_304_from_disk(stub, response_cache):
+    server, base_url = stub
+    versions = {"etag": 'W/"1"', "family": "Russel"}
+    validators = []
+
+    def read(handler):
+        validators.append(handler.headers.get("If-None-Match"))
+        if handler.headers.get("If-None-Match") == versions["etag"]:
+            return 304, {"ETag": versions["etag"]}, b""
+        return 200, {"ETag": versions["etag"]}, {"resourceType": "Patient", "name": [{"family": versions["family"]}]}
+
+    server.routes[("GET", "/Patient/1")] = read
+    url = f"{base_url}/Patient/1"
+    first = http_client.cached_get(url)
+    second = http_client.cached_get(url)
+    assert validators == [None, 'W/"1"']
+    assert (second.status_code, second.json()) == (200, first.json())
+    assert second.headers["ETag"] == 'W/"1"'
+    assert response_cache.hits == 1
+
+    # The resource changed: the server answers 200 with the new version, which replaces the entry
+    versions.update(etag='W/"2"', family="Russell")
+    assert http_client.cached_get(url).json()["name"][0]["family"] == "Russell"
+    assert response_cache.conditional_headers(url) == {"If-None-Match": 'W/"2"'}
+
+
+def test_last_modified_revalidation_and_uncacheable_responses(stub, response_cache):
+    server, base_url = stub
+    modified = "Wed, 10 Dec 2025 08:00:00 GMT"
+
+    def read(handler):
+        if handler.headers.get("If-Modified-Since") == modified:
+            return 304, {}, b""
+        return 200, {"Last-Modified": modified}, {"resourceType": "Condition", "id": "c1"}
+
+    server.routes[("GET", "/Condition/c1")] = read
+    server.routes[("GET", "/metadata")] = (200, {}, {"resourceType": "CapabilityStatement"})
+    assert http_client.cached_get(f"{base_url}/Condition/c1").json()["id"] == "c1"
+    assert http_client.cached_get(f"{base_url}/Condition/c1").json()["id"] == "c1"
+    assert response_cache.hits == 1
+    # Without a validator there is nothing to revalidate with, so nothing is stored
+    http_client.cached_get(f"{base_url}/metadata")
+    assert response_cache.conditional_headers(f"{base_url}/metadata") == {}
+
+
+def test_least_recently_used_entries_are_evicted_by_size(tmp_path, stub):
+    server, base_url = stub
+    for name in ("a", "b", "c"):
+        server.routes[("GET", f"/{name}")] = (200, {"ETag": f'"{name}"'}, "x" * 100)
+    cache = ResponseCache(tmp_path / "http_cache.sqlite", max_bytes=250)
+    responses = {name: http_client.request("GET", f"{base_url}/{name}") for name in ("a", "b", "c")}
+    cache.store(f"{base_url}/a", responses["a"])
+    cache.store(f"{base_url}/b", responses["b"])
+    assert cache.load(f"{base_url}/a") is not None  # a is now more recently used than b
+    cache.store(f"{base_url}/c", responses["c"])
+    assert cache.evictions == 1
+    assert cache.load(f"{base_url}/b") is None
+    assert cache.load(f"{base_url}/a").text == "x" * 100
@@ -0,0 +1,104 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from src import http_client
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """
+        Fresh pooled sessions for the test; the module defaults are restored afterwards.
+    """
+    monkeypatch.setattr(http_client, "_pool_size", http_client.DEFAULT_POOL_SIZE)
+    monkeypatch.setattr(http_client, "DEFAULT_TIMEOUT", http_client.DEFAULT_TIMEOUT)
+    monkeypatch.setattr(http_client, "_run_memo", None)
+    http_client.close_sessions()
+    yield http_client
+    http_client.close_sessions()
+
+
+def connection_recorder(server):
+    """
+        Route handler answering 200 and keeping the client (host, port) of every request in server.clients.
+    """
+    server.clients = []
+
+    def handler(h):
+        server.clients.append(h.client_address)
+        return 200, {}, {"resourceType": "Patient", "id": "1"}
+    return handler
+
+
+def test_one_session_per_host(pool, stub):
+    _, base_url = stub
+    session = pool.get_session(f"{base_url}/Patient/1")
+    assert pool.get_session(f"{base_url}/Observation?patient=1") is session
+    assert pool.get_session("http://127.0.0.1:1/Patient/1") is not session
+    adapter = session.get_adapter(f"{base_url}/Patient/1")
+    assert adapter._pool_maxsize == http_client.DEFAULT_POOL_SIZE
+
+
+def test_sequential_requests_reuse_one_connection(pool, stub):
+    server, base_url = stub
+    server.routes[("GET", "/Patient/1")] = connection_recorder(server)
+    for _ in range(5):
+        assert pool.get(f"{base_url}/Patient/1").json()["id"] == "1"
+    assert len(server.clients) == 5
+    assert len(set(server.clients)) == 1
+
+
+def test_concurrent_requests_stay_within_the_pool(pool, stub):
+    server, base_url = stub
+    server.routes[("GET", "/Patient/1")] = connection_recorder(server)
+    pool.configure(pool_size=4)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        statuses = list(executor.map(lambda _: pool.get(f"{base_url}/Patient/1").status_code, range(40)))
+    assert statuses == [200] * 40
+    # Connections are handed back to the pool and reused, at most one per worker
+    assert len(set(server.clients)) <= 4
+
+
+def test_configure_pool_size_replaces_the_sessions(pool, stub):
+    _, base_url = stub
+    session = pool.get_session(base_url)
+    pool.configure(pool_size=3)
+    resized = pool.get_session(base_url)
+    assert resized is not session
+    assert resized.get_adapter(base_url)._pool_maxsize == 3
+
+
+def test_close_sessions_opens_a_new_connection(pool, stub):
+    server, base_url = stub
+    server.routes[("GET", "/Patient/1")] = connection_recorder(server)
+    pool.get(f"{base_url}/Patient/1")
+    pool.close_sessions()
+    pool.get(f"{base_url}/Patient/1")
+    assert len(set(server.clients)) == 2
+
+
+def test_default_timeout_applies_unless_overridden(pool, stub):
+    server, base_url = stub
+
+    def slow(h):
+        time.sleep(0.3)
+        return 200, {}, {"resourceType": "Patient"}
+    server.routes[("GET", "/slow")] = slow
+    pool.configure(timeout=(1, 0.05))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        pool.get(f"{base_url}/slow")
+    assert pool.get(f"{base_url}/slow", timeout=(1, 2)).status_code == 200
+
+
+def test_headers_may_be_a_function_called_per_request(pool, stub):
+    server, base_url = stub
+    tokens = iter(["Bearer a", "Bearer b"])
+    server.routes[("POST", "/Patient")] = lambda h: (201, {}, {"auth": h.headers["Authorization"]})
+    headers = lambda: {"Authorization": next(tokens)}
+    assert pool.post(f"{base_url}/Patient", headers=headers, json={}).json() == {"auth": "Bearer a"}
+    assert pool.post(f"{base_url}/Patient", headers=headers, json={}).json() == {"auth": "Bearer b"}
+
+
+def test_url_for_builds_urls_from_host_names():
+    assert http_client.url_for("primary", "Patient") == f"{http_client.PRIMARY_FHIR_URL}/Patient"
+    assert http_client.url_for("hermes") == http_client.BASE_HERMES_URL
@@ -0,0 +1,88 @@
+import pytest
+from src import coding_task_5, icd10_map_index
+from src.icd10_map_index import ICD10_MAP_REFSET_ID, MapIndex, build_index
+
+RF2_HEADER = ("id", "effectiveTime", "active", "moduleId", "refsetId", "referencedComponentId", "mapGroup",
+              "mapPriority", "mapRule", "mapAdvice", "mapTarget", "correlationId", "mapCategoryId")
+
+# (active, refsetId, concept, mapGroup, mapPriority, mapRule, mapAdvice, mapTarget)
+MAP_ROWS = [
+    ("1", ICD10_MAP_REFSET_ID, "44054006", "1", "1", "TRUE", "ALWAYS E11.9", "E11.9"),
+    # Written out of order: the index sorts by concept, group and priority
+    ("1", ICD10_MAP_REFSET_ID, "195967001", "2", "1", "TRUE", "ALWAYS J45.909", "J45.909"),
+    ("1", ICD10_MAP_REFSET_ID, "195967001", "1", "2", "OTHERWISE TRUE", "ALWAYS J45.909", "J45.909"),
+    ("1", ICD10_MAP_REFSET_ID, "195967001", "1", "1", "IFA 445518008 | Age at onset |", "ÉCHELLE", "J45.0"),
+    ("0", ICD10_MAP_REFSET_ID, "38341003", "1", "1", "TRUE", "ALWAYS I10", "I10"),
+    ("1", "999999999", "38341003", "1", "1", "TRUE", "ALWAYS I10", "I10"),
+]
+
+
+def write_rf2(path, rows=MAP_ROWS):
+    lines = ["\t".join(RF2_HEADER)]
+    for number, (active, refset_id, concept, group, priority, rule, advice, target) in enumerate(rows):
+        lines.append("\t".join((f"id-{number}", "20250101", active, "449080006", refset_id, concept, group,
+                                priority, rule, advice, target, "447561005", "447637006")))
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def index(tmp_path):
+    rf2_path = write_rf2(tmp_path / "der2_iisssccRefset_ExtendedMapSnapshot_INT.txt")
+    assert build_index(rf2_path, tmp_path / "icd10_map.idx") == 4
+    index = MapIndex(tmp_path / "icd10_map.idx")
+    yield index
+    index.close()
+
+
+def test_lookup_orders_records_by_group_and_priority(index):
+    records = index.lookup("195967001")
+    assert [(record["mapGroup"], record["mapPriority"], record["mapTarget"]) for record in records] == [
+        (1, 1, "J45.0"), (1, 2, "J45.909"), (2, 1, "J45.909")]
+    assert records[0]["mapRule"] == "IFA 445518008 | Age at onset |"
+    assert records[0]["mapAdvice"] == "ÉCHELLE"
+
+
+def test_lookup_returns_hermes_field_names(index):
+    assert index.lookup(44054006) == [
+        {"mapGroup": 1, "mapPriority": 1, "mapRule": "TRUE", "mapAdvice": "ALWAYS E11.9", "mapTarget": "E11.9"}]
+
+
+def test_inactive_rows_and_other_refsets_are_left_out(index):
+    assert index.record_count == 4
+    assert index.lookup("38341003") == []
+    # Ids around the stored ones bisect to no records
+    assert index.lookup("1") == []
+    assert index.lookup("999999999999") == []
+
+
+def test_build_keeps_the_requested_refset(tmp_path):
+    rf2_path = write_rf2(tmp_path / "snapshot.txt")
+    assert build_index(rf2_path, tmp_path / "other.idx", refset_id="999999999") == 1
+    index = MapIndex(tmp_path / "other.idx")
+    assert [record["mapTarget"] for record in index.lookup("38341003")] == ["I10"]
+    index.close()
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / "not_an_index.idx"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        MapIndex(path)
+
+
+def test_get_map_index_is_none_without_a_built_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(icd10_map_index, "_index", None)
+    assert icd10_map_index.get_map_index(tmp_path / "missing.idx") is None
+
+
+def test_map_snomed_to_icd10_uses_the_index_before_hermes(index, stub, monkeypatch):
+    server, base_url = stub
+    server.routes[("GET", f"/concepts/195967001/map/{ICD10_MAP_REFSET_ID}")] = (200, {}, [{"mapTarget": "X99"}])
+    server.routes[("GET", f"/concepts/73211009/map/{ICD10_MAP_REFSET_ID}")] = (200, {}, [{"mapTarget": "E14.9"}])
+    monkeypatch.setattr(coding_task_5, "BASE_HERMES_URL", base_url)
+    monkeypatch.setattr(icd10_map_index, "_index", index)
+
+    assert coding_task_5.map_snomed_to_icd10("195967001", "Asthma") == ("J45.0", "Asthma")
+    # Concepts the index does not map fall back to Hermes
+    assert coding_task_5.map_snomed_to_icd10("73211009", "Diabetes mellitus") == ("E14.9", "Diabetes mellitus")
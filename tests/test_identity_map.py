@@ -0,0 +1,63 @@
+import json
+from urllib.parse import unquote
+from src.identity_map import IdentityMap, conditional_create
+from src.coding_task_3 import create_observation
+
+
+def patient(family):
+    return {"resourceType": "Patient", "name": [{"family": family, "given": ["James"]}]}
+
+
+def test_conditional_create_posts_once_then_updates_only_changed_content(tmp_path, stub, scheduler):
+    server, base_url = stub
+    calls = []
+
+    def create(handler):
+        calls.append(("POST", handler.headers.get("If-None-Exist"), json.loads(handler.request_body)))
+        return 201, {"Location": f"{base_url}/Patient/p-1/_history/1"}, {"resourceType": "Patient", "id": "p-1"}
+
+    def update(handler):
+        calls.append(("PUT", None, json.loads(handler.request_body)))
+        return 200, {}, {"resourceType": "Patient", "id": "p-1"}
+
+    server.routes[("POST", "/Patient")] = create
+    server.routes[("PUT", "/Patient/p-1")] = update
+    identity_map = IdentityMap(tmp_path / "map.sqlite")
+
+    created = conditional_create(patient("Russel"), "src-1", base_url=base_url, identity_map=identity_map)
+    assert created["id"] == "p-1"
+    assert identity_map.get("Patient", "src-1") == "p-1"
+    method, if_none_exist, body = calls[0]
+    assert method == "POST"
+    assert unquote(if_none_exist).endswith("/Patient|src-1")
+    assert body["identifier"][0]["value"] == "src-1"
+
+    # Same content: answered from the map, nothing is sent
+    assert conditional_create(patient("Russel"), "src-1", base_url=base_url, identity_map=identity_map)["id"] == "p-1"
+    assert len(calls) == 1
+
+    # Changed content: the existing resource is updated in place, not dropped or duplicated
+    conditional_create(patient("Russell"), "src-1", base_url=base_url, identity_map=identity_map)
+    assert [call[0] for call in calls] == ["POST", "PUT"]
+    assert calls[1][2]["id"] == "p-1"
+    assert calls[1][2]["name"][0]["family"] == "Russell"
+
+
+def test_conditional_create_recreates_a_resource_deleted_on_the_server(tmp_path, stub, scheduler):
+    server, base_url = stub
+    server.routes[("PUT", "/Patient/gone")] = (410, {}, {"resourceType": "OperationOutcome"})
+    server.routes[("POST", "/Patient")] = (201, {}, {"resourceType": "Patient", "id": "p-2"})
+    identity_map = IdentityMap(tmp_path / "map.sqlite")
+    identity_map.put("Patient", "src-1", "gone")
+
+    created = conditional_create(patient("Russel"), "src-1", base_url=base_url, identity_map=identity_map)
+    assert created["id"] == "p-2"
+    assert identity_map.get("Patient", "src-1") == "p-2"
+
+
+def test_observation_identifier_depends_on_patient_and_reading(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.coding_task_3.save_artifact", lambda resource: None)
+    first = create_observation("patient-a")["identifier"][0]["value"]
+    assert create_observation("patient-a")["identifier"][0]["value"] == first
+    assert create_observation("patient-b")["identifier"][0]["value"] != first
+    assert create_observation("patient-a", effective="2025-11-28")["identifier"][0]["value"] != first
@@ -0,0 +1,97 @@
+import functools
+import json
+import pytest
+import requests
+from src import incremental
+from src.identity_map import IdentityMap, conditional_create, remap_references
+from src.incremental import load_watermarks, run_incremental
+
+
+def observation(value, last_updated):
+    return {"resourceType": "Observation", "id": "obs-1", "meta": {"lastUpdated": last_updated},
+            "status": "final", "code": {"text": "Heart rate"}, "valueQuantity": {"value": value},
+            "subject": {"reference": "Patient/src-p1"}, "encounter": {"reference": "Encounter/enc-9"},
+            "performer": [{"reference": "Patient/src-p1"}, {"reference": "Practitioner/dr-1"}]}
+
+
+@pytest.fixture
+def primary(tmp_path, stub, scheduler, monkeypatch):
+    """
+        Stub server used as both OpenEMR and the primary server, with a fresh identity map
+        in which source patient src-p1 is loaded as p-1.
+    """
+    server, base_url = stub
+    identity_map = IdentityMap(tmp_path / "map.sqlite")
+    identity_map.put("Patient", "src-p1", "p-1")
+    monkeypatch.setattr(incremental, "conditional_create",
+                        functools.partial(conditional_create, base_url=base_url, identity_map=identity_map))
+    monkeypatch.setattr(incremental, "remap_references",
+                        functools.partial(remap_references, identity_map=identity_map))
+    monkeypatch.setattr(incremental, "load_primary_patient_id", lambda source_id: identity_map.get("Patient", source_id))
+    return server, base_url, identity_map
+
+
+def search_results(*resources):
+    return 200, {}, {"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": r} for r in resources]}
+
+
+def sync(base_url, tmp_path):
+    return run_incremental(resource_types=("Observation",), headers={}, base_url=base_url,
+                           watermark_path=tmp_path / "watermarks.json")
+
+
+def test_changed_resources_are_updated_in_place_and_the_watermark_advances(tmp_path, primary):
+    server, base_url, identity_map = primary
+    writes = []
+    server.routes[("POST", "/Observation")] = lambda handler: writes.append(
+        ("POST", json.loads(handler.request_body))) or (201, {}, {"resourceType": "Observation", "id": "o-1"})
+    server.routes[("PUT", "/Observation/o-1")] = lambda handler: writes.append(
+        ("PUT", json.loads(handler.request_body))) or (200, {}, {"resourceType": "Observation", "id": "o-1"})
+
+    server.routes[("GET", "/Observation")] = search_results(observation(70, "2025-12-01T10:00:00Z"))
+    assert sync(base_url, tmp_path) == {"Observation": 1}
+    server.routes[("GET", "/Observation")] = search_results(observation(72, "2025-12-02T10:00:00Z"))
+    assert sync(base_url, tmp_path) == {"Observation": 1}
+
+    assert [method for method, _ in writes] == ["POST", "PUT"]
+    created = writes[0][1]
+    assert created["subject"] == {"reference": "Patient/p-1"}
+    # The source Encounter and Practitioner are not on the primary server; the Patient performer is remapped
+    assert "encounter" not in created
+    assert created["performer"] == [{"reference": "Patient/p-1"}]
+    assert writes[1][1]["valueQuantity"] == {"value": 72}
+    assert load_watermarks(tmp_path / "watermarks.json") == {"Observation": "2025-12-02T10:00:00Z"}
+
+
+def test_a_failed_load_raises_and_keeps_the_watermark(tmp_path, primary):
+    server, base_url, _ = primary
+    server.routes[("GET", "/Observation")] = search_results(observation(70, "2025-12-01T10:00:00Z"))
+    server.routes[("POST", "/Observation")] = (422, {}, {"resourceType": "OperationOutcome"})
+    with pytest.raises(RuntimeError):
+        sync(base_url, tmp_path)
+    assert load_watermarks(tmp_path / "watermarks.json") == {}
+
+
+def test_a_resource_of_an_unloaded_patient_is_not_sent(tmp_path, primary):
+    server, base_url, _ = primary
+    orphan = observation(70, "2025-12-01T10:00:00Z")
+    orphan["subject"] = {"reference": "Patient/src-unknown"}
+    server.routes[("GET", "/Observation")] = search_results(orphan)
+    posts = []
+    server.routes[("POST", "/Observation")] = lambda handler: posts.append(1) or (201, {}, {})
+    with pytest.raises(RuntimeError, match="src-unknown"):
+        sync(base_url, tmp_path)
+    assert not posts
+
+
+def test_an_unreadable_page_raises_and_keeps_the_watermark(tmp_path, primary):
+    server, base_url, _ = primary
+    first = search_results(observation(70, "2025-12-01T10:00:00Z"))[2]
+    first["link"] = [{"relation": "next", "url": f"{base_url}/Observation?page=2"}]
+    server.routes[("GET", "/Observation")] = lambda handler: (
+        (503, {}, {"resourceType": "OperationOutcome"}) if "page=2" in handler.path else (200, {}, first))
+    server.routes[("POST", "/Observation")] = (201, {}, {"resourceType": "Observation", "id": "o-1"})
+    with pytest.raises(requests.HTTPError):
+        sync(base_url, tmp_path)
+    # obs-1 was loaded, but page 2 was never read: the next run starts from the old watermark again
+    assert load_watermarks(tmp_path / "watermarks.json") == {}
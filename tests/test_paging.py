@@ -0,0 +1,72 @@
+import time
+from urllib.parse import parse_qs, urlparse
+import pytest
+import requests
+from src.paging import get_first_resource, iter_bundle_pages, iter_search_resources
+
+
+def paged_search(server, base_url, pages, fail_page=None):
+    """
+        Serve GET /Observation as `pages` searchset pages of one resource each, chained by next links.
+        Page `fail_page` answers 500. Returns the list of pages requested, in order.
+    """
+    requested = []
+
+    def search(handler):
+        page = int(parse_qs(urlparse(handler.path).query).get("page", ["0"])[0])
+        requested.append(page)
+        if page == fail_page:
+            return 500, {}, {"resourceType": "OperationOutcome"}
+        bundle = {"resourceType": "Bundle", "type": "searchset",
+                  "entry": [{"resource": {"resourceType": "Observation", "id": str(page)}}]}
+        if page + 1 < pages:
+            bundle["link"] = [{"relation": "self", "url": f"{base_url}/Observation?page={page}"},
+                              {"relation": "next", "url": f"{base_url}/Observation?page={page + 1}"}]
+        return 200, {}, bundle
+
+    server.routes[("GET", "/Observation")] = search
+    return requested
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_every_next_link_is_followed(stub, prefetch):
+    server, base_url = stub
+    requested = paged_search(server, base_url, pages=4)
+    resources = list(iter_search_resources(f"{base_url}/Observation", headers={}, prefetch=prefetch))
+    assert [resource["id"] for resource in resources] == ["0", "1", "2", "3"]
+    assert requested == [0, 1, 2, 3]
+
+
+def test_prefetch_requests_the_next_page_while_the_current_one_is_processed(stub):
+    server, base_url = stub
+    requested = paged_search(server, base_url, pages=3)
+    pages = iter_bundle_pages(f"{base_url}/Observation", headers={}, prefetch=True)
+    assert next(pages)["entry"][0]["resource"]["id"] == "0"
+    # Page 1 is requested without the caller asking for it
+    deadline = time.monotonic() + 5
+    while len(requested) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert requested == [0, 1]
+    assert [bundle["entry"][0]["resource"]["id"] for bundle in pages] == ["1", "2"]
+    assert requested == [0, 1, 2]
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_an_error_page_raises_after_the_pages_before_it(stub, prefetch):
+    server, base_url = stub
+    paged_search(server, base_url, pages=4, fail_page=2)
+    seen = []
+    with pytest.raises(requests.HTTPError) as error:
+        for resource in iter_search_resources(f"{base_url}/Observation", headers={}, prefetch=prefetch):
+            seen.append(resource["id"])
+    assert seen == ["0", "1"]
+    assert error.value.response.status_code == 500
+
+
+def test_get_first_resource_reads_only_the_first_page(stub):
+    server, base_url = stub
+    requested = paged_search(server, base_url, pages=3)
+    assert get_first_resource(f"{base_url}/Observation", headers={}) == {"resourceType": "Observation", "id": "0"}
+    assert requested == [0]
+    server.routes[("GET", "/Condition")] = (200, {}, {"resourceType": "Bundle", "type": "searchset"})
+    assert get_first_resource(f"{base_url}/Condition", headers={}) is None
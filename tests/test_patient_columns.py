@@ -0,0 +1,71 @@
+import csv
+import json
+from src.artifact_store import iter_source
+from src.coding_task_5 import extract_pid_fields
+from src.er7_serializer import render_adt_a01
+from src.patient_columns import (DEMOGRAPHIC_FIELDS, iter_demographic_rows, iter_patient_columns, patient_from_row,
+                                 write_patients)
+from src.patient_transform import deidentify_patient
+
+ROWS = [
+    {"id": "1", "family": "Russel", "given": "James", "gender": "male", "birthDate": "2000-06-18",
+     "line": "555 Hahn Village", "city": "Westford", "district": "Middlesex", "state": "MA", "postalCode": "01886"},
+    # No district: the de-identification default applies
+    {"id": "2", "family": "Smith", "given": "Ann", "gender": "female", "birthDate": "1985-01-02",
+     "line": "1 Main St", "city": "Boston", "state": "MA", "postalCode": "02101"},
+    # HL7 delimiters and the escape character are data
+    {"id": "3", "family": "O^Brien & Co", "given": "Mary|Jo", "gender": "unknown", "birthDate": "1970-12-31",
+     "line": "2 Back\\Bay ~ Rd", "city": "Quincy", "state": "MA"},
+    {"id": "4", "family": "Nguyễn", "gender": "other", "city": "Worcester"},
+    # Nothing but an id: no name, gender, birthDate or address
+    {"id": "5"},
+]
+
+
+def write_demographics(path, rows=ROWS):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=DEMOGRAPHIC_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+def per_dict(path):
+    """
+        The per-dict path: one Patient dict per row, de-identified and PID-extracted one at a time.
+    """
+    patients = [patient_from_row(row) for row in iter_demographic_rows(path)]
+    pids = [extract_pid_fields(patient) for patient in patients]
+    return [deidentify_patient(patient) for patient in patients], pids
+
+
+def test_columnar_patients_and_pid_fields_equal_the_per_dict_path(tmp_path):
+    path = write_demographics(tmp_path / "demographics.csv")
+    expected_patients, expected_pids = per_dict(path)
+    # Chunks of 2, so a chunk boundary falls inside the rows
+    chunks = list(iter_patient_columns(path, chunk_size=2))
+    assert [len(columns) for columns in chunks] == [2, 2, 1]
+    assert [patient for columns in chunks for patient in columns.iter_patients()] == expected_patients
+    pids = [pid for columns in chunks for pid in columns.iter_pid_fields()]
+    assert pids == expected_pids
+    assert pids[2]["name"] == "O\\S\\Brien \\T\\ Co^Mary\\F\\Jo"
+    assert (pids[2]["gender"], pids[3]["gender"], pids[4]["gender"]) == ("U", "O", "")
+    assert expected_patients[1]["address"][0]["text"] == "1 Main St Boston, Not found, MA 02101"
+
+    # The ADT builder renders the same message from either
+    condition = {"code": {"coding": [{"code": "61582004", "display": "Allergic rhinitis"}]}}
+    for columnar, expected in zip(pids, expected_pids):
+        assert (render_adt_a01(columnar, condition, "J30.4", "Allergic rhinitis", "20240101120000", "MSG1")
+                == render_adt_a01(expected, condition, "J30.4", "Allergic rhinitis", "20240101120000", "MSG1"))
+
+
+def test_ndjson_input_and_the_demographics_stream(tmp_path):
+    path = tmp_path / "demographics.ndjson"
+    path.write_text("".join(json.dumps(row) + "\n" for row in ROWS))
+    expected_patients, _ = per_dict(write_demographics(tmp_path / "demographics.csv"))
+    count, paths = write_patients(path, tmp_path / "artifacts", chunk_size=3)
+    records = list(iter_source(paths[0]))
+    assert count == len(records) == len(ROWS)
+    # Cohort records, as bundle_loader.py loads them
+    assert [record["patient_id"] for record in records] == [row["id"] for row in ROWS]
+    assert [record["Patient"] for record in records] == expected_patients
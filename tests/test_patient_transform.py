@@ -0,0 +1,59 @@
+import copy
+from src.patient_transform import DEFAULT_DISTRICT, deidentify_patient
+from src.bulk_export import run_bulk_export
+from src.artifact_store import iter_source
+from src.coding_task_5 import extract_pid_fields
+from src.stub_server import start_bulk_export_stub
+
+
+def source_patient(number=0, **fields):
+    patient = {
+        "resourceType": "Patient", "id": str(number), "meta": {"versionId": "1"},
+        "extension": [{"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race"}],
+        "identifier": [{"system": "http://hl7.org/fhir/sid/us-ssn", "value": "999-99-9999"},
+                       {"system": "urn:oid:openemr", "value": f"pubpid-{number}"}],
+        "name": [{"family": "Russel", "given": ["James"]}], "gender": "male", "birthDate": "2000-06-18",
+        "address": [{"line": ["555 Hahn Village"], "city": "Westford", "state": "MA", "postalCode": "00000"}],
+    }
+    patient.update(fields)
+    return patient
+
+
+def test_deidentify_applies_every_rule_to_every_address_and_identifier():
+    patient = deidentify_patient(source_patient(address=[
+        {"line": ["1 Main St"], "city": "Boston", "district": "Suffolk", "state": "MA", "postalCode": "02101"},
+        {"city": "Quincy", "district": "", "state": "MA"},
+    ]))
+    assert not {"id", "meta", "extension"} & patient.keys()
+    assert patient["identifier"] == [{"system": "urn:oid:openemr", "value": "pubpid-0"}]
+    first, second = patient["address"]
+    assert first["text"] == "1 Main St Boston, Suffolk, MA 02101"
+    assert second["district"] == DEFAULT_DISTRICT
+    assert second["text"] == f"Quincy, {DEFAULT_DISTRICT}, MA"
+
+
+def test_deidentify_tolerates_missing_elements():
+    patient = deidentify_patient({"resourceType": "Patient", "id": "1",
+                                  "identifier": [{"system": "http://hl7.org/fhir/sid/us-ssn", "value": "x"}]})
+    assert patient == {"resourceType": "Patient"}
+
+
+def test_bulk_export_patients_match_deidentify_patient(tmp_path):
+    patients = [source_patient(number) for number in range(3)]
+    patients.append(source_patient(3, name=[{"family": "Doe"}], gender="", address=[{"district": " "}]))
+    expected = [deidentify_patient(copy.deepcopy(patient)) for patient in patients]
+    server, base_url = start_bulk_export_stub({"Patient": patients})
+    try:
+        run_bulk_export(resource_types=("Patient",), directory=tmp_path, headers={}, base_url=base_url,
+                        poll_interval=0)
+    finally:
+        server.shutdown()
+    assert list(iter_source("bulk_export", tmp_path)) == expected
+
+
+def test_pid_fields_of_a_sparse_patient_are_empty_components():
+    assert extract_pid_fields({"resourceType": "Patient", "id": "p2"}) == {
+        "patient_id": "p2", "name": "^", "birthdate": "", "gender": "", "address": "^^^^^^H"}
+    pid = extract_pid_fields(source_patient(gender="unknown", name=[{"family": "Smith^Jones", "given": []}],
+                                            address=[{"city": "A&B"}]))
+    assert (pid["gender"], pid["name"], pid["address"]) == ("U", "Smith\\S\\Jones^", "^^A\\T\\B^^^^H")
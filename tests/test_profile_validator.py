@@ -0,0 +1,113 @@
+import io
+import json
+import tarfile
+from src.profile_validator import (CompiledProfile, fetch_profile, has_errors, import_package, is_unchecked,
+                                   load_profiles, validate)
+
+VITAL_SIGNS_URL = "http://hl7.org/fhir/StructureDefinition/vitalsigns"
+
+# Shaped like the R4 core vitalsigns differential: the VSCat slice is discriminated by the
+# values fixed on its children, not by a pattern on the slice
+VITAL_SIGNS = {
+    "resourceType": "StructureDefinition", "id": "vitalsigns", "url": VITAL_SIGNS_URL, "version": "4.0.1",
+    "type": "Observation", "derivation": "constraint",
+    "differential": {"element": [
+        {"id": "Observation", "path": "Observation"},
+        {"id": "Observation.category", "path": "Observation.category", "min": 1,
+         "slicing": {"discriminator": [{"type": "value", "path": "coding.code"},
+                                       {"type": "value", "path": "coding.system"}], "rules": "open"}},
+        {"id": "Observation.category:VSCat", "path": "Observation.category", "sliceName": "VSCat",
+         "min": 1, "max": "1"},
+        {"id": "Observation.category:VSCat.coding", "path": "Observation.category.coding", "min": 1},
+        {"id": "Observation.category:VSCat.coding.system", "path": "Observation.category.coding.system",
+         "min": 1, "max": "1", "fixedUri": "http://terminology.hl7.org/CodeSystem/observation-category"},
+        {"id": "Observation.category:VSCat.coding.code", "path": "Observation.category.coding.code",
+         "min": 1, "max": "1", "fixedCode": "vital-signs"},
+        {"id": "Observation.subject", "path": "Observation.subject", "min": 1,
+         "type": [{"code": "Reference", "targetProfile": ["http://hl7.org/fhir/StructureDefinition/Patient"]}]},
+        {"id": "Observation.effective[x]", "path": "Observation.effective[x]", "min": 1},
+        {"id": "Observation.component.value[x]:valueQuantity.system",
+         "path": "Observation.component.value[x].system", "fixedUri": "http://unitsofmeasure.org"},
+    ]},
+}
+
+
+def observation(*categories, subject="Patient/p-1"):
+    return {"resourceType": "Observation", "meta": {"profile": [VITAL_SIGNS_URL]}, "status": "final",
+            "category": [{"coding": [{"system": system, "code": code}]} for system, code in categories],
+            "subject": {"reference": subject}, "effectiveDateTime": "2025-11-27",
+            "component": [{"valueQuantity": {"value": 120, "system": "http://unitsofmeasure.org"}}]}
+
+
+VITAL_SIGNS_CATEGORY = ("http://terminology.hl7.org/CodeSystem/observation-category", "vital-signs")
+
+
+def test_slice_discriminated_by_fixed_children():
+    profiles = {VITAL_SIGNS_URL: CompiledProfile(VITAL_SIGNS)}
+    assert not has_errors(validate(observation(VITAL_SIGNS_CATEGORY), profiles))
+    # Other categories are allowed (open slicing) and are not held to the VSCat values
+    assert not has_errors(validate(observation(VITAL_SIGNS_CATEGORY, ("http://example.org/cs", "x")), profiles))
+
+    outcome = validate(observation(("http://example.org/cs", "vital-signs")), profiles)
+    assert [found["diagnostics"] for found in outcome["issue"]] == [
+        "Observation.category:VSCat: minimum required = 1, but only found 0"]
+
+    outcome = validate(observation(VITAL_SIGNS_CATEGORY, VITAL_SIGNS_CATEGORY), profiles)
+    assert outcome["issue"][0]["diagnostics"] == "Observation.category:VSCat: max allowed = 1, but found 2"
+
+
+def test_references_and_choice_type_slices():
+    profiles = {VITAL_SIGNS_URL: CompiledProfile(VITAL_SIGNS)}
+    resource = observation(VITAL_SIGNS_CATEGORY, subject="Group/g-1")
+    resource["component"][0]["valueQuantity"]["system"] = "http://example.org/units"
+    expressions = sorted(found["expression"][0] for found in validate(resource, profiles)["issue"])
+    assert expressions == ["Observation.component[0].valueQuantity.system", "Observation.subject.reference"]
+
+
+def test_extension_slices_are_discriminated_by_their_profile():
+    race = "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race"
+    profile = CompiledProfile({
+        "resourceType": "StructureDefinition", "url": "http://example.org/p", "type": "Patient",
+        "differential": {"element": [
+            {"id": "Patient.extension:race", "path": "Patient.extension", "sliceName": "race", "min": 1,
+             "type": [{"code": "Extension", "profile": [race]}]},
+        ]},
+    })
+    assert profile.validate({"resourceType": "Patient", "extension": [{"url": race}]}) == []
+    assert len(profile.validate({"resourceType": "Patient", "extension": [{"url": "http://example.org/x"}]})) == 1
+
+
+def test_unknown_profiles_are_reported_as_unchecked():
+    outcome = validate(observation(VITAL_SIGNS_CATEGORY), profiles={})
+    assert is_unchecked(outcome) and not has_errors(outcome)
+
+
+def test_profiles_are_fetched_from_the_server(tmp_path, stub):
+    server, base_url = stub
+    requested = []
+
+    def search(handler):
+        requested.append(handler.path)
+        return 200, {}, {"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": VITAL_SIGNS}]}
+
+    server.routes[("GET", "/StructureDefinition")] = search
+    assert fetch_profile(VITAL_SIGNS_URL, base_url=base_url, directory=tmp_path) == VITAL_SIGNS
+    assert "url=http%3A%2F%2Fhl7.org%2Ffhir%2FStructureDefinition%2Fvitalsigns" in requested[0]
+    profiles = load_profiles(tmp_path)
+    assert profiles[VITAL_SIGNS_URL].version == "4.0.1"
+
+
+def test_profiles_are_imported_from_a_package(tmp_path):
+    package_path = tmp_path / "package.tgz"
+    with tarfile.open(package_path, "w:gz") as package:
+        for name, content in (("package/StructureDefinition-vitalsigns.json", VITAL_SIGNS),
+                              ("package/StructureDefinition-Observation.json",
+                               {"resourceType": "StructureDefinition", "url": "http://hl7.org/fhir/Observation",
+                                "type": "Observation", "derivation": "specialization"}),
+                              ("package/package.json", {"name": "hl7.fhir.r4.core"})):
+            data = json.dumps(content).encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            package.addfile(info, io.BytesIO(data))
+    assert import_package(package_path, directory=tmp_path / "profiles") == [VITAL_SIGNS_URL]
+    assert list(load_profiles(tmp_path / "profiles")) == [VITAL_SIGNS_URL]
@@ -0,0 +1,92 @@
+import pytest
+from src.resource_templates import (CONDITION_SKELETON, CONDITION_TEMPLATE, COMPONENT_INTERPRETATIONS,
+                                    PANEL_INTERPRETATIONS, ResourceTemplate, Slot, build_blood_pressure, thaw)
+
+
+def fill(skeleton, values):
+    """
+        The resource a template should build: a fresh copy of the skeleton with every Slot filled.
+    """
+    if isinstance(skeleton, Slot):
+        value = values[skeleton.name]
+        return value if skeleton.format is None else skeleton.format.format(value)
+    if isinstance(skeleton, dict):
+        return {key: fill(value, values) for key, value in skeleton.items()}
+    if isinstance(skeleton, list):
+        return [fill(value, values) for value in skeleton]
+    return skeleton
+
+
+CONDITION_VALUES = {"code": "61582004", "display": "Allergic rhinitis", "onset": "2024-01-01", "patient_id": "7"}
+
+
+def test_build_fills_every_slot_like_a_dict_literal():
+    condition = CONDITION_TEMPLATE.build(**CONDITION_VALUES)
+    assert condition == fill(CONDITION_SKELETON, CONDITION_VALUES)
+    assert condition["subject"] == {"reference": "Patient/7"}
+    assert condition["code"]["coding"][0]["code"] == "61582004"
+    assert condition["text"]["div"] == '<div xmlns="http://www.w3.org/1999/xhtml"><p>Allergic rhinitis</p></div>'
+
+
+def test_constant_subtrees_are_shared_and_slotted_paths_are_not():
+    first = CONDITION_TEMPLATE.build(**CONDITION_VALUES)
+    second = CONDITION_TEMPLATE.build(**{**CONDITION_VALUES, "patient_id": "8"})
+    assert first["clinicalStatus"] is second["clinicalStatus"]
+    assert first["bodySite"] is second["bodySite"]
+    # Containers leading to a slot are new for every resource
+    assert first is not second
+    assert first["subject"] is not second["subject"]
+    assert first["code"] is not second["code"]
+    assert first["code"]["coding"][0] is not second["code"]["coding"][0]
+    assert first["subject"] == {"reference": "Patient/7"}
+
+
+def test_share_constants_off_builds_independent_resources():
+    template = ResourceTemplate(CONDITION_SKELETON, share_constants=False)
+    first = template.build(**CONDITION_VALUES)
+    second = template.build(**CONDITION_VALUES)
+    assert first == second == CONDITION_TEMPLATE.build(**CONDITION_VALUES)
+    assert first["clinicalStatus"] is not second["clinicalStatus"]
+    assert first["category"][0]["coding"] is not second["category"][0]["coding"]
+
+
+def test_skeleton_is_copied_at_compile_time():
+    skeleton = {"resourceType": "Patient", "id": Slot("id"), "meta": {"versionId": "1"}}
+    template = ResourceTemplate(skeleton)
+    skeleton["meta"]["versionId"] = "2"
+    assert template.build(id="1") == {"resourceType": "Patient", "id": "1", "meta": {"versionId": "1"}}
+    assert template.verify()
+
+
+def test_template_without_slot_is_rejected():
+    with pytest.raises(ValueError):
+        ResourceTemplate({"resourceType": "Patient", "active": True})
+
+
+def test_verify_detects_in_place_changes_and_thaw_avoids_them():
+    template = ResourceTemplate(CONDITION_SKELETON)
+    thawed = thaw(template.build(**CONDITION_VALUES))
+    thawed["clinicalStatus"]["coding"][0]["code"] = "resolved"
+    assert template.verify()
+    assert template.build(**CONDITION_VALUES)["clinicalStatus"]["coding"][0]["code"] == "active"
+
+    shared = template.build(**CONDITION_VALUES)
+    shared["clinicalStatus"]["coding"][0]["code"] = "resolved"
+    assert not template.verify()
+
+
+def test_build_blood_pressure_uses_the_interpretation_codes():
+    observation = build_blood_pressure("7", "urn:uuid:1", "2024-01-01T10:00:00Z", 150, 85,
+                                       systolic_code="H", panel_code="H")
+    systolic, diastolic = observation["component"]
+    assert observation["subject"] == {"reference": "Patient/7"}
+    assert observation["identifier"] == [{"system": "urn:ietf:rfc:3986", "value": "urn:uuid:1"}]
+    assert observation["effectiveDateTime"] == "2024-01-01T10:00:00Z"
+    assert observation["interpretation"] is PANEL_INTERPRETATIONS["H"]
+    assert systolic["valueQuantity"]["value"] == 150
+    assert systolic["interpretation"] is COMPONENT_INTERPRETATIONS["H"]
+    assert diastolic["valueQuantity"] == {"value": 85, "unit": "mmHg", "system": "http://unitsofmeasure.org",
+                                          "code": "mm[Hg]"}
+    assert diastolic["interpretation"] is COMPONENT_INTERPRETATIONS["N"]
+    # The other observation elements are shared between panels
+    assert observation["code"] is build_blood_pressure("8", "urn:uuid:2", "2024", 120, 80)["code"]
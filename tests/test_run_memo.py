@@ -0,0 +1,61 @@
+import threading
+import time
+from src import http_client
+from src.run_memo import RunMemo
+
+
+def test_repeated_gets_in_a_run_share_one_network_call(stub):
+    server, base_url = stub
+    calls = []
+
+    def read(handler):
+        calls.append(handler.headers.get("Authorization"))
+        time.sleep(0.05)
+        return 200, {}, {"resourceType": "Patient", "id": "1"}
+
+    server.routes[("GET", "/Patient/1")] = read
+    url = f"{base_url}/Patient/1"
+    with http_client.run_scope() as memo:
+        headers = {"Authorization": "Bearer a"}
+        threads = [threading.Thread(target=http_client.get, args=(url,), kwargs={"headers": headers}) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Single flight: the concurrent GETs waited for the first one
+        assert calls == ["Bearer a"]
+        # Another token is another auth scope, so its response is not replayed
+        http_client.get(url, headers={"Authorization": "Bearer b"})
+        assert calls == ["Bearer a", "Bearer b"]
+    assert (memo.requests, memo.saved) == (6, 4)
+
+    # Outside a run every GET goes to the network
+    http_client.get(url, headers={"Authorization": "Bearer a"})
+    assert len(calls) == 3
+
+
+def test_errors_are_not_memoized(stub):
+    server, base_url = stub
+    statuses = [503, 200]
+    server.routes[("GET", "/Patient/1")] = lambda handler: (statuses.pop(0), {}, {"resourceType": "Patient"})
+    with http_client.run_scope():
+        assert http_client.get(f"{base_url}/Patient/1").status_code == 503
+        assert http_client.get(f"{base_url}/Patient/1").status_code == 200
+    assert statuses == []
+
+
+def test_least_recently_used_entries_are_dropped():
+    memo = RunMemo(max_entries=2)
+
+    class Ok:
+        status_code = 200
+
+    fetched = []
+
+    def fetch(name):
+        return lambda: fetched.append(name) or Ok()
+
+    for name in ("a", "b", "a", "c", "a", "b"):
+        memo.get_or_fetch(RunMemo.key(f"http://openemr/{name}", params={"_count": 10}), fetch(name))
+    # "a" stayed recent; "b" was dropped when "c" came in and had to be fetched again
+    assert fetched == ["a", "b", "c", "b"]
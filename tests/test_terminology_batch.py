@@ -0,0 +1,64 @@
+import threading
+import time
+import requests
+from src import coding_task_1, terminology_batch
+from src.coding_task_1 import get_parent_for_condition
+from src.terminology_batch import resolve_codes
+
+
+def test_operations_share_one_pool_and_keep_their_own_in_flight_caps(monkeypatch):
+    lock = threading.Lock()
+    in_flight = {"parents": 0, "children": 0}
+    peak = dict(in_flight)
+    threads = set()
+
+    def tracked(operation):
+        def resolve(code):
+            with lock:
+                in_flight[operation] += 1
+                peak[operation] = max(peak[operation], in_flight[operation])
+                threads.add(threading.current_thread().name)
+            time.sleep(0.005)
+            with lock:
+                in_flight[operation] -= 1
+            return [f"{operation}-of-{code}"]
+        return resolve
+
+    for operation in in_flight:
+        monkeypatch.setitem(terminology_batch.OPERATIONS, operation, tracked(operation))
+    codes = [str(code) for code in range(30)] + ["1", "2"]
+    table = resolve_codes(codes, operations=("parents", "children"), max_in_flight={"parents": 2, "children": 3})
+
+    assert sorted(table) == sorted(set(codes))
+    assert table["7"] == {"parents": ["parents-of-7"], "children": ["children-of-7"]}
+    assert peak == {"parents": 2, "children": 3}
+    # One pool of 2 + 3 workers, not a pool per operation
+    assert len({name.rsplit("_", 1)[0] for name in threads}) == 1
+    assert len(threads) <= 5
+
+
+def test_a_failed_lookup_is_recorded_and_the_batch_goes_on(monkeypatch):
+    def parents(code):
+        if code == "2":
+            raise requests.exceptions.ConnectionError("Hermes went away")
+        return [{"conceptId": f"parent-of-{code}"}]
+
+    monkeypatch.setitem(terminology_batch.OPERATIONS, "parents", parents)
+    table = resolve_codes(["1", "2", "3"], operations=("parents",), max_in_flight={"parents": 1})
+    assert table == {"1": {"parents": [{"conceptId": "parent-of-1"}]}, "2": {"parents": None},
+                     "3": {"parents": [{"conceptId": "parent-of-3"}]}}
+
+
+def test_tables_without_an_answer_fall_back_to_search_constraint(monkeypatch):
+    asked = []
+    monkeypatch.setattr(coding_task_1, "search_constraint",
+                        lambda expression, code: asked.append((expression, code)) or
+                        [{"conceptId": "19829001", "preferredTerm": "Disorder of lung"}])
+    condition = {"code": {"coding": [{"system": "http://snomed.info/sct", "code": "233604007"}]}}
+    # Built for children only, and a failed parents lookup: both go to search_constraint
+    for lookup in ({"233604007": {"children": []}}, {"233604007": {"parents": None}}):
+        assert get_parent_for_condition(condition, lookup=lookup) == ("19829001", "Disorder of lung")
+    assert asked == [(">!", "233604007")] * 2
+    lookup = {"233604007": {"parents": [{"conceptId": "404684003", "preferredTerm": "Clinical finding"}]}}
+    assert get_parent_for_condition(condition, lookup=lookup) == ("404684003", "Clinical finding")
+    assert len(asked) == 2
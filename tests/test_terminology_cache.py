@@ -0,0 +1,191 @@
+from urllib.parse import parse_qs, urlparse
+import pytest
+from src import terminology_cache
+from src.coding_task_2 import get_child_for_condition
+from src.snomed_graph import SnomedGraph, build_graph
+from src.terminology_cache import TerminologyCache, search_constraint, snomed_release
+
+RELATIONSHIP_HEADER = "id\teffectiveTime\tactive\tmoduleId\tsourceId\tdestinationId\trelationshipGroup\ttypeId\n"
+DESCRIPTION_HEADER = "id\teffectiveTime\tactive\tmoduleId\tconceptId\tlanguageCode\ttypeId\tterm\tcaseSignificanceId\n"
+
+# Clinical finding <- Disorder of lung <- Pneumonia <- {Bacterial, Viral} pneumonia
+IS_A = [("19829001", "404684003"), ("233604007", "19829001"), ("53084003", "233604007"),
+        ("75570004", "233604007")]
+TERMS = {"404684003": "Clinical finding", "19829001": "Disorder of lung", "233604007": "Pneumonia",
+         "53084003": "Bacterial pneumonia", "75570004": "Viral pneumonia"}
+
+
+def children(code):
+    return {source for source, destination in IS_A if destination == code}
+
+
+def parents(code):
+    return {destination for source, destination in IS_A if source == code}
+
+
+def closure(code, step):
+    found, frontier = set(), step(code)
+    while frontier:
+        found |= frontier
+        frontier = set().union(*(step(concept) for concept in frontier)) - found
+    return found
+
+
+# What Hermes answers for each constraint operator of the fixture hierarchy
+HERMES_OPERATORS = {">!": parents, "<!": children, ">": lambda code: closure(code, parents),
+                    "<": lambda code: closure(code, children)}
+
+
+def write_rf2(directory):
+    relationships = directory / "sct2_Relationship_Snapshot.txt"
+    relationships.write_text(RELATIONSHIP_HEADER + "".join(
+        f"{number}\t20250101\t1\t900000000000207008\t{source}\t{destination}\t0\t116680003\n"
+        for number, (source, destination) in enumerate(IS_A)))
+    descriptions = directory / "sct2_Description_Snapshot.txt"
+    descriptions.write_text(DESCRIPTION_HEADER + "".join(
+        f"{number}\t20250101\t1\t900000000000207008\t{concept}\ten\t900000000000013009\t{term}\t900000000000448009\n"
+        for number, (concept, term) in enumerate(TERMS.items())))
+    return relationships, descriptions
+
+
+@pytest.fixture
+def hermes(tmp_path, stub, monkeypatch):
+    """
+        A stub Hermes answering /search from the fixture hierarchy; yields the list of constraints it was asked.
+    """
+    server, base_url = stub
+    asked = []
+
+    def search(handler):
+        constraint = parse_qs(urlparse(handler.path).query)["constraint"][0]
+        asked.append(constraint)
+        code = constraint.lstrip("<>!")
+        expression = constraint[:len(constraint) - len(code)]
+        concepts = HERMES_OPERATORS[expression](code)
+        # Not in id order, like Hermes
+        return 200, {}, [{"conceptId": concept, "preferredTerm": TERMS[concept]}
+                         for concept in sorted(concepts, reverse=True)]
+
+    server.routes[("GET", "/search")] = search
+    monkeypatch.setattr(terminology_cache, "BASE_HERMES_URL", base_url)
+    cache = TerminologyCache(tmp_path / "cache.sqlite", release="test")
+    monkeypatch.setattr(terminology_cache, "get_terminology_cache", lambda: cache)
+    yield asked
+
+
+def use_graph(monkeypatch, graph):
+    monkeypatch.setattr(terminology_cache, "get_snomed_graph", lambda: graph)
+
+
+def answer(expression, code):
+    return {(concept["conceptId"], concept["preferredTerm"]) for concept in search_constraint(expression, code)}
+
+
+def test_graph_answers_equal_hermes_answers(tmp_path, hermes, monkeypatch):
+    relationships, descriptions = write_rf2(tmp_path)
+    build_graph(relationships, descriptions, graph_dir=tmp_path / "graph")
+    for expression in HERMES_OPERATORS:
+        for code in TERMS:
+            use_graph(monkeypatch, None)
+            from_hermes = answer(expression, code)
+            use_graph(monkeypatch, SnomedGraph(tmp_path / "graph"))
+            assert answer(expression, code) == from_hermes, (expression, code)
+    # Every graph answer came from the graph: Hermes was asked once per question, for the reference answer
+    assert len(hermes) == len(HERMES_OPERATORS) * len(TERMS)
+
+
+def test_codes_missing_from_the_graph_go_to_hermes(tmp_path, hermes, monkeypatch):
+    relationships, descriptions = write_rf2(tmp_path)
+    build_graph(relationships, descriptions, graph_dir=tmp_path / "graph")
+    use_graph(monkeypatch, SnomedGraph(tmp_path / "graph"))
+    # A concept newer than the graph's release: Hermes knows it, the graph does not
+    IS_A.append(("441590008", "233604007"))
+    TERMS["441590008"] = "Abscess of lung"
+    try:
+        assert answer(">!", "441590008") == {("233604007", "Pneumonia")}
+    finally:
+        IS_A.pop()
+        del TERMS["441590008"]
+    assert hermes == [">!441590008"]
+
+
+def test_graph_without_terms_falls_back_to_hermes(tmp_path, hermes, monkeypatch):
+    relationships, _ = write_rf2(tmp_path)
+    build_graph(relationships, graph_dir=tmp_path / "graph")
+    use_graph(monkeypatch, SnomedGraph(tmp_path / "graph"))
+    assert answer("<!", "233604007") == {("53084003", "Bacterial pneumonia"), ("75570004", "Viral pneumonia")}
+    assert hermes == ["<!233604007"]
+
+
+def test_non_snomed_codes_are_not_in_the_graph(tmp_path, hermes, monkeypatch):
+    relationships, descriptions = write_rf2(tmp_path)
+    build_graph(relationships, descriptions, graph_dir=tmp_path / "graph")
+    graph = SnomedGraph(tmp_path / "graph")
+    assert not graph.has("J18.9") and graph.constraint("<!", "J18.9") == []
+    use_graph(monkeypatch, graph)
+    HERMES_OPERATORS["<!"] = lambda code: set()
+    try:
+        assert search_constraint("<!", "J18.9") == []
+    finally:
+        HERMES_OPERATORS["<!"] = children
+    assert hermes == ["<!J18.9"]
+
+
+def test_the_picked_child_does_not_depend_on_who_answered(tmp_path, hermes, monkeypatch):
+    relationships, descriptions = write_rf2(tmp_path)
+    build_graph(relationships, descriptions, graph_dir=tmp_path / "graph")
+    condition = {"code": {"coding": [{"system": "http://snomed.info/sct", "code": "233604007"}]}}
+    use_graph(monkeypatch, None)
+    from_hermes = get_child_for_condition(condition)
+    use_graph(monkeypatch, SnomedGraph(tmp_path / "graph"))
+    assert get_child_for_condition(condition) == from_hermes == ("53084003", "Bacterial pneumonia")
+
+
+def test_release_comes_from_the_hermes_status(stub, monkeypatch):
+    server, base_url = stub
+    server.routes[("GET", "/status")] = (200, {}, {"releases": [
+        "SNOMED Clinical Terms version: 20250101 [R] (January 2025 Release)",
+        "SNOMED CT United Kingdom clinical extension: 20250115 [R]"]})
+    monkeypatch.setattr(terminology_cache, "BASE_HERMES_URL", base_url)
+    assert snomed_release() == "20250101+20250115"
+
+
+def test_hermes_outages_keep_the_stored_release_while_a_graph_exists(tmp_path, stub, monkeypatch):
+    server, base_url = stub
+    status = {"releases": ["SNOMED Clinical Terms version: 20250101 [R] (January 2025 Release)"]}
+    server.routes[("GET", "/status")] = (200, {}, status)
+    monkeypatch.setattr(terminology_cache, "BASE_HERMES_URL", base_url)
+    relationships, descriptions = write_rf2(tmp_path)
+    build_graph(relationships, descriptions, graph_dir=tmp_path / "graph")
+    use_graph(monkeypatch, SnomedGraph(tmp_path / "graph"))
+    path = tmp_path / "cache.sqlite"
+
+    # Nothing stored and Hermes down: the empty cache starts under the graph's RF2 release
+    server.routes[("GET", "/status")] = (503, {}, {})
+    assert TerminologyCache(path).release == "20250101"
+
+    server.routes[("GET", "/status")] = (200, {}, status)
+    TerminologyCache(path).put(">!", "233604007", [{"conceptId": "19829001"}])
+    for available in (False, True, False, True):
+        server.routes[("GET", "/status")] = (200, {}, status) if available else (503, {}, {})
+        cache = TerminologyCache(path)
+        assert cache.release == "20250101"
+        assert cache.get(">!", "233604007") == [{"conceptId": "19829001"}], available
+
+    # Only a release change Hermes reports drops the old answers
+    server.routes[("GET", "/status")] = (200, {}, {"releases": ["SNOMED CT version: 20250701 [R]"]})
+    assert TerminologyCache(path).get(">!", "233604007") is None
+
+
+def test_an_outage_keeps_entries_of_a_release_the_graph_does_not_match(tmp_path, stub, monkeypatch):
+    server, base_url = stub
+    server.routes[("GET", "/status")] = (503, {}, {})
+    monkeypatch.setattr(terminology_cache, "BASE_HERMES_URL", base_url)
+    path = tmp_path / "cache.sqlite"
+    TerminologyCache(path, release="20240701+20240715").put(">!", "233604007", [{"conceptId": "19829001"}])
+    relationships, descriptions = write_rf2(tmp_path)
+    build_graph(relationships, descriptions, graph_dir=tmp_path / "graph")
+    use_graph(monkeypatch, SnomedGraph(tmp_path / "graph"))
+    cache = TerminologyCache(path)
+    assert cache.release == "20240701+20240715"
+    assert cache.get(">!", "233604007") == [{"conceptId": "19829001"}]
@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from itertools import count
+from src import bulk_export, http_client
+from src.bulk_export import run_bulk_export
+from src.stub_server import start_bulk_export_stub
+from src.token_provider import TokenProvider
+
+
+def expiring_token_file(tmp_path, token="old", expires_in=30):
+    path = tmp_path / "access_token.json"
+    path.write_text(json.dumps({"access_token": token, "expires_in": expires_in}))
+    return path
+
+
+def test_expiring_token_is_renewed_once_for_concurrent_callers(tmp_path):
+    renewals = []
+
+    def renew():
+        renewals.append(1)
+        time.sleep(0.05)
+        return {"access_token": "new", "expires_in": 3600}
+
+    provider = TokenProvider(expiring_token_file(tmp_path), refresh_margin=60, renew=renew)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(provider.get_token())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ["new"] * 8
+    assert len(renewals) == 1
+    assert provider.get_headers() == {"Authorization": "Bearer new"}
+
+
+def test_failed_renew_backs_off_instead_of_renewing_on_every_call(tmp_path):
+    answers = [None, {"access_token": "new", "expires_in": 3600}]
+    renewals = []
+
+    def renew():
+        renewals.append(1)
+        return answers.pop(0)
+
+    provider = TokenProvider(expiring_token_file(tmp_path), refresh_margin=60, renew=renew, retry_base=0.2)
+    for _ in range(20):
+        assert provider.get_token() == "old"
+    assert len(renewals) == 1
+    assert provider.failures == 1
+    # A 401 within the backoff does not hit the token endpoint again either
+    assert provider.refresh_authorization("Bearer old") == "Bearer old"
+    assert len(renewals) == 1
+
+    # Once the backoff is over, the background retry renews the token
+    deadline = time.monotonic() + 5
+    while provider.access_token != "new" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert provider.get_token() == "new"
+    assert len(renewals) == 2
+    assert provider.failures == 0
+
+
+def test_bulk_export_asks_for_fresh_headers_on_every_request(tmp_path, monkeypatch):
+    tokens = count()
+    monkeypatch.setattr(bulk_export, "get_headers", lambda: {"Authorization": f"Bearer token-{next(tokens)}"})
+    server, base_url = start_bulk_export_stub({"Condition": [{"resourceType": "Condition", "id": "c1"}]},
+                                              pending_polls=2)
+    seen = []
+
+    def recording(route):
+        def handle(handler):
+            seen.append(handler.headers.get("Authorization"))
+            return route(handler) if callable(route) else route
+        return handle
+
+    server.routes = {key: recording(route) for key, route in server.routes.items()}
+    try:
+        counts = run_bulk_export(resource_types=("Condition",), directory=tmp_path, base_url=base_url,
+                                 poll_interval=0)
+    finally:
+        server.shutdown()
+    assert counts == {"Condition": 1}
+    # Kick-off, three status polls and the download each carried the token current at the time
+    assert seen == [f"Bearer token-{number}" for number in range(5)]
+
+
+def test_a_401_is_not_retried_while_the_renewal_backs_off(tmp_path, stub, monkeypatch):
+    server, base_url = stub
+    seen = []
+    server.routes[("GET", "/Patient/1")] = lambda handler: seen.append(handler.headers["Authorization"]) or (
+        (200, {}, {"resourceType": "Patient"}) if handler.headers["Authorization"] == "Bearer new" else (401, {}, {}))
+    answers = [None, {"access_token": "new", "expires_in": 3600}]
+    provider = TokenProvider(expiring_token_file(tmp_path, expires_in=3600), renew=lambda: answers.pop(0),
+                             retry_base=60)
+    monkeypatch.setattr(http_client, "_auth_refresher", provider.refresh_authorization)
+
+    # The renewal fails and backs off: the same stale token would only get another 401
+    assert http_client.request("GET", f"{base_url}/Patient/1", headers=provider.get_headers()).status_code == 401
+    assert seen == ["Bearer old"]
+    assert http_client.request("GET", f"{base_url}/Patient/1", headers=provider.get_headers()).status_code == 401
+    assert seen == ["Bearer old"] * 2
+
+    # Once the backoff is over, the 401 is retried with the renewed token
+    provider.retry_at = 0.0
+    assert http_client.request("GET", f"{base_url}/Patient/1", headers=provider.get_headers()).status_code == 200
+    assert seen == ["Bearer old"] * 3 + ["Bearer new"]
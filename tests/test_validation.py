@@ -0,0 +1,77 @@
+import pytest
+from src import profile_validator, validation, validation_cache
+from src.validation import validate_on_server, validate_resource
+from src.validation_cache import ValidationCache
+
+UNKNOWN_PROFILE = "http://example.org/fhir/StructureDefinition/not-available"
+
+
+@pytest.fixture
+def server(stub, scheduler, tmp_path, monkeypatch):
+    """
+        Stub primary server with an empty validation cache and no local profiles (nor fetches).
+    """
+    server, base_url = stub
+    monkeypatch.setattr(validation, "PRIMARY_FHIR_URL", base_url)
+    monkeypatch.setattr(validation_cache, "_cache", ValidationCache(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(profile_validator, "_profiles", {})
+    monkeypatch.setattr(profile_validator, "_missing", {UNKNOWN_PROFILE})
+    return server
+
+
+def patient(birth_date, *profiles):
+    return {"resourceType": "Patient", "meta": {"profile": list(profiles)}, "birthDate": birth_date}
+
+
+def server_error(diagnostics):
+    return {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "required",
+                                                           "diagnostics": diagnostics}]}
+
+
+def test_a_failed_validate_call_is_a_fatal_outcome(server):
+    server.routes[("POST", "/Patient/$validate")] = (200, {}, server_error("Patient.name: minimum 1"))
+    assert validate_on_server(patient("1990-01-01"), verbose=False) == server_error("Patient.name: minimum 1")
+
+    server.routes[("POST", "/Patient/$validate")] = (500, {}, "<html>Internal Server Error</html>")
+    assert validate_on_server(patient("1990-01-01"), verbose=False)["issue"] == [
+        {"severity": "fatal", "code": "exception", "diagnostics": "Server $validate answered 500"}]
+
+    # A server that rejects the request with an OperationOutcome keeps its issues after the fatal one
+    server.routes[("POST", "/Patient/$validate")] = (422, {}, server_error("Unknown resource"))
+    issues = validate_on_server(patient("1990-01-01"), verbose=False)["issue"]
+    assert [found["severity"] for found in issues] == ["fatal", "error"]
+    assert issues[1]["diagnostics"] == "Unknown resource"
+
+
+def test_unchecked_profiles_go_to_the_server_whatever_the_sample(server):
+    calls = []
+    server.routes[("POST", "/Patient/$validate")] = lambda handler: calls.append(1) or (
+        200, {}, server_error("Patient.identifier: minimum 1"))
+    resource = patient("1990-01-01", UNKNOWN_PROFILE)
+    outcome = validate_resource(resource, server_sample=0)
+    assert outcome == server_error("Patient.identifier: minimum 1")
+    # The server outcome is cached: the same content is not sent again
+    assert validate_resource(resource, server_sample=0) == outcome
+    assert len(calls) == 1
+
+    # A server failure is returned as such and not cached
+    server.routes[("POST", "/Patient/$validate")] = (503, {}, "")
+    other = patient("1991-01-01", UNKNOWN_PROFILE)
+    assert validate_resource(other, server_sample=0)["issue"][0]["severity"] == "fatal"
+    assert validation_cache.get_validation_cache().get("server", other) is None
+
+
+def test_only_the_sampled_share_is_sent_to_the_server(server, monkeypatch, capsys):
+    calls = []
+    server.routes[("POST", "/Patient/$validate")] = lambda handler: calls.append(1) or (
+        200, {}, server_error("Patient.name: minimum 1"))
+    draws = iter([0.9, 0.1, 0.7, 0.2])
+    monkeypatch.setattr(validation.random, "random", lambda: next(draws))
+    outcomes = [validate_resource(patient(f"199{number}-01-01"), server_sample=0.25) for number in range(4)]
+    # Draws under 0.25 are sampled; the local verdict is returned either way
+    assert len(calls) == 2
+    assert all(outcome["issue"][0]["severity"] == "information" for outcome in outcomes)
+    assert capsys.readouterr().out.count("Local and server validation disagree") == 2
+
+    assert validate_resource(patient("2001-01-01"), server_sample=0)["issue"][0]["severity"] == "information"
+    assert len(calls) == 2
@@ -0,0 +1,95 @@
+import pytest
+from src import profile_validator, validation_cache
+from src.profile_validator import CompiledProfile
+from src.validation_cache import ValidationCache, cached_validation, content_hash
+
+PROFILE_URL = "http://example.org/fhir/StructureDefinition/test-patient"
+
+
+def definition(minimum):
+    return {"resourceType": "StructureDefinition", "url": PROFILE_URL, "version": "1.0.0", "type": "Patient",
+            "differential": {"element": [{"id": "Patient.name", "path": "Patient.name", "min": minimum}]}}
+
+
+@pytest.fixture
+def profiles(monkeypatch):
+    """
+        The local profiles, as a dict tests can replace compiled profiles in.
+    """
+    compiled = {PROFILE_URL: CompiledProfile(definition(1))}
+    monkeypatch.setattr(profile_validator, "_profiles", compiled)
+    return compiled
+
+
+def patient(number):
+    return {"resourceType": "Patient", "id": str(number), "meta": {"profile": [PROFILE_URL]},
+            "birthDate": f"19{number:02d}-01-01"}
+
+
+def outcome(diagnostics):
+    return {"resourceType": "OperationOutcome",
+            "issue": [{"severity": "information", "code": "informational", "diagnostics": diagnostics}]}
+
+
+def test_same_content_on_another_id_or_save_is_a_hit(tmp_path, profiles):
+    cache = ValidationCache(tmp_path / "cache.sqlite")
+    cache.put("local", patient(1), outcome("ok"))
+    copy = {**patient(1), "id": "elsewhere", "meta": {**patient(1)["meta"], "lastUpdated": "2025-12-01T00:00:00Z"}}
+    assert cache.get("local", copy) == outcome("ok")
+    assert cache.get("server", patient(1)) is None
+    # Outcomes about the attempt, not the resource, are not stored
+    cache.put("local", patient(2), {"resourceType": "OperationOutcome",
+                                    "issue": [{"severity": "fatal", "code": "exception"}]})
+    assert cache.get("local", patient(2)) is None
+
+
+def test_a_changed_structure_definition_invalidates_its_outcomes(tmp_path, profiles):
+    path = tmp_path / "cache.sqlite"
+    ValidationCache(path).put("local", patient(1), outcome("min 1"))
+    assert ValidationCache(path).get("local", patient(1)) == outcome("min 1")
+
+    # Same url and version, different content: the digest no longer matches
+    profiles[PROFILE_URL] = CompiledProfile(definition(2))
+    for cache in (ValidationCache(path), ValidationCache(path)):
+        assert cache.get("local", patient(1)) is None
+    assert cache.stats()["entries"] == 0
+
+    # The in-memory LRU is held to the digest as well
+    cache = ValidationCache(path)
+    cache.put("local", patient(1), outcome("min 2"))
+    profiles[PROFILE_URL] = CompiledProfile(definition(1))
+    assert cache.get("local", patient(1)) is None
+    assert cache.invalidated == 1
+
+
+def test_least_recently_used_outcomes_are_evicted_by_size(tmp_path, profiles):
+    size = len('{"resourceType":"OperationOutcome","issue":[{"severity":"information","code":"informational",'
+               '"diagnostics":"0"}]}')
+    cache = ValidationCache(tmp_path / "cache.sqlite", max_bytes=2 * size)
+    cache.put("local", patient(0), outcome("0"))
+    cache.put("local", patient(1), outcome("1"))
+    cache.flush()
+    assert cache.get("local", patient(0)) == outcome("0")  # 0 is now more recently used than 1
+    cache.put("local", patient(2), outcome("2"))
+    assert cache.evictions == 1
+    assert [cache.get("local", patient(number)) is not None for number in range(3)] == [True, False, True]
+    assert cache.stats()["bytes"] == 2 * size
+
+
+def test_memory_lru_keeps_the_most_recent_entries(tmp_path, profiles):
+    cache = ValidationCache(tmp_path / "cache.sqlite", memory_entries=2)
+    for number in range(3):
+        cache.put("local", patient(number), outcome(str(number)))
+    assert [key[1] for key in cache._memory] == [content_hash(patient(1)), content_hash(patient(2))]
+    # An entry dropped from memory is still answered from disk, and is recent again
+    assert cache.get("local", patient(0)) == outcome("0")
+    assert [key[1] for key in cache._memory] == [content_hash(patient(2)), content_hash(patient(0))]
+
+
+def test_cached_validation_calls_the_validator_once_per_content(tmp_path, profiles, monkeypatch):
+    monkeypatch.setattr(validation_cache, "_cache", ValidationCache(tmp_path / "cache.sqlite"))
+    calls = []
+    validate = cached_validation("local", lambda resource: calls.append(resource["id"]) or outcome("ok"))
+    for number in (1, 1, 2, 1):
+        assert validate(patient(number)) == outcome("ok")
+    assert calls == ["1", "2"]
@@ -0,0 +1,106 @@
+import threading
+import time
+import pytest
+import requests
+from src import http_client
+from src.write_scheduler import AIMDLimiter, WriteScheduler
+
+
+def scheduler(**settings):
+    return WriteScheduler(rate=None, report_interval=None, backoff_base=0.001, backoff_cap=0.01, **settings)
+
+
+def test_unexpected_errors_release_their_slot_and_shrink_the_limit(monkeypatch):
+    def broken(method, url, **kwargs):
+        raise requests.exceptions.ChunkedEncodingError("connection broken mid-body")
+
+    monkeypatch.setattr(http_client, "request", broken)
+    writes = scheduler(initial_concurrency=2)
+    writes.limiter.decrease_interval = 0
+    for _ in range(5):
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            writes.post("http://primary/fhir/Patient")
+    assert writes.limiter.in_flight == 0
+    assert writes.limiter.limit == 1
+    assert writes.metrics()["failed"] == 5
+
+    # Later writes still get a slot instead of blocking forever
+    created = requests.Response()
+    created.status_code = 201
+    monkeypatch.setattr(http_client, "request", lambda method, url, **kwargs: created)
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(writes.post("http://primary/fhir/Patient")),
+                              daemon=True)
+    thread.start()
+    thread.join(timeout=2)
+    assert len(responses) == 1
+
+
+def test_throttled_writes_are_retried_after_retry_after(stub):
+    server, base_url = stub
+    statuses = [429, 503, 201]
+
+    def create(handler):
+        status = statuses.pop(0)
+        return status, {"Retry-After": "0"}, {"resourceType": "Patient", "id": "p-1"}
+
+    server.routes[("POST", "/Patient")] = create
+    writes = scheduler()
+    response = writes.post(f"{base_url}/Patient", json={"resourceType": "Patient"})
+    assert response.status_code == 201
+    metrics = writes.metrics()
+    assert (metrics["retries"], metrics["throttled"], metrics["completed"], metrics["in_flight"]) == (2, 2, 1, 0)
+
+
+def test_non_idempotent_post_is_not_retried_after_a_server_error(stub):
+    server, base_url = stub
+    calls = []
+    server.routes[("POST", "/Patient")] = lambda handler: calls.append(1) or (502, {}, {})
+    response = scheduler().post(f"{base_url}/Patient", json={"resourceType": "Patient"})
+    assert response.status_code == 502
+    assert len(calls) == 1
+
+
+def test_aimd_limit_grows_on_healthy_writes_and_halves_on_overload():
+    limiter = AIMDLimiter(initial=4, maximum=8, decrease_interval=0)
+    for _ in range(40):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 8
+    limiter.acquire()
+    limiter.release(overloaded=True)
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.release(1.0)  # far above the 10 ms baseline
+    assert limiter.limit == 2
+
+
+def test_rejected_writes_are_failures_and_not_latency_samples(stub):
+    server, base_url = stub
+    server.routes[("POST", "/Patient")] = (422, {}, {"resourceType": "OperationOutcome"})
+    writes = scheduler(initial_concurrency=4)
+    for _ in range(10):
+        assert writes.post(f"{base_url}/Patient", json={"resourceType": "Patient"}).status_code == 422
+    metrics = writes.metrics()
+    assert (metrics["completed"], metrics["failed"], metrics["latency_p50"]) == (0, 10, None)
+    # Neither grown (fast rejections are not healthy writes) nor shrunk (the server is not overloaded)
+    assert writes.limiter.limit == 4
+
+
+def test_bundles_and_single_writes_have_their_own_limits(stub):
+    server, base_url = stub
+    server.routes[("POST", "/Patient")] = (201, {}, {"resourceType": "Patient", "id": "p-1"})
+    # A 50-entry Bundle takes much longer than one write without any congestion
+    server.routes[("POST", "/")] = lambda handler: time.sleep(0.05) or (
+        200, {}, {"resourceType": "Bundle", "type": "batch-response"})
+    writes = scheduler(initial_concurrency=4)
+    bundle = {"resourceType": "Bundle", "type": "batch", "entry": [{}] * 50}
+    for _ in range(10):
+        writes.post(f"{base_url}/Patient", json={"resourceType": "Patient"})
+        writes.post(f"{base_url}/", json=bundle)
+    # Each limiter only sees its own latencies, so the Bundles never set the baseline of single writes
+    assert len(writes.limiter._latencies) == len(writes.bundle_limiter._latencies) == 10
+    assert min(writes.bundle_limiter._latencies) >= 0.05 > max(writes.limiter._latencies)
+    metrics = writes.metrics()
+    assert metrics["bundle_latency_p50"] >= 0.05 > metrics["latency_p95"]
+    assert metrics["in_flight"] == 0